@@ -1,58 +1,203 @@
 # Created by Luming on 11/10/2020 1:47 PM
 from __future__ import annotations
 
-from typing import Optional, List, Dict, Any
+import threading
+from array import array
+from math import ceil
+from typing import Optional, List, Dict, Any, Tuple, Iterator
 
-from BPlusTreeNode import Node, NodeType, gen_constraint
+from BPlusTreeAggregate import Monoid, summarize, aggregate_between
+from BPlusTreeNode import Node, NodeType, Key, gen_constraint, get_separator
+from BPlusTreePacked import PackedKeys
+
+# marks an omitted argument, so that None can still be stored and returned as a value
+_MISSING = object()
+
+# guards the version clock of the nodes and the live snapshots of every tree.  reentrant, since a snapshot may be
+# released by the garbage collector at any point
+_version_lock = threading.RLock()
 
 
 class BPlusTree:
-    """construct a tree with empty root node, or with a given root"""
+    """construct a tree with empty root node, or with a given root.
+    keys builds a tree where each key is its own payload, items builds one from (key, value) pairs.
+    option lays out the nodes built from keys or items: 'dense', 'sparse', or a fill factor between 0 and 1 that
+    leaves room for later inserts, see get_node_dist_fill.
+    key_store='array' keeps leaf keys in array('q') rather than lists, for 64-bit integer keys only.
+    key_store='packed' compresses integer leaf keys by frame of reference, see PackedKeys.
+    with a wal (BPlusTreeLog.WriteAheadLog), every change made by insert, upsert, delete, pop, bulk_insert and
+    delete_range is logged before it is applied, see BPlusTreeLog.recover.
+    snapshot returns an immutable view of the tree as it is, which those changes leave as it is, see Snapshot.
+    rank, select and count_range answer positional queries in one descent each, from the number of keys under every
+    child that the internal nodes keep, see Node.get_rank.
+    aggregates names monoids, e.g. {'sum': SUM, 'max': MAX} from BPlusTreeAggregate, that the internal nodes keep
+    for every child as well, so that aggregate_range reads O(log n) nodes rather than the values in the range.
+    """
 
-    def __init__(self, order: int, root: Node = None, keys: List[int] = None, option='dense'):
+    def __init__(self, order: int, root: Node = None, keys: List[Key] = None, option='dense',
+                 items: List[Tuple[Key, Any]] = None, key_store: str = 'list', wal=None,
+                 aggregates: Dict[str, Monoid] = None):
+        if key_store not in ('list', 'array', 'packed'):
+            raise Exception('unknown key store {}'.format(key_store))
+        self.aggregates: Dict[str, Monoid] = dict(aggregates) if aggregates else {}
+        self.monoids: List[Monoid] = list(self.aggregates.values())  # in the order of the aggregates of a child
         self.option = option
         self.order: int = order
-        self.root: Node = root if root else Node(type=NodeType.ROOT, order=self.order)
-        self.constraint: Dict = gen_constraint(self.order)
+        self.key_store: str = key_store
+        self.root: Node = root if root else Node(keys=self.new_keys(), type=NodeType.ROOT)
+        self.constraint: Dict = gen_constraint(self.order)  # the only copy of the order constraint, nodes share it
         if keys:
             self.root = self.construct(keys, option)
+        elif items:
+            self.root = self.construct_items(items, option)
+        # kept in sync by every change from here on, see init_stats
+        self.height: int = 0
+        self.num_keys: int = 0
+        self.num_leaves: int = 0
+        self.first_leaf: Node = self.root
+        self.last_leaf: Node = self.root
+        self.init_stats()
+        self.wal = wal
+        self.versions: List[int] = []  # versions of the snapshots held, see snapshot
+        self.pinned: int = -1  # the newest of them, nodes stamped no later may be shared with a snapshot
 
     def __repr__(self):
-        return 'order: {}, option: {}, {} keys, {} height'.format(self.order, self.option, self.get_num_keys(),
-                                                                  self.get_height())
+        return 'order: {}, option: {}, {} keys, {} height'.format(self.order, self.option, self.num_keys, self.height)
+
+    def __len__(self) -> int:
+        return self.num_keys
+
+    def init_stats(self) -> None:
+        """count the keys and leaves, and find the height and the first and last leaf, by a walk of the whole tree.
+        for a tree built or replaced as a whole.  from then on every change keeps them up to date, so that len,
+        get_num_keys, get_num_leaves, get_height, get_min_key and get_max_key take constant time.  delete_range
+        counts the leaves it detaches from the nodes above them, see Node.get_num_leaves.
+        the aggregates of the internal nodes are computed here as well, see fill_summaries.
+        """
+        leaves = self.root.get_leaf_nodes()
+        self.num_keys = sum(leaf.get_key_size() for leaf in leaves)
+        self.num_leaves = len(leaves)
+        self.first_leaf, self.last_leaf = leaves[0], leaves[-1]
+        self.height = self.root.get_height()
+        if self.aggregates:
+            self.fill_summaries()
+
+    def update_counts(self, keys: int = 0, leaves: int = 0) -> None:
+        """add to the number of keys and leaves"""
+        self.num_keys += keys
+        self.num_leaves += leaves
+
+    def count_keys(self, path: List[Tuple[Node, int]], delta: int) -> None:
+        """add delta keys to the leaf at the end of the descent path, in the counts of the subtrees on the path and in
+        the key count of the tree"""
+        for parent, idx in path:
+            parent.counts[idx] += delta
+        self.num_keys += delta
+
+    def summarize_path(self, path: List[Tuple[Node, int]]) -> None:
+        """compute the aggregates of the children on the descent path again, bottom up, after the values of the leaf
+        at its end changed.  called before the leaf is split or merged, which leaves the aggregates of the nodes
+        above the parents it changes as they are."""
+        for parent, idx in reversed(path):
+            parent.summaries[idx] = summarize(parent.pointers[idx], self.monoids)
+
+    def summarize_children(self, node: Node, lo: int = 0, hi: int = None) -> None:
+        """compute the aggregates of the children of the node from lo up to hi, or of all of them by default"""
+        if hi is None:
+            node.summaries = [summarize(child, self.monoids) for child in node.pointers]
+        else:
+            for idx in range(lo, min(hi, node.get_pointer_size())):
+                node.summaries[idx] = summarize(node.pointers[idx], self.monoids)
+
+    def count_split(self, node: Node, new_nodes: List[Node]) -> None:
+        """account for the nodes a split of the node put to its right"""
+        if node.is_leaf():
+            self.update_counts(leaves=len(new_nodes))
+            if node is self.last_leaf:
+                self.last_leaf = new_nodes[-1]
+
+    def count_merge(self, node: Node) -> None:
+        """account for the node that was merged into the node, its left neighbor"""
+        if node.is_leaf():
+            self.update_counts(leaves=-1)
+            if node.sequence_pointer is None:
+                self.last_leaf = node
 
     def get_constraint(self) -> List[str]:
-        return self.root.get_constraint()
+        ret = ['order {}'.format(self.order)]
+        for node_type in NodeType:
+            c = self.constraint[node_type]
+            info = '{}, pointers [{}-{}], keys [{}-{}]' \
+                .format(node_type, c['min_pointers'], c['max_pointers'], c['min_keys'], c['max_keys'])
+            ret.append(info)
+        else:
+            return ret
 
-    def get_node_dist_sparse(self, num_nodes: int, node_type: NodeType = NodeType.LEAF) -> List[int]:
-        """distribute by sparse"""
-        remain = num_nodes
+    def new_keys(self, keys: List[Key] = ()) -> List[Key]:
+        """key container for a leaf, following the key store of the tree"""
+        if self.key_store == 'array':
+            return array('q', keys)
+        elif self.key_store == 'packed':
+            return PackedKeys(keys)
+        else:
+            return list(keys)
+
+    def get_bounds(self, node_type: NodeType = NodeType.LEAF) -> Tuple[int, int]:
+        """the min and max size of a node, in keys for a leaf and in pointers for an internal node"""
         if node_type == NodeType.LEAF:
-            lower = self.constraint[node_type]['min_keys']
+            return self.constraint[node_type]['min_keys'], self.constraint[node_type]['max_keys']
         else:
-            lower = self.constraint[node_type]['min_pointers']
+            return self.constraint[node_type]['min_pointers'], self.constraint[node_type]['max_pointers']
+
+    def get_fill_target(self, node_type: NodeType = NodeType.LEAF, fill_factor: float = 1.0) -> int:
+        """node size closest to fill_factor of the maximum, within the constraint"""
+        lower, upper = self.get_bounds(node_type)
+        return min(upper, max(lower, round(upper * fill_factor)))
+
+    def get_node_dist_fill(self, num: int, node_type: NodeType = NodeType.LEAF, fill_factor: float = 1.0) -> List[int]:
+        """distribute num keys over leaves, or num pointers over internal nodes, filling each to the fill target,
+        see get_fill_target.  only the tail differs: if the remainder after one more target node would be too small
+        for a node on its own, it goes into a single node if it fits, otherwise into two nodes, one of them of the
+        minimum size.
 
+        a fill factor of 1 gives the dense distribution, and any fill factor at or below the minimum occupancy
+        gives the sparse one.
+        example: order of 3, leaf min=2, max=3, 7 keys -> [3, 2, 2] at fill 1, [2, 2, 3] at fill 0.5
+        """
+        lower, upper = self.get_bounds(node_type)
+        target = self.get_fill_target(node_type, fill_factor)
+
+        remain = num
         ret = []
         while remain > 0:
-            if remain <= lower:  # extreme case, for root only
+            if remain <= target:
                 ret.append(remain)
                 remain = 0
-            # when remain - lower < lower, assigning lower to the current mode will make the remaining node
-            # violate the constraint, therefore it needs to assign all to the current node.
-            elif lower < remain < 2 * lower:
-                ret.append(remain)
+            # taking target from the remainder would leave less than the minimum for the next node
+            elif remain - target < lower:
+                if remain <= upper:
+                    ret.append(remain)
+                else:
+                    ret.extend([remain - lower, lower])
                 remain = 0
             else:
-                ret.append(lower)
-                remain -= lower
+                ret.append(target)
+                remain -= target
         else:
             return ret
 
-    def get_node_dist(self, num_keys: int, node_type: NodeType = NodeType.LEAF, option: str = 'dense') -> List[int]:
+    def get_node_dist_sparse(self, num_nodes: int, node_type: NodeType = NodeType.LEAF) -> List[int]:
+        """distribute by sparse, every node at the minimum size, the remainder goes into the last node"""
+        return self.get_node_dist_fill(num_nodes, node_type, 0.0)
+
+    def get_node_dist(self, num_keys: int, node_type: NodeType = NodeType.LEAF, option='dense') -> List[int]:
+        """option is 'dense', 'sparse', or a fill factor between 0 and 1"""
         if option == 'dense':
             leaf_distribution = self.get_node_dist_dense(num_keys, node_type)
         elif option == 'sparse':
             leaf_distribution = self.get_node_dist_sparse(num_keys, node_type)
+        elif isinstance(option, (int, float)):
+            leaf_distribution = self.get_node_dist_fill(num_keys, node_type, option)
         else:
             raise Exception('unknown option {}'.format(option))
         return leaf_distribution
@@ -75,53 +220,53 @@ class BPlusTree:
         for leaf node, group based on min_keys;
         for non-leaf node, group based on min_pointers.
         """
-        if node_type == NodeType.LEAF:
-            lower = self.constraint[node_type]['min_keys']
-            upper = self.constraint[node_type]['max_keys']
-        else:
-            lower = self.constraint[node_type]['min_pointers']
-            upper = self.constraint[node_type]['max_pointers']
+        return self.get_node_dist_fill(num_keys, node_type, 1.0)
 
-        remain = num_keys
-        ret = []
-        while remain > 0:
-            if remain <= upper:
-                ret.append(remain)
-                remain = 0
-            elif upper < remain < lower + upper:
-                last = lower
-                last_but_one = remain - lower
-                ret.extend([last_but_one, last])
-                remain = 0
-            else:
-                ret.append(upper)
-                remain -= upper
-        else:
-            return ret
+    def get_split_dist(self, num: int, node_type: NodeType = NodeType.LEAF, fill_factor: float = 1.0) -> List[int]:
+        """distribute num keys of an overflow leaf, or num pointers of an overflow internal node, evenly over as
+        many nodes as it takes to fill each to about fill_factor of the maximum, without breaking the constraint.
+        """
+        lower, upper = self.get_bounds(node_type)
+        target = self.get_fill_target(node_type, fill_factor)
+        count = max(ceil(num / upper), min(ceil(num / target), num // lower))
+        base, extra = divmod(num, count)
+        return [base + 1] * extra + [base] * (count - extra)
 
-    def construct(self, keys: List[int], option: str = 'dense') -> Node:
-        """build dense b+ tree from a provided list of keys.
+    def construct(self, keys: List[Key], option: str = 'dense') -> Node:
+        """build dense b+ tree from a provided list of keys, each key is stored as its own payload.
         1. build leaf nodes. add sequence pointer
         2. build parent nodes recursively, until a single node is returned as the root.
         """
         keys.sort()
+        return self.construct_leaves(keys, keys, option)
+
+    def construct_items(self, items: List[Tuple[Key, Any]], option: str = 'dense') -> Node:
+        """build b+ tree from (key, value) pairs, the value of each key is stored as its payload."""
+        items = sorted(items, key=lambda item: item[0])
+        keys = [key for key, _ in items]
+        values = [value for _, value in items]
+        return self.construct_leaves(keys, values, option)
+
+    def construct_leaves(self, keys: List[Key], values: List[Any], option: str = 'dense') -> Node:
+        """keys are sorted, and values[i] is the payload of keys[i]"""
         leaf_distribution = self.get_node_dist(len(keys), NodeType.LEAF, option)
         leaves = []
         start = 0
         for count in leaf_distribution:
             end = start + count
-            new_node = Node(keys=keys[start:end],
-                            payload=[str(key) for key in keys[start:end]],
-                            type=NodeType.LEAF,
-                            order=self.order)
+            new_node = Node(keys=self.new_keys(keys[start:end]),
+                            payload=values[start:end],
+                            type=NodeType.LEAF)
             leaves.append(new_node)
             start = end
 
         for i in range(len(leaves) - 1):
             leaves[i].sequence_pointer = leaves[i + 1]
+            leaves[i + 1].prev_pointer = leaves[i]
 
         num_nodes = len(leaf_distribution)
-        if num_nodes == 1:
+        if num_nodes == 1:  # the leaf is the root, which may hold fewer keys than the minimum
+            leaves[0].type = NodeType.ROOT
             return leaves[0]
         else:
             return self.construct_parents(leaves, option)
@@ -132,14 +277,17 @@ class BPlusTree:
         """
         # with num_nodes, it requires num_nodes-1 parent keys
         curr_height = nodes[0].get_height() + 1
+        separators = [get_separator(left.get_last_leaf().keys[-1], right.get_first_leaf().keys[0])
+                      for left, right in zip(nodes, nodes[1:])]
+        self.link_level(nodes, separators)
         pointer_distribution = self.get_node_dist(len(nodes), NodeType.NON_LEAF, option)
         parent_nodes = []
         start = 0
         for count in pointer_distribution:
             end = start + count
             pointers = nodes[start:end]
-            keys = [child.get_first_leaf().keys[0] for child in pointers[1:]]
-            new_node = Node(keys=keys, pointers=pointers, type=NodeType.NON_LEAF, order=self.order)
+            keys = separators[start:end - 1]
+            new_node = Node(keys=keys, pointers=pointers, type=NodeType.NON_LEAF)
             parent_nodes.append(new_node)
             start = end
 
@@ -150,6 +298,17 @@ class BPlusTree:
         else:
             return self.construct_parents(parent_nodes, option)
 
+    @staticmethod
+    def link_level(nodes: List[Node], separators: List[Key]) -> None:
+        """link a whole level from left to right and back, separators[i] goes between nodes[i] and nodes[i + 1]"""
+        for node, next_node, separator in zip(nodes, nodes[1:], separators):
+            node.sequence_pointer = next_node
+            next_node.prev_pointer = node
+            node.high_key = separator
+        nodes[0].prev_pointer = None
+        nodes[-1].sequence_pointer = None
+        nodes[-1].high_key = None
+
     def is_valid(self) -> bool:
         """perform constraint check for the given node and all its child node
         handle leaf and non-leaf nodes differently.  check payload for leaf, and pointers for non-leaf.
@@ -159,11 +318,7 @@ class BPlusTree:
             if node.get_key_size() == 0 and node.get_payload_size() == 0 and node.get_pointer_size() == 0:
                 # exception: allow empty root node
                 print('empty root node')
-                return True
-
-        if node.order is None:
-            print('node order not set.')
-            return False
+                return self.is_counted() and self.is_summarized()
 
         if node.is_root():  # test search only in root node
             if not self.test_search('any'):
@@ -187,49 +342,655 @@ class BPlusTree:
                     print("sequence pointer inconsistent.")
                     return False
 
-        if not node.is_valid():
+        if not node.is_valid(self.constraint):
+            return False
+
+        if not self.is_linked():
+            return False
+
+        return self.is_counted() and self.is_summarized()
+
+    def is_counted(self) -> bool:
+        """check the statistics kept by the changes against a walk of the tree, see init_stats"""
+        leaves = self.root.get_leaf_nodes()
+        counted = (self.num_keys, self.num_leaves, self.height, self.first_leaf, self.last_leaf)
+        walked = (sum(leaf.get_key_size() for leaf in leaves), len(leaves), self.root.get_height(), leaves[0],
+                  leaves[-1])
+        if any(a is not b and a != b for a, b in zip(counted, walked)):
+            print('statistics {} kept, {} walked'.format(counted[:3], walked[:3]))
             return False
+        return True
+
+    def is_linked(self) -> bool:
+        """check the links both ways and high keys of every level against the keys of the parents"""
+        level = [self.root]
+        high_keys = [None]
+        while True:
+            for node, next_node, high_key in zip(level, level[1:] + [None], high_keys):
+                if node.sequence_pointer is not next_node or node.high_key != high_key:
+                    print('node {} linked to {} with high key {}, expected {} with {}'
+                          .format(node.describe(), next_node and next_node.describe(), node.high_key,
+                                  next_node and next_node.get_id(), high_key))
+                    return False
+            for prev_node, node in zip([None] + level, level):
+                if node.prev_pointer is not prev_node:
+                    print('node {} linked back to {}, expected {}'.format(
+                        node.describe(), node.prev_pointer and node.prev_pointer.describe(),
+                        prev_node and prev_node.get_id()))
+                    return False
+            if not level[0].pointers:
+                return True
+            high_keys = [high_key for node in level for high_key in list(node.keys) + [node.high_key]]
+            level = [child for node in level for child in node.pointers]
 
+    def is_summarized(self) -> bool:
+        """check the aggregates kept by the internal nodes against the ones computed from their children"""
+        if not self.aggregates:
+            return True
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if node.pointers:
+                expected = [summarize(child, self.monoids) for child in node.pointers]
+                if node.summaries != expected:
+                    print('node {} keeps aggregates {}, expected {}'.format(node.describe(), node.summaries, expected))
+                    return False
+                nodes.extend(node.pointers)
         return True
 
-    def insert(self, key: int):
+    def descend(self, key: Key) -> Tuple[Node, List[Tuple[Node, int]]]:
+        """walk from the root down to the leaf that may contain the key.
+        return the leaf and the path of (node, child index) pairs taken on the way, top down.
+        the path is reused by insert and delete to fix overflow and underflow bottom up.
+        """
+        path = []
+        curr = self.root
+        while curr.pointers:
+            idx = curr.get_index(key)
+            path.append((curr, idx))
+            curr = curr.pointers[idx]
+        else:
+            return curr, path
+
+    def snapshot(self) -> Snapshot:
+        """return an immutable view of the tree as it is now, which later changes to the tree leave as it is, so that
+        a long scan of the view is consistent while the tree keeps changing.  taking one costs nothing up front, the
+        view holds the current root, and from then on the tree copies on write: a change copies the nodes on its path
+        from the root that the view may hold, and leaves the originals to the view (path copying), see own_path.
+        old nodes live as long as a view holds them.  once the last view is released, the tree changes its nodes in
+        place again, see Snapshot.release.
+        the view must not be taken halfway through a change, see ConcurrentBPlusTree for one shared between threads.
+        """
+        with _version_lock:
+            version = Node.clock
+            Node.clock += 1
+            self.versions.append(version)
+            self.pinned = version
+        return Snapshot(self, version)
+
+    def unpin(self, version: int) -> None:
+        """forget a released snapshot.  nodes stamped after the newest snapshot still held are changed in place."""
+        with _version_lock:
+            self.versions.remove(version)
+            self.pinned = max(self.versions, default=-1)
+
+    def own_root(self) -> Node:
+        """return the root, copied first if a snapshot may hold it"""
+        if self.root.epoch <= self.pinned:
+            self.root = self.root.copy()
+            if self.root.is_leaf():
+                self.first_leaf = self.last_leaf = self.root
+        return self.root
+
+    def own_child(self, parent: Node, idx: int, prev: Optional[Node]) -> Node:
+        """return the idx-th child of the parent, copied first if a snapshot may hold it.  the parent is not shared,
+        prev is the node before the parent on its level.  the copy takes the place of the child in the parent, and in
+        the link from the node before it, which is changed in place even if that node is shared: a snapshot walks its
+        leaves by descent rather than by links.
+        """
+        child = parent.pointers[idx]
+        if child.epoch > self.pinned:
+            return child
+        copy = child.copy()
+        parent.pointers[idx] = copy
+        before = self.get_prev(parent, idx, prev)
+        if before is not None:
+            before.sequence_pointer = copy
+        if copy.sequence_pointer is not None:
+            copy.sequence_pointer.prev_pointer = copy
+        if child is self.first_leaf:
+            self.first_leaf = copy
+        if child is self.last_leaf:
+            self.last_leaf = copy
+        return copy
+
+    def own_path(self, path: List[Tuple[Node, int]]) -> Tuple[Node, List[Tuple[Node, int]]]:
+        """copy on write of a descent path: copy every node on it that a snapshot may hold, from the root down, and
+        return the leaf and the path through the copies, which a change may then modify in place.
+        """
+        node = self.own_root()
+        prev = None
+        owned = []
+        for _, idx in path:
+            owned.append((node, idx))
+            child = self.own_child(node, idx, prev)
+            prev = self.get_prev(node, idx, prev)
+            node = child
+        else:
+            return node, owned
+
+    @staticmethod
+    def get_prev(parent: Node, idx: int, prev: Optional[Node]) -> Optional[Node]:
+        """the node before the idx-th child of the parent on its level, prev is the node before the parent.
+        None if prev was emptied by delete_range, which relinks the level once it drops prev."""
+        if idx > 0:
+            return parent.pointers[idx - 1]
+        return prev.pointers[-1] if prev is not None and prev.pointers else None
+
+    def get_prevs(self, path: List[Tuple[Node, int]]) -> List[Optional[Node]]:
+        """the node before each parent on a descent path from the root, on its level"""
+        prevs = [None]
+        for parent, idx in path[:-1]:
+            prevs.append(self.get_prev(parent, idx, prevs[-1]))
+        return prevs
+
+    def insert(self, key: Key, value: Any = _MISSING):
         """1. find possible position within a leaf node that may store this key
         2. insert into the position
         3. on the upper level, check if it overflows
+        without a value, the key itself is stored as the payload.  inserting an existing key raises KeyError,
+        use upsert to replace the value instead.
+        """
+        leaf, path = self.descend(key)
+        if leaf.get_key_idx(key) is not None:
+            raise KeyError('key {} already exists.'.format(key))
+        if value is _MISSING:
+            value = key
+        self.insert_at(key, value, leaf, path)
+
+    def insert_at(self, key: Key, value: Any, leaf: Node, path: List[Tuple[Node, int]]) -> None:
+        """insert a key that does not exist into the leaf reached by path, then split the nodes that overflow"""
+        if self.wal:
+            self.wal.append('insert', key, value)
+        if self.pinned >= 0:
+            leaf, path = self.own_path(path)
+        leaf.insert_key(key, value)
+        self.count_keys(path, 1)
+        if self.aggregates:
+            self.summarize_path(path)
+        self.fix_overflow(leaf, path)
+
+    def upsert(self, key: Key, value: Any) -> None:
+        """replace the value of an existing key in place, or insert the key if it does not exist."""
+        if self.wal:
+            self.wal.append('upsert', key, value)
+        leaf, path = self.descend(key)
+        if self.pinned >= 0:
+            leaf, path = self.own_path(path)
+        idx = leaf.get_key_idx(key)
+        if idx is not None:
+            leaf.payload[idx] = value
+            if self.aggregates:
+                self.summarize_path(path)
+        else:
+            leaf.insert_key(key, value)
+            self.count_keys(path, 1)
+            if self.aggregates:
+                self.summarize_path(path)
+            self.fix_overflow(leaf, path)
+
+    def fix_overflow(self, node: Node, path: List[Tuple[Node, int]]) -> None:
+        """split the overflow node and walk back up the descent path, splitting every parent that overflows in turn.
+        a root split adds a new root on top, which is the only way for the tree to grow in height.
         """
-        self.root.insert_key(key, str(key), 0)
-
-        if self.root.is_overflow():
-            print('root overflows.  left and right node: ')
-            new_node = self.root.split()
-            root_key = new_node.get_first_leaf().keys[0]
-            new_root = Node(keys=[root_key], pointers=[self.root, new_node], type=NodeType.ROOT, order=self.order)
-            print('new root: {}'.format(new_root))
-            print('left child: {}'.format(self))
-            print('right child: {}'.format(new_node))
+        for parent, idx in reversed(path):
+            if not node.is_overflow(self.constraint):
+                return
+            if Node.tracer:
+                Node.tracer('INSERTION OVERFLOW')
+                Node.tracer('NODE BEFORE SPLIT: {}', node)
+            new_node, separator = node.split(self.constraint)
+            self.count_split(node, [new_node])
+            if Node.tracer:
+                Node.tracer('NODE AFTER SPLIT: {}', node)
+                Node.tracer('NEW NODE: {}', new_node)
+                Node.tracer('NODE BEFORE INSERT: {}', parent)
+            # insert to the right of the original node that just got split
+            parent.add_children(idx, [new_node], [separator])
+            if self.aggregates:
+                self.summarize_children(parent, idx, idx + 2)
+            if Node.tracer:
+                Node.tracer('NODE AFTER INSERT: {}', parent)
+            node = parent
+
+        # the walk reached the root, unless the path only covers the levels a concurrent writer holds
+        if node is self.root and node.is_overflow(self.constraint):
+            if Node.tracer:
+                Node.tracer('root overflows.  left and right node: ')
+            new_node, separator = self.root.split(self.constraint)
+            self.count_split(self.root, [new_node])
+            new_root = Node(keys=[separator], pointers=[self.root, new_node], type=NodeType.ROOT)
+            if self.aggregates:
+                self.summarize_children(new_root)
+            if Node.tracer:
+                Node.tracer('new root: {}', new_root)
+                Node.tracer('left child: {}', self.root)
+                Node.tracer('right child: {}', new_node)
             self.root = new_root
+            self.height += 1
+
+    def bulk_insert(self, sorted_items: List[Tuple[Key, Any]], fill_factor: float = 1.0) -> None:
+        """merge a batch of (key, value) pairs in ascending key order into the tree, one leaf at a time.
+        all the pairs that fall within one leaf are merged into it with a single descent, and a leaf that overflows
+        is split once into as many leaves as needed, each filled to about fill_factor.  existing keys get the new
+        value, as in upsert.
+        """
+        for (prev, _), (key, _) in zip(sorted_items, sorted_items[1:]):
+            if key <= prev:
+                raise Exception('items not sorted by key: {} after {}'.format(key, prev))
+        if self.wal:
+            self.wal.append('bulk_insert', list(sorted_items), fill_factor)
+
+        num_items = len(sorted_items)
+        i = 0
+        while i < num_items:
+            leaf, path = self.descend(sorted_items[i][0])
+            if self.pinned >= 0:
+                leaf, path = self.own_path(path)
+            upper = leaf.high_key  # the leaf covers the keys below it
 
-    def delete(self, key: int) -> None:
-        if self.search(key) is None:
-            print('key {} does not exist.'.format(key))
+            keys, payload = leaf.keys, leaf.payload
+            new_keys, new_payload = [], []
+            pos = 0
+            while i < num_items and (upper is None or sorted_items[i][0] < upper):
+                key, value = sorted_items[i]
+                while pos < len(keys) and keys[pos] < key:
+                    new_keys.append(keys[pos])
+                    new_payload.append(payload[pos])
+                    pos += 1
+                if pos < len(keys) and keys[pos] == key:  # replace the value of an existing key
+                    pos += 1
+                new_keys.append(key)
+                new_payload.append(value)
+                i += 1
+            new_keys.extend(keys[pos:])
+            new_payload.extend(payload[pos:])
+            self.count_keys(path, len(new_keys) - len(keys))
+            leaf.keys = self.new_keys(new_keys)
+            leaf.payload = new_payload
+            if self.aggregates:
+                self.summarize_path(path)
+
+            self.fix_overflow_many(leaf, path, fill_factor)
+
+    def fix_overflow_many(self, node: Node, path: List[Tuple[Node, int]], fill_factor: float = 1.0) -> None:
+        """same as fix_overflow, but an overflow node may hold many nodes worth of keys.  it is split once into as many
+        nodes as needed, see get_split_dist.  the root keeps splitting until it fits, adding a level each time.
+        """
+        for parent, idx in reversed(path):
+            if not node.is_overflow(self.constraint):
+                return
+            node_type = NodeType.LEAF if node.is_leaf() else NodeType.NON_LEAF
+            sizes = self.get_split_dist(node.get_pointer_size() or node.get_key_size(), node_type, fill_factor)
+            if Node.tracer:
+                Node.tracer('BULK SPLIT INTO {} NODES: {}', len(sizes), node)
+            new_nodes, separators = node.split_into(sizes)
+            self.count_split(node, new_nodes)
+            parent.add_children(idx, new_nodes, separators)
+            if self.aggregates:
+                self.summarize_children(parent, idx, idx + 1 + len(new_nodes))
+            node = parent
+
+        while self.root.is_overflow(self.constraint):
+            node_type = NodeType.LEAF if self.root.is_leaf() else NodeType.NON_LEAF
+            sizes = self.get_split_dist(self.root.get_pointer_size() or self.root.get_key_size(), node_type,
+                                        fill_factor)
+            if Node.tracer:
+                Node.tracer('BULK SPLIT ROOT INTO {} NODES: {}', len(sizes), self.root)
+            new_nodes, separators = self.root.split_into(sizes)
+            self.count_split(self.root, new_nodes)
+            self.root = Node(keys=separators, pointers=[self.root] + new_nodes, type=NodeType.ROOT)
+            if self.aggregates:
+                self.summarize_children(self.root)
+            self.height += 1
+
+    def delete(self, key: Key) -> None:
+        leaf, path = self.descend(key)
+        if leaf.get_key_idx(key) is None:
+            if Node.tracer:
+                Node.tracer('key {} does not exist.', key)
         else:
-            print('DELETING KEY: {}'.format(key))
-            self.root.delete_key(key)
-            if self.root.is_singular():
-                print('SINGULAR ROOT, ELEVATE CHILD. ')
-                print('OLD ROOT: \n{}\n'.format(self.root))
-                self.root = self.root.pointers[0]
-                self.root.type = NodeType.ROOT
-                print('NEW ROOT: \n{}\n'.format(self.root))
-
-    def range_search(self, left, right) -> List[str]:
+            self.delete_at(key, leaf, path)
+
+    def pop(self, key: Key, default: Any = _MISSING) -> Any:
+        """delete the key and return its value.  if the key does not exist, return default if given,
+        otherwise raise KeyError."""
+        leaf, path = self.descend(key)
+        idx = leaf.get_key_idx(key)
+        if idx is None:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        value = leaf.payload[idx]
+        self.delete_at(key, leaf, path)
+        return value
+
+    def delete_at(self, key: Key, leaf: Node, path: List[Tuple[Node, int]]) -> None:
+        """delete an existing key from the leaf reached by path, then rebalance and shrink the root if needed"""
+        if self.wal:
+            self.wal.append('delete', key)
+        if Node.tracer:
+            Node.tracer('DELETING KEY: {}', key)
+        if self.pinned >= 0:
+            leaf, path = self.own_path(path)
+        leaf.delete_key(key)
+        self.count_keys(path, -1)
+        if self.aggregates:
+            self.summarize_path(path)
+        self.fix_underflow(path)
+        if self.root.is_singular():
+            if Node.tracer:
+                Node.tracer('SINGULAR ROOT, ELEVATE CHILD. ')
+                Node.tracer('OLD ROOT: \n{}\n', self.root)
+            self.root = self.root.pointers[0]
+            self.root.type = NodeType.ROOT
+            self.height -= 1
+            if Node.tracer:
+                Node.tracer('NEW ROOT: \n{}\n', self.root)
+
+    def delete_range(self, left: Key, right: Key) -> int:
+        """delete every key within [left, right], return the number of keys deleted.
+        subtrees that lie fully within the range are detached as a whole, only the nodes on the two boundary paths
+        are trimmed and rebalanced, see delete_range_under.
+        """
+        if right < left:
+            return 0
+        if self.wal:
+            self.wal.append('delete_range', left, right)
+        if Node.tracer:
+            Node.tracer('DELETING RANGE: [{}, {}]', left, right)
+        removed = self.delete_range_under(self.own_root(), left, right)
+        self.num_keys -= removed
+
+        while self.root.get_pointer_size() == 1:
+            if Node.tracer:
+                Node.tracer('SINGULAR ROOT, ELEVATE CHILD. ')
+            self.root = self.root.pointers[0]
+            self.height -= 1
+        if self.root.is_empty() and self.root.is_leaf():  # everything is deleted
+            self.root = Node(keys=self.new_keys(), type=NodeType.ROOT)
+            self.height = 0
+            self.num_leaves = 1
+        self.own_root().type = NodeType.ROOT
+        # merges along the boundary may have run before the last leaves were relinked
+        self.first_leaf = self.root.get_first_leaf()
+        self.last_leaf = self.root.get_last_leaf()
+        node = self.root
+        while node:  # the right most nodes of the remaining levels
+            node.sequence_pointer = None
+            node.high_key = None
+            node = node.pointers[-1] if node.pointers else None
+        node = self.root
+        while node:  # and the left most ones
+            node.prev_pointer = None
+            node = node.pointers[0] if node.pointers else None
+        return removed
+
+    def delete_range_under(self, node: Node, left: Key, right: Key, prev: Node = None) -> int:
+        """delete keys within [left, right] under the node, return the number of keys deleted.
+        the children between the one routing left and the one routing right are covered by the range, and are dropped
+        without a visit to their keys.  the two boundary children are handled recursively, emptied children are
+        dropped, and leaf links are repaired across the affected children.  the node itself may be left underflow,
+        which is fixed by its parent, or by the root collapse in delete_range.
+        the node is not shared with a snapshot, and prev is the node before it on its level, see own_child.
+        """
+        if node.is_leaf():
+            lo = node.get_left_index(left)
+            hi = node.get_index(right)
+            if lo >= hi:
+                return 0
+            del node.keys[lo:hi]
+            del node.payload[lo:hi]
+            if node.is_empty():  # dropped by the parent, or replaced if it is the root
+                self.update_counts(leaves=-1)
+            return hi - lo
+
+        lo = node.get_index(left)
+        hi = node.get_index(right)
+        removed = 0
+        if hi > lo + 1:
+            removed += sum(node.counts[lo + 1:hi])
+            self.update_counts(leaves=-sum(child.get_num_leaves() for child in node.pointers[lo + 1:hi]))
+            del node.pointers[lo + 1:hi]
+            del node.keys[lo:hi - 1]
+            del node.counts[lo + 1:hi]
+            if self.aggregates:
+                del node.summaries[lo + 1:hi]
+
+        boundary = [lo, lo + 1] if hi > lo else [lo]
+        for idx in boundary:
+            child = self.own_child(node, idx, prev)
+            removed += self.delete_range_under(child, left, right, self.get_prev(node, idx, prev))
+            node.counts[idx] = child.get_count()
+        for idx in reversed(boundary):
+            child = node.pointers[idx]
+            if child.is_empty() and child.is_leaf():  # an internal node left with no child looks like an empty leaf
+                node.pointers.pop(idx)
+                node.counts.pop(idx)
+                if self.aggregates:
+                    node.summaries.pop(idx)
+                if node.keys:
+                    node.keys.pop(idx - 1 if idx > 0 else 0)
+
+        for idx in range(max(lo - 1, 0), min(lo + 2, node.get_pointer_size()) - 1):
+            self.link_spines(node.pointers[idx], node.pointers[idx + 1], node.keys[idx])
+
+        self.fix_children(node, prev)
+        return removed
+
+    @staticmethod
+    def link_spines(left: Node, right: Node, separator: Key) -> None:
+        """link two adjacent subtrees on every level, the right most node of each level of left to the left most node
+        of the same level of right.  separator is the key between them in their parent.
+        """
+        while True:
+            left.sequence_pointer = right
+            right.prev_pointer = left
+            left.high_key = separator
+            if not left.pointers:
+                return
+            left = left.pointers[-1]
+            right = right.pointers[0]
+
+    def fix_children(self, node: Node, prev: Node = None) -> None:
+        """rebalance the underflow children of the node, whatever their shortage.
+        an underflow child is merged into a neighbor, the merged node is rebalanced inside first if it is internal,
+        then split evenly if it overflows.  repeat until no child underflows, or a single child is left.  the
+        aggregates of the children are computed again at the end, for delete_range_under as well.
+        the node is not shared with a snapshot, and prev is the node before it on its level, see own_child.
+        """
+        while node.get_pointer_size() > 1:
+            for idx, child in enumerate(node.pointers):
+                if child.is_underflow(self.constraint):
+                    break
+            else:
+                break
+
+            if idx == node.get_pointer_size() - 1:
+                idx -= 1
+            if Node.tracer:
+                Node.tracer('FIX BY MERGING')
+                Node.tracer('LEFT NODE BEFORE MERGE: {}', node.pointers[idx])
+                Node.tracer('RIGHT NODE BEFORE MERGE: {}', node.pointers[idx + 1])
+            self.own_child(node, idx, prev)
+            merged = node.concat(idx)
+            self.count_merge(merged)
+            if not merged.is_leaf():
+                self.fix_children(merged, self.get_prev(node, idx, prev))
+            if merged.is_overflow(self.constraint):
+                node_type = NodeType.LEAF if merged.is_leaf() else NodeType.NON_LEAF
+                sizes = self.get_split_dist(merged.get_pointer_size() or merged.get_key_size(), node_type)
+                new_nodes, separators = merged.split_into(sizes)
+                self.count_split(merged, new_nodes)
+                node.add_children(idx, new_nodes, separators)
+        if self.aggregates:
+            self.summarize_children(node)
+
+    def fix_underflow(self, path: List[Tuple[Node, int]]) -> None:
+        """walk back up the descent path, fixing the underflow child of each parent.
+        stop as soon as a child is not underflow, since the levels above are left untouched.
+        while a snapshot is held, the path from the root is copied by the caller, see own_path, and the siblings of
+        an underflow child are copied here before they may lend to it or take it in.
+        """
+        prevs = self.get_prevs(path) if self.pinned >= 0 else [None] * len(path)
+        for (parent, idx), prev in zip(reversed(path), reversed(prevs)):
+            if not parent.pointers[idx].is_underflow(self.constraint):
+                return
+            if Node.tracer:
+                Node.tracer('UNDERFLOW CAUSED BY DELETE')
+                Node.tracer('NODE BEFORE FIX: {}', parent.pointers[idx])
+            if self.pinned >= 0:
+                for sibling in range(max(idx - 1, 0), min(idx + 2, parent.get_pointer_size())):
+                    self.own_child(parent, sibling, prev)
+            # priority: redistribution > merge
+            # try merge with neighbor nodes
+            if parent.redistribute(idx, self.constraint):
+                pass
+            elif parent.merge(idx, self.constraint):  # merge curr and right
+                self.count_merge(parent.pointers[idx])
+            elif parent.merge(idx - 1, self.constraint):  # merge left and curr
+                self.count_merge(parent.pointers[idx - 1])
+            else:  # singular case,
+                if Node.tracer:
+                    Node.tracer('singular case, cannot redistribute nor merge')
+            if self.aggregates:  # of the child and the siblings it took keys from or was merged with
+                self.summarize_children(parent, max(idx - 1, 0), idx + 2)
+
+    def range_search(self, left, right, reverse: bool = False) -> List[Any]:
+        """values of the keys within [left, right], in descending key order if reverse"""
+        if reverse:
+            return [value for _, value in self.iter_range(left, right, reverse=True)]
         return self.root.range_search(left, right)
 
-    def search_node(self, target: int) -> Optional[Node]:
-        return self.search_node(target)
+    def iter_range(self, left: Key = None, right: Key = None, inclusive: Tuple[bool, bool] = (True, True),
+                   reverse: bool = False, limit: int = None, offset: int = 0) -> Iterator[Tuple[Key, Any]]:
+        """lazily yield (key, value) pairs with keys between left and right, in ascending order or descending if
+        reverse.  a bound of None leaves that side open, inclusive tells whether each bound itself is matched.
+        offset skips that many matches and limit stops after that many, so a page of results only visits the
+        leaves it comes from, the skipped matches are counted out by rank, see skip_matches.  the tree should not be
+        modified while the iterator is in use, iterate over a snapshot of it for that, see snapshot.
+        """
+        if offset > 0:
+            bounds = skip_matches(self.root, self.num_keys, left, right, inclusive, reverse, offset)
+            if bounds is None:
+                return
+            left, right, inclusive = bounds
+            offset = 0
+        if reverse:
+            leaves = self.iter_leaves_reverse(right)
+        else:
+            leaves = self.iter_leaves(left)
+        yield from iter_pairs(leaves, left, right, inclusive, reverse, limit, offset)
+
+    def iter_reverse(self, from_key: Key = None, inclusive: bool = True, limit: int = None) \
+            -> Iterator[Tuple[Key, Any]]:
+        """lazily yield (key, value) pairs in descending key order, from from_key down, or from the largest key for
+        None.  inclusive tells whether from_key itself is matched.  the leaves are walked back by their prev
+        pointers, so the top limit keys, e.g. the latest entries of a tree keyed by time, take a descent and the
+        leaves they are in.
+        """
+        return self.iter_range(None, from_key, (True, inclusive), reverse=True, limit=limit)
+
+    def rank(self, key: Key) -> int:
+        """number of keys smaller than the key, which is the position of the key in key order if it exists"""
+        return self.root.get_rank(key)
+
+    def select(self, position: int) -> Key:
+        """the key at the position in key order, counted from 0, or from the end if negative as for a list.
+        select(len(tree) // 2) is the median key."""
+        return select_position(self.root, self.num_keys, position)
+
+    def count_range(self, left: Key = None, right: Key = None, inclusive: Tuple[bool, bool] = (True, True)) -> int:
+        """number of keys between left and right, with the bounds of iter_range, by two descents rather than a scan"""
+        return count_between(self.root, self.num_keys, left, right, inclusive)
+
+    def aggregate_range(self, left: Optional[Key], right: Optional[Key], op: str,
+                        inclusive: Tuple[bool, bool] = (True, True)) -> Any:
+        """the aggregate named op, one of the aggregates of the tree, of the values with keys between left and right,
+        with the bounds of iter_range.  the identity of the aggregate if there are none.  it reads the aggregates
+        kept for the children covered by the range, and the values of the two leaves at its ends only, see
+        BPlusTreeAggregate.aggregate_under.
+        """
+        return aggregate_between(self.root, self.aggregates, left, right, op, inclusive)
+
+    def iter_leaves(self, key: Key = None) -> Iterator[Node]:
+        """from the leaf that may contain the key (first leaf for None) to the last leaf, by sequence pointers"""
+        curr = self.get_first_leaf() if key is None else self.descend(key)[0]
+        while curr:
+            yield curr
+            curr = curr.sequence_pointer
+
+    def iter_leaves_reverse(self, key: Key = None) -> Iterator[Node]:
+        """from the leaf that may contain the key (last leaf for None) back to the first leaf, by prev pointers"""
+        curr = self.get_last_leaf() if key is None else self.descend(key)[0]
+        while curr:
+            yield curr
+            curr = curr.prev_pointer
+
+    def search_node(self, target: Key) -> Optional[Node]:
+        leaf, _ = self.descend(target)
+        return leaf
 
-    def search(self, target: int) -> Optional[Any, None]:
-        return self.root.search(target)
+    def search(self, target: Key) -> Optional[Any, None]:
+        return self.get(target)
+
+    def get(self, key: Key, default: Any = None) -> Any:
+        """return the value stored for the key, or default if the key does not exist"""
+        leaf, _ = self.descend(key)
+        idx = leaf.get_key_idx(key)
+        if idx is not None:
+            return leaf.payload[idx]
+        else:
+            return default
+
+    def __contains__(self, key: Key) -> bool:
+        leaf, _ = self.descend(key)
+        return leaf.get_key_idx(key) is not None
+
+    def search_many(self, keys: List[Key], presorted: bool = False, default: Any = None) -> List[Any]:
+        """look up a batch of keys, return their values in the order of the given keys, default for missing ones.
+        the batch is visited in sorted order: descend once, then sweep forward along the sequence pointers.
+        a key that lies beyond the next few leaves is cheaper to reach from the root, so it descends again.
+        keys may be a list or a numpy array, pass presorted=True to skip sorting an already sorted batch.
+        """
+        if hasattr(keys, 'tolist'):  # numpy array, compare on python ints rather than numpy scalars
+            keys = keys.tolist()
+        ret = [default] * len(keys)
+        if presorted:
+            order = range(len(keys))
+        else:
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+
+        max_hops = max(1, self.height)  # a descent costs one step per level
+        leaf = None
+        for i in order:
+            key = keys[i]
+            if leaf is not None:
+                # the leaf covers the key up to its high key
+                hops = 0
+                while leaf.high_key is not None and key >= leaf.high_key and hops < max_hops:
+                    leaf = leaf.sequence_pointer
+                    hops += 1
+                if leaf.high_key is not None and key >= leaf.high_key:
+                    leaf = None
+            if leaf is None:
+                leaf, _ = self.descend(key)
+
+            idx = leaf.get_key_idx(key)
+            if idx is not None:
+                ret[i] = leaf.payload[idx]
+        else:
+            return ret
 
     def fill_type(self, node: Node = None) -> None:
         if node is None:
@@ -256,68 +1017,77 @@ class BPlusTree:
             for child in node.pointers:
                 self.fill_payload(child)
 
-    def fill_order(self) -> None:
-        stack = [self.root]
-        while stack:
-            curr = stack.pop()
-            curr.order = self.order
-            stack.extend(curr.pointers[::-1])
+    def fill_counts(self, node: Node = None) -> int:
+        """count the keys under every child of the internal nodes, return the number of keys under the node"""
+        if node is None:
+            node = self.root
+
+        if node.is_leaf():
+            return node.get_key_size()
+        else:
+            node.counts = [self.fill_counts(child) for child in node.pointers]
+            return sum(node.counts)
+
+    def fill_summaries(self, node: Node = None) -> tuple:
+        """compute the aggregates of the children of the internal nodes, return the aggregates of the node"""
+        if node is None:
+            node = self.root
+
+        if not node.is_leaf():
+            node.summaries = [self.fill_summaries(child) for child in node.pointers]
+        return summarize(node, self.monoids)
 
     def add_sequence_pointers(self) -> None:
-        """add sequence pointers between child leaf nodes in place, do for the whole tree"""
-        stack = [self.root]
-        prev: Optional[Node] = None
-        while stack:
-            curr = stack.pop()
-            if curr.is_leaf() and not curr.is_root():  # here exclude the single root case by checking type
-                if prev:
-                    prev.sequence_pointer = curr
-                    prev = curr
-                else:
-                    prev = curr
-            else:
-                for child in reversed(curr.pointers):
-                    stack.append(child)
+        """link every level in place, do for the whole tree.  the high key of a node is the key to its right in the
+        parent, or the high key of the parent for the last child."""
+        level = [self.root]
+        high_keys = [None]
+        while True:
+            self.link_level(level, high_keys[:-1])
+            if not level[0].pointers:
+                return
+            high_keys = [high_key for node in level for high_key in list(node.keys) + [node.high_key]]
+            level = [child for node in level for child in node.pointers]
 
     def build(self) -> bool:
         """try to build a tree from given key structure,
         return if the build is successful and if the resulting tree is valid"""
-        self.fill_order()
         self.fill_type()
         self.fill_payload()
         self.add_sequence_pointers()
+        self.fill_counts()
+        self.init_stats()
         return self.is_valid()
 
     def get_num_leaves(self) -> int:
-        return self.root.get_num_leaves()
+        return self.num_leaves
 
     def get_num_keys(self) -> int:
         """get the number of keys in leaf nodes"""
-        return self.root.get_num_keys_total()
+        return self.num_keys
 
     def get_leaf_nodes(self) -> List[Node]:
         return self.root.get_leaf_nodes()
 
     def get_first_leaf(self) -> Node:
-        """get the first leaf under the given node"""
-        return self.root.get_first_leaf()
+        return self.first_leaf
 
     def get_last_leaf(self) -> Node:
-        return self.root.get_last_leaf()
+        return self.last_leaf
 
-    def get_min_key(self) -> int:
-        return self.root.get_min_key()
+    def get_min_key(self) -> Key:
+        return self.first_leaf.keys[0]
 
-    def get_max_key(self) -> int:
-        return self.root.get_max_key()
+    def get_max_key(self) -> Key:
+        return self.last_leaf.keys[-1]
 
-    def get_leaf_keys(self, option='sequential') -> List[int]:
+    def get_leaf_keys(self, option='sequential') -> List[Key]:
         return self.root.get_leaf_keys(option)
 
     def get_height(self) -> int:
-        return self.root.get_height()
+        return self.height
 
-    def get_key_layer(self, height: int = 0) -> List[List[int]]:
+    def get_key_layer(self, height: int = 0) -> List[List[Key]]:
         """for default argument, return the leaf keys.  For leaves, it traverses top down,
         rather than using sequence pointers"""
         return self.root.get_key_layer(height)
@@ -343,7 +1113,7 @@ class BPlusTree:
         while curr:
             for key in curr.keys:
                 count += 1
-                if self.search(key) is None:
+                if key not in self:
                     report = 'key {} exist but not found.'.format(key)
                     if option == 'any':
                         print(report)
@@ -359,3 +1129,231 @@ class BPlusTree:
                 return True
             else:
                 return False
+
+
+def descend_edge(root: Node, step: int) -> Tuple[Node, List[Tuple[Node, int]]]:
+    """walk down to the first leaf under the root for step 1, or the last one for step -1, return it and the path"""
+    path = []
+    curr = root
+    while curr.pointers:
+        idx = 0 if step > 0 else len(curr.pointers) - 1
+        path.append((curr, idx))
+        curr = curr.pointers[idx]
+    else:
+        return curr, path
+
+
+def walk_leaves(curr: Node, path: List[Tuple[Node, int]], step: int) -> Iterator[Node]:
+    """yield the leaf reached by the descent path, then the leaves after it for step 1, or before it for step -1,
+    without links: climb to the nearest ancestor with a child on that side, then go down its nearest children.
+    """
+    while True:
+        yield curr
+        while path and not 0 <= path[-1][1] + step < path[-1][0].get_pointer_size():
+            path.pop()
+        if not path:
+            return
+        node, idx = path.pop()
+        path.append((node, idx + step))
+        curr, below = descend_edge(node.pointers[idx + step], step)
+        path.extend(below)
+
+
+def iter_pairs(leaves: Iterator[Node], left: Key, right: Key, inclusive: Tuple[bool, bool], reverse: bool,
+               limit: Optional[int], offset: int) -> Iterator[Tuple[Key, Any]]:
+    """the (key, value) pairs of BPlusTree.iter_range, taken from the leaves in the order given, from the leaf that
+    may contain the first bound onwards"""
+    if limit is not None and limit <= 0:
+        return
+    skip = offset
+    count = 0
+    for leaf in leaves:
+        keys = leaf.keys
+        lo = 0 if left is None else leaf.get_left_index(left, inclusive[0])
+        if right is None:
+            hi = len(keys)
+        else:
+            hi = leaf.get_index(right) if inclusive[1] else leaf.get_left_index(right)
+
+        if skip >= hi - lo:  # the whole leaf is skipped without touching its pairs
+            skip -= max(0, hi - lo)
+        else:
+            if reverse:
+                positions = range(hi - 1 - skip, lo - 1, -1)
+            else:
+                positions = range(lo + skip, hi)
+            skip = 0
+            payload = leaf.payload
+            for i in positions:
+                yield keys[i], payload[i]
+                count += 1
+                if count == limit:
+                    return
+
+        # the rest of the range lies beyond this leaf only if the bound was not reached within it
+        if (lo > 0) if reverse else (hi < len(keys)):
+            return
+
+
+def select_position(root: Node, num_keys: int, position: int) -> Key:
+    """the key at the position under the root, which holds num_keys keys, see BPlusTree.select"""
+    if position < 0:
+        position += num_keys
+    if not 0 <= position < num_keys:
+        raise IndexError('position {} out of range for {} keys'.format(position, num_keys))
+    return root.select(position)
+
+
+def count_between(root: Node, num_keys: int, left: Key, right: Key, inclusive: Tuple[bool, bool]) -> int:
+    """number of keys under the root between left and right, see BPlusTree.count_range"""
+    lo = 0 if left is None else root.get_rank(left, not inclusive[0])
+    hi = num_keys if right is None else root.get_rank(right, inclusive[1])
+    return max(hi - lo, 0)
+
+
+def skip_matches(root: Node, num_keys: int, left: Key, right: Key, inclusive: Tuple[bool, bool], reverse: bool,
+                 offset: int) -> Optional[Tuple[Key, Key, Tuple[bool, bool]]]:
+    """move the bound that a scan of BPlusTree.iter_range starts from to the match after the first offset ones, by
+    rank and select rather than a walk over the leaves they are in.  return the new bounds and inclusive flags, or
+    None if there are no more matches."""
+    if reverse:
+        position = (num_keys if right is None else root.get_rank(right, inclusive[1])) - 1 - offset
+        if position < 0:
+            return None
+        return left, root.select(position), (inclusive[0], True)
+    position = (0 if left is None else root.get_rank(left, not inclusive[0])) + offset
+    if position >= num_keys:
+        return None
+    return root.select(position), right, (True, inclusive[1])
+
+
+class Snapshot:
+    """immutable view of a tree as it was when BPlusTree.snapshot took it, a consistent point in time for long scans
+    while the tree keeps changing.  it shares every node the tree has not changed since, the tree copies a node
+    before it changes it.  release the view once done with it, or use it as a context manager: until then every
+    change to the tree copies the nodes it shares with the view, and the old nodes stay alive.
+
+    the links and high keys of shared nodes follow the tree, so the view does not read them: it walks its leaves
+    along descent paths, see walk_leaves.  a view carries the attributes BPlusTreeSnapshot.dump reads, so it can be
+    dumped while the tree keeps changing.
+    """
+
+    def __init__(self, tree: BPlusTree, version: int):
+        self.tree = tree
+        self.version: int = version
+        self.root: Optional[Node] = tree.root  # None once released
+        self.height: int = tree.height
+        self.num_keys: int = tree.num_keys
+        self.num_leaves: int = tree.num_leaves
+        self.aggregates: Dict[str, Monoid] = tree.aggregates
+        self.order: int = tree.order
+        self.option = tree.option
+        self.key_store: str = tree.key_store
+
+    def __repr__(self):
+        if self.root is None:
+            return 'snapshot version {}, released'.format(self.version)
+        return 'snapshot version {}, order: {}, {} keys, {} height'.format(self.version, self.order, self.num_keys,
+                                                                           self.height)
+
+    def __len__(self) -> int:
+        return self.num_keys
+
+    def __enter__(self) -> Snapshot:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+    def __del__(self):
+        self.release()
+
+    def release(self) -> None:
+        """let go of the view.  the tree changes in place again the nodes that no other view holds, and the old
+        nodes that only this view held are freed."""
+        if self.root is not None:
+            self.root = None
+            self.tree.unpin(self.version)
+
+    def get_root(self) -> Node:
+        if self.root is None:
+            raise Exception('snapshot version {} is released'.format(self.version))
+        return self.root
+
+    def descend(self, key: Key) -> Tuple[Node, List[Tuple[Node, int]]]:
+        """same as BPlusTree.descend, within the view"""
+        path = []
+        curr = self.get_root()
+        while curr.pointers:
+            idx = curr.get_index(key)
+            path.append((curr, idx))
+            curr = curr.pointers[idx]
+        else:
+            return curr, path
+
+    def get(self, key: Key, default: Any = None) -> Any:
+        leaf, _ = self.descend(key)
+        idx = leaf.get_key_idx(key)
+        return leaf.payload[idx] if idx is not None else default
+
+    def search(self, target: Key) -> Any:
+        return self.get(target)
+
+    def __contains__(self, key: Key) -> bool:
+        leaf, _ = self.descend(key)
+        return leaf.get_key_idx(key) is not None
+
+    def iter_leaves(self, key: Key = None) -> Iterator[Node]:
+        """from the leaf that may contain the key (first leaf for None) to the last leaf"""
+        curr, path = descend_edge(self.get_root(), 1) if key is None else self.descend(key)
+        yield from walk_leaves(curr, path, 1)
+
+    def iter_leaves_reverse(self, key: Key = None) -> Iterator[Node]:
+        """from the leaf that may contain the key (last leaf for None) back to the first leaf"""
+        curr, path = descend_edge(self.get_root(), -1) if key is None else self.descend(key)
+        yield from walk_leaves(curr, path, -1)
+
+    def iter_range(self, left: Key = None, right: Key = None, inclusive: Tuple[bool, bool] = (True, True),
+                   reverse: bool = False, limit: int = None, offset: int = 0) -> Iterator[Tuple[Key, Any]]:
+        """same as BPlusTree.iter_range, within the view"""
+        if offset > 0:
+            bounds = skip_matches(self.get_root(), self.num_keys, left, right, inclusive, reverse, offset)
+            if bounds is None:
+                return
+            left, right, inclusive = bounds
+            offset = 0
+        if reverse:
+            leaves = self.iter_leaves_reverse(right)
+        else:
+            leaves = self.iter_leaves(left)
+        yield from iter_pairs(leaves, left, right, inclusive, reverse, limit, offset)
+
+    def range_search(self, left: Key, right: Key, reverse: bool = False) -> List[Any]:
+        """values of the keys within [left, right], in descending key order if reverse"""
+        return [value for _, value in self.iter_range(left, right, reverse=reverse)]
+
+    def iter_reverse(self, from_key: Key = None, inclusive: bool = True, limit: int = None) \
+            -> Iterator[Tuple[Key, Any]]:
+        return self.iter_range(None, from_key, (True, inclusive), reverse=True, limit=limit)
+
+    def rank(self, key: Key) -> int:
+        return self.get_root().get_rank(key)
+
+    def select(self, position: int) -> Key:
+        return select_position(self.get_root(), self.num_keys, position)
+
+    def count_range(self, left: Key = None, right: Key = None, inclusive: Tuple[bool, bool] = (True, True)) -> int:
+        return count_between(self.get_root(), self.num_keys, left, right, inclusive)
+
+    def aggregate_range(self, left: Optional[Key], right: Optional[Key], op: str,
+                        inclusive: Tuple[bool, bool] = (True, True)) -> Any:
+        return aggregate_between(self.get_root(), self.aggregates, left, right, op, inclusive)
+
+    def get_num_keys(self) -> int:
+        return self.num_keys
+
+    def get_leaf_keys(self) -> List[Key]:
+        return self.get_root().get_leaf_keys('topdown')
+
+    def get_height(self) -> int:
+        return self.height
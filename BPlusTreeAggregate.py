@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import math
+import operator
+from functools import reduce
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from BPlusTreeNode import Node, Key
+
+
+class Monoid:
+    """an associative combine with its identity, aggregated over the values of a tree, see BPlusTree.aggregate_range.
+    lift takes the value to aggregate out of a payload, the payload itself by default.  fold combines any number of
+    values in one call, e.g. sum, and defaults to a reduce by combine.  combine need not be commutative, values are
+    always combined in key order.
+    """
+    __slots__ = ('identity', 'combine', 'lift', 'fold')
+
+    def __init__(self, identity: Any, combine: Callable[[Any, Any], Any], lift: Callable[[Any], Any] = None,
+                 fold: Callable[[Iterable], Any] = None):
+        self.identity = identity
+        self.combine = combine
+        self.lift = lift
+        self.fold = fold
+
+    def reduce(self, values: Iterable) -> Any:
+        if self.fold is not None:
+            return self.fold(values)
+        return reduce(self.combine, values, self.identity)
+
+    def reduce_payload(self, payload: Iterable) -> Any:
+        return self.reduce(payload if self.lift is None else map(self.lift, payload))
+
+
+# for numeric payloads
+SUM = Monoid(0, operator.add, fold=sum)
+MIN = Monoid(math.inf, min, fold=lambda values: min(values, default=math.inf))
+MAX = Monoid(-math.inf, max, fold=lambda values: max(values, default=-math.inf))
+
+
+def summarize(node: Node, monoids: List[Monoid]) -> Tuple:
+    """the aggregates of all the values under the node, one per monoid.  an internal node folds the aggregates it
+    keeps for its children, a leaf its payload."""
+    if node.pointers:
+        summaries = node.summaries
+        return tuple(monoid.reduce([summary[i] for summary in summaries]) for i, monoid in enumerate(monoids))
+    return tuple(monoid.reduce_payload(node.payload) for monoid in monoids)
+
+
+def aggregate_under(node: Node, left: Optional[Key], right: Optional[Key], inclusive: Tuple[bool, bool],
+                    monoid: Monoid, i: int) -> Any:
+    """the aggregate by the i-th monoid of the values under the node with keys between left and right, None for an
+    open side.  the children between the one routing left and the one routing right are covered by the range, and
+    only their kept aggregates are read, so that a descent visits two partial nodes per level.
+    """
+    if not node.pointers:
+        lo = 0 if left is None else node.get_left_index(left, inclusive[0])
+        if right is None:
+            hi = len(node.keys)
+        else:
+            hi = node.get_index(right) if inclusive[1] else node.get_left_index(right)
+        return monoid.reduce_payload(node.payload[lo:hi])
+    if left is None and right is None:
+        return monoid.reduce([summary[i] for summary in node.summaries])
+
+    lo = 0 if left is None else node.get_index(left)
+    hi = len(node.pointers) - 1 if right is None else node.get_index(right)
+    if lo == hi:
+        return aggregate_under(node.pointers[lo], left, right, inclusive, monoid, i)
+    if lo > hi:
+        return monoid.identity
+    value = aggregate_under(node.pointers[lo], left, None, inclusive, monoid, i)
+    value = monoid.combine(value, monoid.reduce([summary[i] for summary in node.summaries[lo + 1:hi]]))
+    return monoid.combine(value, aggregate_under(node.pointers[hi], None, right, inclusive, monoid, i))
+
+
+def aggregate_between(root: Node, aggregates: Dict[str, Monoid], left: Optional[Key], right: Optional[Key], op: str,
+                      inclusive: Tuple[bool, bool]) -> Any:
+    """the aggregate named op of the values under the root with keys between left and right, see
+    BPlusTree.aggregate_range"""
+    if op not in aggregates:
+        raise Exception('unknown aggregate {}, the tree keeps {}'.format(op, list(aggregates)))
+    return aggregate_under(root, left, right, inclusive, aggregates[op], list(aggregates).index(op))
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+
+class Frame:
+    """a page held in memory by the buffer pool"""
+    __slots__ = ('page_id', 'data', 'pin_count', 'dirty', 'retained')
+
+    def __init__(self, page_id: int, data: bytearray, retained: bool):
+        self.page_id: int = page_id
+        self.data: bytearray = data
+        self.pin_count: int = 0
+        self.dirty: bool = False
+        self.retained: bool = retained
+
+
+class LRUPolicy:
+    """evict the least recently used page"""
+
+    def __init__(self):
+        self.pages: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def add(self, page_id: int) -> None:
+        self.pages[page_id] = None
+
+    def touch(self, page_id: int) -> None:
+        self.pages.move_to_end(page_id)
+
+    def remove(self, page_id: int) -> None:
+        del self.pages[page_id]
+
+    def victim(self, is_evictable: Callable[[int], bool]) -> Optional[int]:
+        for page_id in self.pages:
+            if is_evictable(page_id):
+                return page_id
+        else:
+            return None
+
+
+class ClockPolicy:
+    """second chance: the hand sweeps the pages, clearing reference bits, and evicts the first page without one"""
+
+    def __init__(self):
+        self.ring: List[Optional[int]] = []
+        self.slots: Dict[int, int] = {}  # page id -> position in ring
+        self.referenced: Dict[int, bool] = {}
+        self.free: List[int] = []
+        self.hand: int = 0
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def add(self, page_id: int) -> None:
+        if self.free:
+            slot = self.free.pop()
+            self.ring[slot] = page_id
+        else:
+            slot = len(self.ring)
+            self.ring.append(page_id)
+        self.slots[page_id] = slot
+        self.referenced[page_id] = True
+
+    def touch(self, page_id: int) -> None:
+        self.referenced[page_id] = True
+
+    def remove(self, page_id: int) -> None:
+        slot = self.slots.pop(page_id)
+        del self.referenced[page_id]
+        self.ring[slot] = None
+        self.free.append(slot)
+
+    def victim(self, is_evictable: Callable[[int], bool]) -> Optional[int]:
+        # two full sweeps clear every reference bit, anything still not chosen is pinned
+        for _ in range(2 * len(self.ring)):
+            page_id = self.ring[self.hand]
+            self.hand = (self.hand + 1) % len(self.ring)
+            if page_id is None or not is_evictable(page_id):
+                continue
+            if self.referenced[page_id]:
+                self.referenced[page_id] = False
+            else:
+                return page_id
+        else:
+            return None
+
+
+class BufferPool:
+    """bounded cache of pages between a tree and its storage.
+    storage provides read_page(page_id) -> bytes and write_page(page_id, data).
+
+    a page is pinned while in use and cannot be evicted until unpinned, a page modified in place is marked dirty and
+    written back on eviction or flush.  pages for which retain(data) is true, e.g. internal nodes, are kept in a
+    separate tier that is evicted only when every other page is pinned, so that the upper levels of a tree stay
+    cached and a warm lookup reads at most its leaf.
+    """
+
+    def __init__(self, storage, capacity: int, policy: str = 'lru', retain: Callable[[bytes], bool] = None):
+        if capacity < 1:
+            raise Exception('buffer pool needs at least one frame')
+        if policy == 'lru':
+            policy_class = LRUPolicy
+        elif policy == 'clock':
+            policy_class = ClockPolicy
+        else:
+            raise Exception('unknown eviction policy {}'.format(policy))
+        self.storage = storage
+        self.capacity: int = capacity
+        self.retain = retain
+        self.frames: Dict[int, Frame] = {}
+        self.policies = {False: policy_class(), True: policy_class()}  # by Frame.retained
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.writes: int = 0
+
+    def __repr__(self):
+        return 'buffer pool: {}/{} frames, {} hits, {} misses, {} evictions, {} writes' \
+            .format(len(self.frames), self.capacity, self.hits, self.misses, self.evictions, self.writes)
+
+    def pin(self, page_id: int) -> bytearray:
+        """return the page content, reading it from storage on a miss.  every pin needs a matching unpin."""
+        frame = self.frames.get(page_id)
+        if frame is not None:
+            self.hits += 1
+            self.policies[frame.retained].touch(page_id)
+        else:
+            self.misses += 1
+            if len(self.frames) >= self.capacity:
+                self.evict()
+            data = bytearray(self.storage.read_page(page_id))
+            frame = Frame(page_id, data, bool(self.retain and self.retain(data)))
+            self.frames[page_id] = frame
+            self.policies[frame.retained].add(page_id)
+        frame.pin_count += 1
+        return frame.data
+
+    def unpin(self, page_id: int, dirty: bool = False) -> None:
+        frame = self.frames[page_id]
+        if frame.pin_count == 0:
+            raise Exception('page {} is not pinned'.format(page_id))
+        frame.pin_count -= 1
+        frame.dirty = frame.dirty or dirty
+
+    def mark_dirty(self, page_id: int) -> None:
+        self.frames[page_id].dirty = True
+
+    def is_evictable(self, page_id: int) -> bool:
+        return self.frames[page_id].pin_count == 0
+
+    def evict(self) -> None:
+        """make room for one page: the victim of the ordinary tier first, then of the retained tier"""
+        for retained in [False, True]:
+            page_id = self.policies[retained].victim(self.is_evictable)
+            if page_id is not None:
+                break
+        else:
+            raise Exception('buffer pool exhausted, all {} pages are pinned'.format(self.capacity))
+
+        frame = self.frames.pop(page_id)
+        self.policies[frame.retained].remove(page_id)
+        if frame.dirty:
+            self.write_back(frame)
+        self.evictions += 1
+
+    def write_back(self, frame: Frame) -> None:
+        self.storage.write_page(frame.page_id, bytes(frame.data))
+        frame.dirty = False
+        self.writes += 1
+
+    def flush(self, page_id: int = None) -> None:
+        """write the dirty page back to storage, or every dirty page if no page id is given"""
+        frames = self.frames.values() if page_id is None else [self.frames[page_id]]
+        for frame in frames:
+            if frame.dirty:
+                self.write_back(frame)
+
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'frames': len(self.frames),
+            'retained_frames': len(self.policies[True]),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'writes': self.writes,
+        }
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+from array import array
+from typing import Any, Dict, List, Sequence
+
+from BPlusTree import BPlusTree
+from BPlusTreeAggregate import Monoid
+from BPlusTreeNode import Node, NodeType, get_separator
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, only bulk_load needs it
+    np = None
+
+
+def get_node_dist_array(num: int, lower: int, upper: int, option='dense'):
+    """same distribution as BPlusTree.get_node_dist, computed arithmetically rather than by a loop over the nodes.
+    return the sizes as an array."""
+    if option == 'dense':
+        target = upper
+    elif option == 'sparse':
+        target = lower
+    elif isinstance(option, (int, float)):
+        target = min(upper, max(lower, round(upper * option)))
+    else:
+        raise Exception('unknown option {}'.format(option))
+    if num <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # get_node_dist_fill takes target nodes until less than target + lower remains, then places the tail
+    count = (num - target - lower) // target + 1 if num >= target + lower else 0
+    rest = num - count * target
+    if rest <= upper:
+        sizes = np.full(count + 1, target, dtype=np.int64)
+        sizes[-1] = rest
+    else:
+        sizes = np.full(count + 2, target, dtype=np.int64)
+        sizes[-2:] = [rest - lower, lower]
+    return sizes
+
+
+def get_offsets(sizes):
+    """start offset of every node, followed by the total"""
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return offsets
+
+
+def bulk_load(order: int, keys: Sequence, values: Sequence = None, option='dense',
+              key_store: str = 'list', aggregates: Dict[str, Monoid] = None) -> BPlusTree:
+    """build the same tree as BPlusTree(order, keys=keys) or BPlusTree(order, items=zip(keys, values)), for large
+    loads.  keys are sorted with numpy, node sizes come from get_node_dist_array, every separator is taken from the
+    sorted keys by offset rather than by a descent to the first leaf of each child, and each level is materialized
+    in one pass.  keys are numbers, str or bytes, and must be unique.  values default to the keys themselves.
+    str and bytes keys are kept as the objects given, in an object array, since the fixed width numpy dtypes drop
+    trailing NULs.  aggregates are those of BPlusTree, computed once the levels are built.
+    """
+    if np is None:
+        raise Exception('bulk_load needs numpy')
+    tree = BPlusTree(order, option=option, key_store=key_store, aggregates=aggregates)
+    if not isinstance(keys, np.ndarray):
+        key_array = np.asarray(keys)
+        keys = np.array(keys, dtype=object) if key_array.dtype.kind in 'US' else key_array
+    if values is not None and len(values) != len(keys):
+        raise Exception('{} keys and {} values'.format(len(keys), len(values)))
+    if len(keys) == 0:
+        return tree
+
+    if values is None:
+        keys = np.sort(keys)
+    else:
+        indices = np.argsort(keys, kind='stable')
+        keys = keys[indices]
+        if isinstance(values, np.ndarray):
+            values = values[indices].tolist()
+        else:
+            values = [values[i] for i in indices.tolist()]
+    if np.any(keys[1:] == keys[:-1]):
+        raise Exception('duplicate keys')
+
+    # leaves
+    constraint = tree.constraint[NodeType.LEAF]
+    offsets = get_offsets(get_node_dist_array(len(keys), constraint['min_keys'], constraint['max_keys'], option))
+    key_list: List[Any] = keys.tolist()
+    if key_store == 'array':
+        key_bytes = memoryview(keys.astype(np.int64).tobytes())
+    nodes = []
+    starts = offsets.tolist()
+    for start, end in zip(starts, starts[1:]):
+        if key_store == 'array':
+            leaf_keys = array('q')
+            leaf_keys.frombytes(key_bytes[start * 8:end * 8])
+        elif key_store == 'packed':
+            leaf_keys = tree.new_keys(key_list[start:end])
+        else:
+            leaf_keys = key_list[start:end]
+        payload = key_list[start:end] if values is None else values[start:end]
+        nodes.append(Node(keys=leaf_keys, payload=payload, type=NodeType.LEAF))
+
+    # internal levels, separators[i] goes between nodes[i - 1] and nodes[i], and stays the separator between their
+    # ancestors on the levels above where those are adjacent
+    if keys.dtype.kind in 'biuf':
+        separators = keys[offsets[:-1]]
+    else:  # str and bytes keys are cut to the shortest separator
+        separators = np.array([key_list[0]] + [get_separator(key_list[i - 1], key_list[i]) for i in starts[1:-1]],
+                              dtype=object)
+    constraint = tree.constraint[NodeType.NON_LEAF]
+    while len(nodes) > 1:
+        offsets = get_offsets(get_node_dist_array(len(nodes), constraint['min_pointers'], constraint['max_pointers'],
+                                                  option))
+        separator_list = separators.tolist()
+        tree.link_level(nodes, separator_list[1:])
+        parents = []
+        starts = offsets.tolist()
+        for start, end in zip(starts, starts[1:]):
+            parents.append(Node(keys=separator_list[start + 1:end], pointers=nodes[start:end], type=NodeType.NON_LEAF))
+        nodes = parents
+        separators = separators[offsets[:-1]]
+
+    tree.root = nodes[0]
+    tree.root.type = NodeType.ROOT
+    tree.init_stats()
+    return tree
@@ -0,0 +1,547 @@
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from itertools import islice
+from typing import Any, Callable, Iterator, List, Optional, Sequence, Tuple
+
+from BPlusTree import BPlusTree, Snapshot, _MISSING, skip_matches
+from BPlusTreeNode import Node, NodeType, Key
+
+# concurrency control: every node carries a reader-writer latch, created on first use.
+#
+# writers crab down: the latch of a child is taken before the latch of its parent is let go.  a first pass takes read
+# latches and write latches the leaf only, which is all a change needs when the leaf is safe, i.e. it cannot split
+# (not is_full) on insert, or underflow (is_plenty) on delete.  otherwise a second pass write latches from the root,
+# and lets go of every held ancestor as soon as a child is safe, since the fix of the leaf cannot climb above it.
+# the nodes still held when the leaf is reached are the part of the path that fix_overflow and fix_underflow walk.
+#
+# readers are optimistic and take no latch: a latch counts its write acquisitions in a version, odd while a writer
+# holds it.  a reader notes the version of a node, reads it, and checks the version again, so that what it read is
+# consistent, or reads the node again.  keys that left the node meanwhile by a split went right, and the high key
+# of the node sends the reader along the right link to them (b-link tree), so a split costs a reader a second
+# look at one node rather than a restart.  keys that move left, when the node lends to its left sibling or is
+# merged into it, cannot be followed: a latch also counts these moves, a reader notes the count of a child before
+# it checks the parent it came from, and restarts from the root if the count changes.  a range scan follows the
+# right links, or the prev links if descending, and resumes after the last key it returned.  a reader that keeps
+# getting in the way of writers falls back to an exclusive lookup.
+#
+# the counts of keys under every child, see Node.get_rank, are kept on the path from the root, above the part a
+# writer latches.  a writer adds its key to them by a descent under the stats lock, and internal nodes only change
+# under it as well: fix_overflow runs within it, and fix_underflow takes it once the siblings are latched, so that no
+# thread holds it while it waits for a latch.  positional queries hold the whole tree.
+#
+# operations that restructure many nodes at once, delete_range and bulk_insert, hold the whole tree exclusively,
+# as do full scans that rely on the tree being still.
+#
+# a snapshot is taken while the tree is held.  while one is held, writers copy the path from the root they change,
+# see BPlusTree.own_path, which a writer that latches part of the path cannot do, so they hold the tree as well.
+# readers of a snapshot take no latch at all, the nodes they read do not change.
+
+
+class RWLatch:
+    """reader-writer latch with a version for optimistic readers.  waiting writers go before new readers, so
+    that a stream of readers does not starve them."""
+    __slots__ = ('cond', 'readers', 'writer', 'waiting_writers', 'version', 'shifts', 'dead')
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers: int = 0
+        self.writer: bool = False
+        self.waiting_writers: int = 0
+        self.version: int = 0  # odd while write latched
+        self.shifts: int = 0  # times keys moved out of the node to the left, bumped while write latched
+        self.dead: bool = False  # the node is no longer in the tree
+
+    def acquire_read(self) -> None:
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self) -> None:
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all()
+
+    def acquire_write(self) -> None:
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+            self.version += 1
+
+    def release_write(self) -> None:
+        with self.cond:
+            self.version += 1
+            self.writer = False
+            self.cond.notify_all()
+
+
+class ConcurrentBPlusTree(BPlusTree):
+    """b+ tree that can be shared between threads, see the module comment.
+    insert, upsert, delete and pop latch the nodes they change, get, search, __contains__, range_search and
+    iter_range read optimistically, delete_range, bulk_insert, search_many, rank, select, count_range,
+    aggregate_range and is_valid hold the whole tree, snapshot holds it briefly, and writers hold it while a
+    snapshot is held.  len, get_num_keys and get_num_leaves may be read at any time, and give the counts as of some
+    recent moment.  any other method may run only while no thread changes the tree, or within exclusive().
+    """
+    max_restarts = 32  # optimistic attempts of a reader before it holds the tree
+
+    def __init__(self, order: int, *args, **kwargs):
+        super().__init__(order, *args, **kwargs)
+        if self.wal is not None:
+            raise Exception('a write ahead log is not supported on a concurrent tree')
+        self.tree_latch = RWLatch()  # read latched by every writer, write latched by exclusive
+        self.owner: Optional[int] = None  # the thread within exclusive
+        self.latch_lock = threading.Lock()
+        self.stats_lock = threading.Lock()  # held while the counts are changed, see the module comment
+        self.num_restarts: int = 0
+
+    def get_latch(self, node: Node) -> RWLatch:
+        latch = node.latch
+        if latch is None:
+            with self.latch_lock:
+                if node.latch is None:
+                    node.latch = RWLatch()
+                latch = node.latch
+        return latch
+
+    def is_exclusive(self) -> bool:
+        return self.owner == threading.get_ident()
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        """hold the whole tree, no other thread reads or writes it meanwhile.  within it, the thread may call any
+        method of the tree, which then runs without latches."""
+        if self.is_exclusive():
+            yield
+            return
+        self.tree_latch.acquire_write()
+        self.owner = threading.get_ident()
+        try:
+            yield
+        finally:
+            self.owner = None
+            self.tree_latch.release_write()
+
+    def restart(self) -> None:
+        self.num_restarts += 1
+        time.sleep(0)  # let the writer in the way finish
+
+    # writers
+
+    def descend_shared(self, key: Key) -> Node:
+        """read latch crabbing down to the leaf that may contain the key, return the leaf, write latched"""
+        while True:
+            node = self.root
+            latch = self.get_latch(node)
+            if node.pointers:
+                latch.acquire_read()
+                if node is self.root:
+                    break
+                latch.release_read()
+            else:
+                latch.acquire_write()
+                if node is self.root:
+                    return node
+                latch.release_write()
+
+        while node.pointers:
+            child = node.pointers[node.get_index(key)]
+            child_latch = self.get_latch(child)
+            if child.pointers:
+                child_latch.acquire_read()
+            else:
+                child_latch.acquire_write()
+            latch.release_read()
+            node, latch = child, child_latch
+        else:
+            return node
+
+    def descend_exclusive(self, key: Key, is_safe: Callable[[Node], bool]) \
+            -> Tuple[Node, List[Tuple[Node, int]], List[Node]]:
+        """write latch crabbing down to the leaf that may contain the key.  return the leaf, the path from the
+        highest node still held, and the held nodes.  the ancestors of a safe node are let go.
+        """
+        while True:
+            node = self.root
+            self.get_latch(node).acquire_write()
+            if node is self.root:
+                break
+            self.get_latch(node).release_write()
+
+        held = [node]
+        path = []
+        while node.pointers:
+            idx = node.get_index(key)
+            child = node.pointers[idx]
+            self.get_latch(child).acquire_write()
+            if is_safe(child):
+                self.release(held)
+                held = []
+                path = []
+            else:
+                path.append((node, idx))
+            held.append(child)
+            node = child
+        else:
+            return node, path, held
+
+    def release(self, nodes: List[Node]) -> None:
+        for node in nodes:
+            node.latch.release_write()
+
+    def write(self, key: Key, is_safe: Callable[[Node], bool], apply: Callable[[Node, List[Tuple[Node, int]]], Any]):
+        """run apply(leaf, path) with the leaf that may contain the key and the nodes on path write latched.
+        the leaf alone is latched if it is safe, otherwise path goes up to the highest node the change may reach.
+        """
+        if self.is_exclusive():
+            leaf, path = self.descend(key)
+            if self.pinned >= 0:
+                leaf, path = self.own_path(path)
+            return apply(leaf, path)
+        self.tree_latch.acquire_read()
+        if self.pinned >= 0:  # no snapshot is taken while the tree is read latched
+            self.tree_latch.release_read()
+            with self.exclusive():
+                return self.write(key, is_safe, apply)
+        try:
+            leaf = self.descend_shared(key)
+            if is_safe(leaf):
+                path, held = [], [leaf]
+            else:
+                self.release([leaf])
+                leaf, path, held = self.descend_exclusive(key, is_safe)
+            try:
+                return apply(leaf, path)
+            finally:
+                self.release(held)
+        finally:
+            self.tree_latch.release_read()
+
+    def insert(self, key: Key, value: Any = _MISSING):
+        if value is _MISSING:
+            value = key
+
+        def apply(leaf: Node, path: List[Tuple[Node, int]]) -> None:
+            if leaf.get_key_idx(key) is not None:
+                raise KeyError('key {} already exists.'.format(key))
+            leaf.insert_key(key, value)
+            with self.stats_lock:
+                self.count_key(key, 1)
+                self.fix_overflow(leaf, path)
+
+        self.write(key, lambda node: not node.is_full(self.constraint), apply)
+
+    def upsert(self, key: Key, value: Any) -> None:
+        def apply(leaf: Node, path: List[Tuple[Node, int]]) -> None:
+            idx = leaf.get_key_idx(key)
+            if idx is not None:
+                leaf.payload[idx] = value
+                if self.aggregates:
+                    with self.stats_lock:
+                        self.count_key(key, 0)
+            else:
+                leaf.insert_key(key, value)
+                with self.stats_lock:
+                    self.count_key(key, 1)
+                    self.fix_overflow(leaf, path)
+
+        self.write(key, lambda node: not node.is_full(self.constraint), apply)
+
+    def count_key(self, key: Key, delta: int) -> None:
+        """add delta keys to the leaf that holds the key, which the writer has latched, along the whole path from the
+        root rather than the part the writer latched, and compute the aggregates on the path again.  called with the
+        stats lock held."""
+        path = self.descend(key)[1]
+        self.count_keys(path, delta)
+        if self.aggregates:
+            self.summarize_path(path)
+
+    def delete(self, key: Key) -> None:
+        if self.remove(key) is _MISSING:
+            if Node.tracer:
+                Node.tracer('key {} does not exist.', key)
+
+    def pop(self, key: Key, default: Any = _MISSING) -> Any:
+        value = self.remove(key)
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        return value
+
+    def remove(self, key: Key) -> Any:
+        """delete the key, return its value or _MISSING if it does not exist"""
+
+        def apply(leaf: Node, path: List[Tuple[Node, int]]) -> Any:
+            idx = leaf.get_key_idx(key)
+            if idx is None:
+                return _MISSING
+            value = leaf.payload[idx]
+            if Node.tracer:
+                Node.tracer('DELETING KEY: {}', key)
+            leaf.delete_key(key)
+            with self.stats_lock:
+                self.count_key(key, -1)
+            self.fix_underflow(path)
+            top = path[0][0] if path else leaf
+            if top is self.root and top.is_singular():  # held, so no other writer replaces it meanwhile
+                if Node.tracer:
+                    Node.tracer('SINGULAR ROOT, ELEVATE CHILD. ')
+                    Node.tracer('OLD ROOT: \n{}\n', top)
+                new_root = top.pointers[0]
+                new_root.type = NodeType.ROOT
+                self.root = new_root
+                self.height -= 1
+                self.get_latch(top).dead = True
+                if Node.tracer:
+                    Node.tracer('NEW ROOT: \n{}\n', new_root)
+            return value
+
+        return self.write(key, lambda node: node.is_plenty(self.constraint), apply)
+
+    def fix_underflow(self, path: List[Tuple[Node, int]]) -> None:
+        """same as BPlusTree.fix_underflow, with the siblings of the underflow child write latched while they
+        may give it keys or be merged with it.  a node merged away is marked dead for the optimistic readers.
+        within exclusive(), the path starts at the root and no latch is needed.
+        """
+        if self.is_exclusive():
+            super().fix_underflow(path)
+            return
+        for parent, idx in reversed(path):
+            if not parent.pointers[idx].is_underflow(self.constraint):
+                return
+            lo = max(idx - 1, 0)
+            siblings = [parent.pointers[i] for i in range(lo, min(idx + 2, parent.get_pointer_size())) if i != idx]
+            for sibling in siblings:  # left to right, as every writer latches the children of a node
+                self.get_latch(sibling).acquire_write()
+            # the child and its right sibling may lose keys to their left, readers on the way to them restart
+            self.get_latch(parent.pointers[idx]).shifts += 1
+            if idx + 1 < parent.get_pointer_size():
+                self.get_latch(parent.pointers[idx + 1]).shifts += 1
+            try:
+                nodes = parent.pointers[lo:idx + 2]
+                with self.stats_lock:
+                    super().fix_underflow([(parent, idx)])
+                remaining = parent.pointers[lo:idx + 2]
+                for node in nodes:
+                    if not any(node is other for other in remaining):
+                        self.get_latch(node).dead = True
+            finally:
+                self.release(siblings)
+
+    # optimistic readers
+
+    def descend_optimistic(self, key: Key, last: bool = False) -> Optional[Tuple[Node, RWLatch, int]]:
+        """walk down to the leaf that covers the key without latching, return the leaf, its latch and the version it
+        was reached at, for the caller to validate once it has read the leaf.  a node whose high key the key is at or
+        beyond has split since its pointer was read, the walk moves right on the same level.  a node that changes
+        while it is read is read again.  return None if keys moved left on the way, or a writer stays in the way.
+        a key of None walks to the first leaf, or to the last one if last.
+        """
+        node = self.root
+        latch = self.get_latch(node)
+        shifts = latch.shifts
+        for _ in range(self.max_restarts):
+            version = latch.version
+            if latch.dead or latch.shifts != shifts:
+                return None
+            if version & 1:
+                time.sleep(0)
+                continue
+            high_key = node.high_key
+            if high_key is not None and (last if key is None else key >= high_key):
+                next_node = node.sequence_pointer
+            elif node.pointers:
+                next_node = node.pointers[(-1 if last else 0) if key is None else node.get_index(key)]
+            else:
+                return node, latch, version
+            next_latch = self.get_latch(next_node)
+            next_shifts = next_latch.shifts  # noted before the node is validated, see the module comment
+            if latch.version == version:
+                node, latch, shifts = next_node, next_latch, next_shifts
+        else:
+            return None
+
+    def get(self, key: Key, default: Any = None) -> Any:
+        if self.is_exclusive():
+            return super().get(key, default)
+        for _ in range(self.max_restarts):
+            tree_version = self.tree_latch.version
+            if not tree_version & 1:
+                try:
+                    found = self.descend_optimistic(key)
+                    if found:
+                        leaf, latch, version = found
+                        idx = leaf.get_key_idx(key)
+                        value = leaf.payload[idx] if idx is not None else default
+                        if latch.version == version and self.tree_latch.version == tree_version:
+                            return value
+                except IndexError:  # read a node halfway through a change
+                    pass
+            self.restart()
+
+        with self.exclusive():
+            return super().get(key, default)
+
+    def __contains__(self, key: Key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def range_search(self, left, right, reverse: bool = False) -> List[Any]:
+        """values of the keys within [left, right], as in BPlusTree.range_search.  leaves are read one at a time,
+        each one validated before its values are taken, so the result is consistent per leaf rather than a snapshot
+        of the whole range, see scan."""
+        if self.is_exclusive():
+            return super().range_search(left, right, reverse)
+        ret = []
+        for _, values in self.scan(left, right, (True, True), reverse):
+            ret.extend(reversed(values) if reverse else values)
+        return ret
+
+    def scan(self, left: Key, right: Key, inclusive: Tuple[bool, bool], reverse: bool) \
+            -> Iterator[Tuple[Sequence[Key], List[Any]]]:
+        """lazily yield the keys and values of iter_range(left, right, inclusive, reverse) a leaf at a time, in
+        ascending order within each leaf.  a leaf is validated before its pairs are yielded, then the walk goes on
+        to the next leaf, or to the previous one if reverse.  keys that a leaf loses to a split after it is read went
+        right: an ascending scan took them from it already, and a descending scan finds the previous leaf no longer
+        linked to the one it left, and goes back to the root.  a writer in the way sends the scan back to the root,
+        to resume after the last key it yielded, and after max_restarts attempts in a row that read nothing, the
+        next leaf's worth of pairs is read while the tree is held.
+        """
+        failures = 0
+        while True:
+            if failures == self.max_restarts:
+                with self.exclusive():
+                    pairs = list(islice(super().iter_range(left, right, inclusive, reverse), self.order))
+                if reverse:
+                    pairs.reverse()
+                if pairs:
+                    yield [key for key, _ in pairs], [value for _, value in pairs]
+                if len(pairs) < self.order:
+                    return
+                if reverse:
+                    right, inclusive = pairs[0][0], (inclusive[0], False)
+                else:
+                    left, inclusive = pairs[-1][0], (False, inclusive[1])
+                failures = 0
+                continue
+
+            tree_version = self.tree_latch.version
+            try:
+                found = None if tree_version & 1 else self.descend_optimistic(right if reverse else left, reverse)
+                while found:
+                    leaf, latch, version = found
+                    keys, values, done = read_leaf(leaf, left, right, inclusive, reverse)
+                    if reverse:
+                        next_leaf = leaf.prev_pointer
+                    else:
+                        next_leaf = leaf.sequence_pointer
+                    if next_leaf is not None:
+                        next_latch = self.get_latch(next_leaf)
+                        next_shifts = next_latch.shifts
+                        next_version = next_latch.version  # a descending scan needs the leaf unchanged from here
+                    if latch.version != version or self.tree_latch.version != tree_version:
+                        break
+                    if len(keys):
+                        failures = 0
+                        yield keys, values
+                        if reverse:
+                            right, inclusive = keys[0], (inclusive[0], False)
+                        else:
+                            left, inclusive = keys[-1], (False, inclusive[1])
+                    if done or next_leaf is None:
+                        return
+                    if reverse:
+                        if next_version & 1 or next_latch.dead or next_leaf.sequence_pointer is not leaf:
+                            break
+                    else:
+                        next_version = next_latch.version
+                        if next_version & 1 or next_latch.dead or next_latch.shifts != next_shifts:
+                            break
+                    found = next_leaf, next_latch, next_version
+            except IndexError:  # read a node halfway through a change
+                pass
+            failures += 1
+            self.restart()
+
+    # whole tree operations
+
+    def snapshot(self) -> Snapshot:
+        with self.exclusive():
+            return super().snapshot()
+
+    def bulk_insert(self, sorted_items: List[Tuple[Key, Any]], fill_factor: float = 1.0) -> None:
+        with self.exclusive():
+            super().bulk_insert(sorted_items, fill_factor)
+
+    def delete_range(self, left: Key, right: Key) -> int:
+        with self.exclusive():
+            return super().delete_range(left, right)
+
+    def search_many(self, keys: List[Key], presorted: bool = False, default: Any = None) -> List[Any]:
+        with self.exclusive():
+            return super().search_many(keys, presorted, default)
+
+    def rank(self, key: Key) -> int:
+        with self.exclusive():
+            return super().rank(key)
+
+    def select(self, position: int) -> Key:
+        with self.exclusive():
+            return super().select(position)
+
+    def count_range(self, left: Key = None, right: Key = None, inclusive: Tuple[bool, bool] = (True, True)) -> int:
+        with self.exclusive():
+            return super().count_range(left, right, inclusive)
+
+    def aggregate_range(self, left: Optional[Key], right: Optional[Key], op: str,
+                        inclusive: Tuple[bool, bool] = (True, True)) -> Any:
+        with self.exclusive():
+            return super().aggregate_range(left, right, op, inclusive)
+
+    def iter_range(self, left: Key = None, right: Key = None, inclusive: Tuple[bool, bool] = (True, True),
+                   reverse: bool = False, limit: int = None, offset: int = 0) -> Iterator[Tuple[Key, Any]]:
+        """the pairs of BPlusTree.iter_range, read optimistically a leaf at a time as they are consumed, see scan, so
+        they are consistent per leaf rather than a snapshot of the whole range.  the matches that offset skips are
+        counted out by rank while the tree is held briefly."""
+        if self.is_exclusive():
+            yield from super().iter_range(left, right, inclusive, reverse, limit, offset)
+            return
+        if limit is not None and limit <= 0:
+            return
+        if offset > 0:
+            with self.exclusive():
+                bounds = skip_matches(self.root, self.num_keys, left, right, inclusive, reverse, offset)
+            if bounds is None:
+                return
+            left, right, inclusive = bounds
+        count = 0
+        for keys, values in self.scan(left, right, inclusive, reverse):
+            for pair in zip(reversed(keys), reversed(values)) if reverse else zip(keys, values):
+                yield pair
+                count += 1
+                if count == limit:
+                    return
+
+    def is_valid(self) -> bool:
+        with self.exclusive():
+            return super().is_valid()
+
+
+def read_leaf(leaf: Node, left: Key, right: Key, inclusive: Tuple[bool, bool], reverse: bool) \
+        -> Tuple[Sequence[Key], List[Any], bool]:
+    """the keys and values of the leaf between left and right, with the bounds of iter_range, and whether the bound
+    a scan in that direction stops at lies within the leaf"""
+    keys = leaf.keys
+    lo = 0 if left is None else leaf.get_left_index(left, inclusive[0])
+    if right is None:
+        hi = len(keys)
+    else:
+        hi = leaf.get_index(right) if inclusive[1] else leaf.get_left_index(right)
+    return keys[lo:hi], leaf.payload[lo:hi], (lo > 0) if reverse else (hi < len(keys))
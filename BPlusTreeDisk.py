@@ -0,0 +1,331 @@
+from __future__ import annotations
+
+import mmap
+import os
+import pickle
+import struct
+from bisect import bisect_right
+from typing import Any, Iterator, List, Optional, Tuple
+
+from BPlusTree import BPlusTree
+from BPlusTreeBuffer import BufferPool
+from BPlusTreeNode import Node
+
+# disk format: a single file of fixed size pages, one page per node, followed by a heap of payloads.
+#
+# page 0 is the file header.  node pages are numbered from 1 in breadth first order, so the root is page 1 and
+# the leaves come last, from left to right.
+#
+# node page: page header, then room for order keys, then room for order + 1 references.
+#     leaf page: references are offsets of the payloads within the heap, next is the page id of the next leaf.
+#     internal page: references are child page ids.
+# payload: 4 byte length, then the pickled value.
+#
+# keys are stored as 64-bit integers.
+
+MAGIC = b'BPTREE01'
+# magic, page size, order, root page id, height, first leaf page id, number of keys, heap offset
+FILE_HEADER = struct.Struct('<8sIIqqqqq')
+# leaf flag, number of keys, next leaf page id or NO_PAGE
+PAGE_HEADER = struct.Struct('<BxxxIq')
+PAYLOAD_HEADER = struct.Struct('<I')
+NO_PAGE = -1
+
+
+def get_page_size(order: int) -> int:
+    return max(FILE_HEADER.size, PAGE_HEADER.size + order * 8 + (order + 1) * 8)
+
+
+def dump(tree: BPlusTree, path: str) -> None:
+    """write the tree to path in the disk format, see DiskBPlusTree for reading it back."""
+    page_size = get_page_size(tree.order)
+    nodes: List[Node] = []
+    level = [tree.root]
+    while level:  # breadth first, so that children of a node and leaves are on consecutive pages
+        nodes.extend(level)
+        level = [child for node in level for child in node.pointers]
+    page_ids = {id(node): page_id for page_id, node in enumerate(nodes, 1)}
+    heap_offset = page_size * (len(nodes) + 1)
+
+    with open(path, 'wb') as f:
+        heap_size = 0
+        for page_id, node in enumerate(nodes, 1):
+            page = bytearray(page_size)
+            if node.is_leaf():
+                next_id = page_ids[id(node.sequence_pointer)] if node.sequence_pointer else NO_PAGE
+                refs = []
+                f.seek(heap_offset + heap_size)
+                for value in node.payload:
+                    data = pickle.dumps(value)
+                    f.write(PAYLOAD_HEADER.pack(len(data)))
+                    f.write(data)
+                    refs.append(heap_size)
+                    heap_size += PAYLOAD_HEADER.size + len(data)
+            else:
+                next_id = NO_PAGE
+                refs = [page_ids[id(child)] for child in node.pointers]
+
+            keys = node.keys
+            if not all(type(key) is int for key in keys):
+                raise Exception('disk pages store 64-bit integer keys only')
+            PAGE_HEADER.pack_into(page, 0, node.is_leaf(), len(keys), next_id)
+            struct.pack_into('<{}q'.format(len(keys)), page, PAGE_HEADER.size, *keys)
+            struct.pack_into('<{}q'.format(len(refs)), page, PAGE_HEADER.size + tree.order * 8, *refs)
+            f.seek(page_size * page_id)
+            f.write(page)
+
+        first_leaf = page_ids[id(tree.get_first_leaf())]
+        header = FILE_HEADER.pack(MAGIC, page_size, tree.order, 1, tree.get_height(), first_leaf,
+                                  tree.get_num_keys(), heap_offset)
+        f.seek(0)
+        f.write(header)
+
+
+def is_internal_page(page: bytes) -> bool:
+    return not page[0]
+
+
+class PageFile:
+    """page storage for BufferPool, reading and writing whole pages of a file with pread / pwrite"""
+
+    def __init__(self, fd: int, page_size: int):
+        self.fd = fd
+        self.page_size = page_size
+
+    def read_page(self, page_id: int) -> bytes:
+        return os.pread(self.fd, self.page_size, self.page_size * page_id)
+
+    def write_page(self, page_id: int, data: bytes) -> None:
+        os.pwrite(self.fd, data, self.page_size * page_id)
+
+
+class DiskBPlusTree:
+    """b+ tree served from a file written by dump.
+    a lookup reads only the pages on its root to leaf path, and keys are binary searched within the page, so opening
+    a tree costs the same whatever its size.
+
+    by default the file is memory mapped read only and paging is left to the os.  with pool_size, pages are read
+    through a BufferPool of that many pages instead, evicted by policy ('lru' or 'clock') with internal pages
+    retained over leaves, and with writable the values can be replaced in place via update.
+    """
+
+    def __init__(self, path: str, pool_size: int = None, policy: str = 'lru', writable: bool = False):
+        self.path = path
+        self.pool: Optional[BufferPool] = None
+        if pool_size is None:
+            if writable:
+                raise Exception('a writable disk tree needs a buffer pool')
+            self.file = open(path, 'rb')
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mm)
+            header = self.mm[:FILE_HEADER.size]
+        else:
+            self.file = open(path, 'r+b' if writable else 'rb')
+            header = os.pread(self.file.fileno(), FILE_HEADER.size, 0)
+        self.writable = writable
+        magic, self.page_size, self.order, self.root_id, self.height, self.first_leaf_id, self.num_keys, \
+            self.heap_offset = FILE_HEADER.unpack_from(header, 0)
+        if magic != MAGIC:
+            self.close()
+            raise Exception('{} is not a b+ tree file'.format(path))
+        if pool_size is not None:
+            self.pool = BufferPool(PageFile(self.file.fileno(), self.page_size), pool_size, policy,
+                                   retain=is_internal_page)
+            self.heap_size = os.fstat(self.file.fileno()).st_size - self.heap_offset
+
+    def __repr__(self):
+        return 'disk tree {}, order: {}, {} keys, {} height'.format(self.path, self.order, self.num_keys, self.height)
+
+    def __len__(self) -> int:
+        return self.num_keys
+
+    def __enter__(self) -> DiskBPlusTree:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """iterators from iter_range should be exhausted or dropped first, since they hold views on the map"""
+        if self.pool is not None:
+            self.flush()
+        else:
+            self.view.release()
+            self.mm.close()
+        self.file.close()
+
+    def flush(self) -> None:
+        """write the dirty pages in the buffer pool back to the file"""
+        if self.pool is not None:
+            self.pool.flush()
+            if self.writable:
+                os.fsync(self.file.fileno())
+
+    def read_page(self, page_id: int) -> Tuple[bool, memoryview, memoryview, int]:
+        """return whether the page is a leaf, its keys, its references and the next leaf page id.
+        keys and references are views on the map or on the pool frame, nothing is copied.
+        """
+        if self.pool is None:
+            view, offset = self.view, self.page_size * page_id
+        else:
+            # the views keep the frame content alive after it is unpinned, even if the pool evicts it
+            view, offset = memoryview(self.pool.pin(page_id)), 0
+            self.pool.unpin(page_id)
+        is_leaf, num_keys, next_id = PAGE_HEADER.unpack_from(view, offset)
+        start = offset + PAGE_HEADER.size
+        keys = view[start:start + num_keys * 8].cast('q')
+        start = offset + PAGE_HEADER.size + self.order * 8
+        num_refs = num_keys if is_leaf else num_keys + 1
+        refs = view[start:start + num_refs * 8].cast('q')
+        return bool(is_leaf), keys, refs, next_id
+
+    def read_payload(self, ref: int) -> Any:
+        start = self.heap_offset + ref
+        if self.pool is None:
+            length, = PAYLOAD_HEADER.unpack_from(self.mm, start)
+            start += PAYLOAD_HEADER.size
+            return pickle.loads(self.mm[start:start + length])
+        else:
+            length, = PAYLOAD_HEADER.unpack(os.pread(self.file.fileno(), PAYLOAD_HEADER.size, start))
+            return pickle.loads(os.pread(self.file.fileno(), length, start + PAYLOAD_HEADER.size))
+
+    def update(self, key: int, value: Any) -> None:
+        """replace the value of an existing key.  the value is appended to the heap and the leaf page is changed in
+        the pool and marked dirty, it reaches the file on eviction, flush or close.
+        """
+        if not self.writable:
+            raise Exception('disk tree is read only')
+        leaf_id, _ = self.descend(key)
+        page = self.pool.pin(leaf_id)
+        dirty = False
+        try:
+            _, num_keys, _ = PAGE_HEADER.unpack_from(page, 0)
+            keys = memoryview(page)[PAGE_HEADER.size:PAGE_HEADER.size + num_keys * 8].cast('q')
+            idx = bisect_right(keys, key)
+            if idx == 0 or keys[idx - 1] != key:
+                raise KeyError(key)
+
+            data = pickle.dumps(value)
+            os.pwrite(self.file.fileno(), PAYLOAD_HEADER.pack(len(data)) + data, self.heap_offset + self.heap_size)
+            struct.pack_into('<q', page, PAGE_HEADER.size + self.order * 8 + (idx - 1) * 8, self.heap_size)
+            self.heap_size += PAYLOAD_HEADER.size + len(data)
+            dirty = True
+        finally:
+            self.pool.unpin(leaf_id, dirty=dirty)
+
+    def descend(self, key: int) -> Tuple[int, List[Tuple[int, int]]]:
+        """same as BPlusTree.descend, on page ids.  return the leaf page id and the (page id, child index) path"""
+        path = []
+        page_id = self.root_id
+        while True:
+            is_leaf, keys, refs, _ = self.read_page(page_id)
+            if is_leaf:
+                return page_id, path
+            idx = bisect_right(keys, key)
+            path.append((page_id, idx))
+            page_id = refs[idx]
+
+    def get(self, key: int, default: Any = None) -> Any:
+        leaf_id, _ = self.descend(key)
+        _, keys, refs, _ = self.read_page(leaf_id)
+        idx = bisect_right(keys, key)
+        if idx > 0 and keys[idx - 1] == key:
+            return self.read_payload(refs[idx - 1])
+        else:
+            return default
+
+    def search(self, target: int) -> Optional[Any]:
+        return self.get(target)
+
+    def __contains__(self, key: int) -> bool:
+        leaf_id, _ = self.descend(key)
+        _, keys, _, _ = self.read_page(leaf_id)
+        idx = bisect_right(keys, key)
+        return idx > 0 and keys[idx - 1] == key
+
+    def range_search(self, left: int, right: int) -> List[Any]:
+        return [value for _, value in self.iter_range(left, right)]
+
+    def iter_range(self, left: int = None, right: int = None, inclusive: Tuple[bool, bool] = (True, True),
+                   reverse: bool = False, limit: int = None, offset: int = 0) -> Iterator[Tuple[int, Any]]:
+        """same as BPlusTree.iter_range, reading the leaf pages from the map as the scan reaches them"""
+        if limit is not None and limit <= 0:
+            return
+        if reverse:
+            leaves = self.iter_leaves_reverse(right)
+        else:
+            leaves = self.iter_leaves(left)
+
+        skip = offset
+        count = 0
+        for leaf_id in leaves:
+            _, keys, refs, _ = self.read_page(leaf_id)
+            if left is None:
+                lo = 0
+            else:
+                lo = bisect_right(keys, left)
+                if inclusive[0] and lo > 0 and keys[lo - 1] == left:
+                    lo -= 1
+            if right is None:
+                hi = len(keys)
+            else:
+                hi = bisect_right(keys, right)
+                if not inclusive[1] and hi > 0 and keys[hi - 1] == right:
+                    hi -= 1
+
+            if skip >= hi - lo:
+                skip -= max(0, hi - lo)
+            else:
+                if reverse:
+                    positions = range(hi - 1 - skip, lo - 1, -1)
+                else:
+                    positions = range(lo + skip, hi)
+                skip = 0
+                for i in positions:
+                    yield keys[i], self.read_payload(refs[i])
+                    count += 1
+                    if count == limit:
+                        return
+
+            if (lo > 0) if reverse else (hi < len(keys)):
+                return
+
+    def iter_leaves(self, key: int = None) -> Iterator[int]:
+        page_id = self.first_leaf_id if key is None else self.descend(key)[0]
+        while page_id != NO_PAGE:
+            yield page_id
+            page_id = self.read_page(page_id)[3]
+
+    def iter_leaves_reverse(self, key: int = None) -> Iterator[int]:
+        """same as BPlusTree.iter_leaves_reverse, stepping back along the path of page ids"""
+        if key is None:
+            path = []
+            page_id = self.root_id
+            is_leaf, _, refs, _ = self.read_page(page_id)
+            while not is_leaf:
+                path.append((page_id, len(refs) - 1))
+                page_id = refs[-1]
+                is_leaf, _, refs, _ = self.read_page(page_id)
+        else:
+            page_id, path = self.descend(key)
+
+        while True:
+            yield page_id
+            while path and path[-1][1] == 0:
+                path.pop()
+            if not path:
+                return
+            parent_id, idx = path.pop()
+            path.append((parent_id, idx - 1))
+            page_id = self.read_page(parent_id)[2][idx - 1]
+            is_leaf, _, refs, _ = self.read_page(page_id)
+            while not is_leaf:
+                path.append((page_id, len(refs) - 1))
+                page_id = refs[-1]
+                is_leaf, _, refs, _ = self.read_page(page_id)
+
+    def get_height(self) -> int:
+        return self.height
+
+    def get_num_keys(self) -> int:
+        return self.num_keys
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Iterator, List, Optional, Tuple
+
+import BPlusTreeSnapshot
+from BPlusTree import BPlusTree
+
+# write ahead log: an append only file of records, one record per change to the tree, written before the change is
+# applied.  the log is logical, a record names a BPlusTree method and its arguments, so replaying it into an empty
+# tree runs the same splits, merges and redistributions and rebuilds a consistent tree whatever state the crashed
+# tree was left in.
+#
+# record: 4 byte length, 4 byte crc32 of the body, then the body, the pickled (method name, arguments).
+# a torn or corrupt record at the end of the log is a write interrupted by the crash, replay stops there.
+#
+# a checkpoint writes a snapshot of the tree and empties the log.  it first commits a checkpoint record with a new
+# id, and the snapshot carries the same id, so that a crash between installing the snapshot and emptying the log
+# leaves a log whose records up to that checkpoint record the snapshot covers already, and replay skips them.  a
+# crash before the snapshot is installed leaves the old snapshot, which covers the log up to its own checkpoint
+# record if any, so the records of the new checkpoint on are replayed.
+
+RECORD_HEADER = struct.Struct('<II')
+OPERATIONS = ('insert', 'upsert', 'delete', 'bulk_insert', 'delete_range')
+
+
+class WriteAheadLog:
+    """append only log with group commit.
+    appended records are buffered and written with a single write and fsync once group_size records are pending,
+    or once the oldest pending record is older than group_interval seconds, or on commit.  a timer commits a group
+    that reaches group_interval with no append to follow it.  a change is durable only after its group is
+    committed, so a crash loses at most the last uncommitted group, never part of one.
+    """
+
+    def __init__(self, path: str, group_size: int = 64, group_interval: float = None):
+        self.path = path
+        self.group_size: int = group_size
+        self.group_interval = group_interval
+        self.file = open(path, 'ab')
+        self.pending: List[bytes] = []
+        self.pending_since: float = 0.0
+        self.num_commits: int = 0
+        self.lock = threading.Lock()  # held by the timer and the thread that appends while they change the group
+        self.timer: Optional[threading.Timer] = None
+
+    def __repr__(self):
+        return 'write ahead log {}, {} pending, {} commits'.format(self.path, len(self.pending), self.num_commits)
+
+    def __enter__(self) -> WriteAheadLog:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def append(self, op: str, *args) -> None:
+        body = pickle.dumps((op, args))
+        with self.lock:
+            if not self.pending:
+                self.pending_since = time.monotonic()
+                if self.group_interval is not None:
+                    self.timer = threading.Timer(self.group_interval, self.commit)
+                    self.timer.daemon = True
+                    self.timer.start()
+            self.pending.append(RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body)
+            if len(self.pending) >= self.group_size or \
+                    (self.group_interval is not None and time.monotonic() - self.pending_since >= self.group_interval):
+                self.write_pending()
+
+    def commit(self) -> None:
+        """write the pending records and fsync, the changes they log are durable once this returns"""
+        with self.lock:
+            self.write_pending()
+
+    def write_pending(self) -> None:
+        """commit with the lock held"""
+        self.cancel_timer()
+        if not self.pending:
+            return
+        self.file.write(b''.join(self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = []
+        self.num_commits += 1
+
+    def cancel_timer(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def discard(self) -> None:
+        """drop the pending records, as a crash would"""
+        with self.lock:
+            self.cancel_timer()
+            self.pending = []
+
+    def truncate(self) -> None:
+        """empty the log, once the tree it describes is persisted elsewhere"""
+        with self.lock:
+            self.cancel_timer()
+            self.pending = []
+            self.file.truncate(0)
+            os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        with self.lock:
+            self.write_pending()
+            self.file.close()
+
+
+def read_log(path: str) -> Iterator[Tuple[str, Tuple[Any, ...], int]]:
+    """yield the (method name, arguments, end offset) records of the log, up to the first torn or corrupt one"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, crc = RECORD_HEADER.unpack(header)
+            body = f.read(length)
+            if len(body) < length or zlib.crc32(body) != crc:
+                return
+            op, args = pickle.loads(body)
+            yield op, args, f.tell()
+
+
+def replay(path: str, tree: BPlusTree, checkpoint: int = 0) -> int:
+    """apply the records of the log to the tree, return the length of the valid part of the log.  the records up to
+    the checkpoint record with the given id, which the snapshot the tree was loaded from covers, are skipped.
+    the log of the tree, if any, is detached meanwhile, so the records are not logged again.
+    """
+    start = 0
+    if checkpoint:
+        for op, args, end in read_log(path):
+            if op == 'checkpoint' and args == (checkpoint,):
+                start = end
+    wal, tree.wal = tree.wal, None
+    length = 0
+    try:
+        for op, args, length in read_log(path):
+            if length <= start or op == 'checkpoint':
+                continue
+            if op not in OPERATIONS:
+                raise Exception('unknown operation {} in log {}'.format(op, path))
+            getattr(tree, op)(*args)
+    finally:
+        tree.wal = wal
+    return length
+
+
+def checkpoint(tree: BPlusTree, snapshot_path: str) -> None:
+    """write a snapshot of the tree, then empty its log, which the snapshot now covers.
+    the snapshot is written aside and renamed into place, so a crash leaves either the old or the new one, and the
+    log tells which of its records each one covers, see the module comment.
+    """
+    checkpoint_id = time.time_ns()
+    tree.wal.append('checkpoint', checkpoint_id)
+    tree.wal.commit()
+    with open(snapshot_path + '.tmp', 'wb') as f:
+        BPlusTreeSnapshot.dump(tree, f, checkpoint_id)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(snapshot_path + '.tmp', snapshot_path)
+    tree.wal.truncate()
+
+
+def recover(path: str, order: int, group_size: int = 64, group_interval: float = None, snapshot: str = None,
+            **kwargs) -> BPlusTree:
+    """rebuild the tree from its log after a crash, and keep logging to it.
+    the log is replayed on top of the snapshot written by the last checkpoint if given, otherwise the tree must
+    have started out empty.  kwargs are passed to BPlusTree, e.g. key_store.  the order, option and key store of
+    the snapshot must be those the arguments give, so that the tree is the same with or without it.
+    """
+    tree = BPlusTree(order, **kwargs)
+    checkpoint_id = 0
+    if snapshot is not None and os.path.exists(snapshot):
+        with open(snapshot, 'rb') as f:
+            order, _, key_store, option, _, _, checkpoint_id = BPlusTreeSnapshot.read_header(f)
+            if (order, option, key_store) != (tree.order, tree.option, tree.key_store):
+                raise Exception('snapshot {} has order {}, option {}, key store {}, expected {}, {}, {}'.format(
+                    snapshot, order, option, key_store, tree.order, tree.option, tree.key_store))
+            f.seek(0)
+            tree = BPlusTreeSnapshot.load(f, kwargs.get('aggregates'))
+    if os.path.exists(path):
+        length = replay(path, tree, checkpoint_id)
+        if length < os.path.getsize(path):  # cut the torn tail, or new records would follow it unreadable
+            os.truncate(path, length)
+    tree.wal = WriteAheadLog(path, group_size, group_interval)
+    return tree
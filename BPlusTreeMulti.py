@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import operator
+from array import array
+from bisect import bisect_left
+from itertools import groupby
+from typing import Any, Dict, Iterator, List, Tuple
+
+from BPlusTree import BPlusTree
+from BPlusTreeAggregate import Monoid
+from BPlusTreeNode import Node, Key
+
+# multimap: a key maps to any number of row ids, e.g. a secondary index over a column with repeated values.
+#
+# the tree itself keeps its keys unique, each key takes one leaf slot whatever its number of row ids, and its value
+# is a posting list, the sorted row ids of the key in an array('q') (8 bytes per row id, no object per row id).
+# inserting a pair adds to the posting list of its key, or inserts the key with a new list, and deleting the last
+# row id of a key deletes the key, so search, rank, select, count_range and the splits and merges are those of
+# BPlusTree, over the distinct keys.
+#
+# posting lists change in place.  while a snapshot is held, a change copies the posting list it touches first, as it
+# copies the nodes on its path, since the copy of a leaf shares its posting lists with the original, see own_path.
+
+# number of row ids under each child, for aggregates={'postings': POSTINGS}
+POSTINGS = Monoid(0, operator.add, lift=len, fold=sum)
+
+
+class MultiBPlusTree(BPlusTree):
+    """b+ tree that maps a key to a posting list of row ids, see the module comment.
+    insert and delete take (key, rowid) pairs, get returns the posting list of a key, which the caller must not
+    change, and iter_postings and range_search stream the row ids of a range of keys.  len, rank, select and
+    count_range count distinct keys.
+    items are (key, rowid) pairs in any order, a repeated pair is kept once.
+    a write ahead log is not supported, it replays the records of BPlusTree.insert and delete.
+    """
+
+    def __init__(self, order: int, items: List[Tuple[Key, int]] = None, option='dense', key_store: str = 'list',
+                 aggregates: Dict[str, Monoid] = None):
+        postings = None
+        if items:
+            pairs = sorted(set(items))
+            postings = [(key, array('q', [rowid for _, rowid in group]))
+                        for key, group in groupby(pairs, key=lambda pair: pair[0])]
+        super().__init__(order, option=option, items=postings, key_store=key_store, aggregates=aggregates)
+
+    def own_postings(self, leaf: Node, idx: int) -> array:
+        """return the posting list at idx of an owned leaf, copied first if a snapshot may hold it"""
+        postings = leaf.payload[idx]
+        if self.pinned >= 0:
+            postings = leaf.payload[idx] = array('q', postings)
+        return postings
+
+    def insert(self, key: Key, rowid: int) -> None:
+        """add the row id to the posting list of the key, or insert the key if it does not exist.  inserting an
+        existing pair raises KeyError."""
+        leaf, path = self.descend(key)
+        idx = leaf.get_key_idx(key)
+        if idx is None:
+            self.insert_at(key, array('q', [rowid]), leaf, path)
+            return
+        postings = leaf.payload[idx]
+        pos = bisect_left(postings, rowid)
+        if pos < len(postings) and postings[pos] == rowid:
+            raise KeyError('pair ({}, {}) already exists.'.format(key, rowid))
+        if self.pinned >= 0:
+            leaf, path = self.own_path(path)
+        self.own_postings(leaf, idx).insert(pos, rowid)
+        if self.aggregates:
+            self.summarize_path(path)
+
+    def upsert(self, key: Key, value: Any) -> None:
+        raise Exception('upsert is not supported on a multimap tree, insert (key, rowid) pairs')
+
+    def bulk_insert(self, sorted_items: List[Tuple[Key, Any]], fill_factor: float = 1.0) -> None:
+        raise Exception('bulk_insert is not supported on a multimap tree, insert (key, rowid) pairs')
+
+    def delete(self, key: Key, rowid: int = None) -> None:
+        """delete the row id from the posting list of the key, and the key with its last row id.  without a row id,
+        delete the key with all its row ids."""
+        leaf, path = self.descend(key)
+        idx = leaf.get_key_idx(key)
+        if idx is None:
+            if Node.tracer:
+                Node.tracer('key {} does not exist.', key)
+            return
+        postings = leaf.payload[idx]
+        if rowid is None or len(postings) == 1 and postings[0] == rowid:
+            self.delete_at(key, leaf, path)
+            return
+        pos = bisect_left(postings, rowid)
+        if pos == len(postings) or postings[pos] != rowid:
+            if Node.tracer:
+                Node.tracer('pair ({}, {}) does not exist.', key, rowid)
+            return
+        if self.pinned >= 0:
+            leaf, path = self.own_path(path)
+        del self.own_postings(leaf, idx)[pos]
+        if self.aggregates:
+            self.summarize_path(path)
+
+    def count(self, key: Key) -> int:
+        """number of row ids of the key"""
+        return len(self.get(key, ()))
+
+    def iter_postings(self, left: Key = None, right: Key = None, inclusive: Tuple[bool, bool] = (True, True),
+                      reverse: bool = False) -> Iterator[Tuple[Key, int]]:
+        """lazily yield (key, rowid) pairs with keys between left and right, with the bounds of iter_range, in key
+        then row id order, or descending if reverse.  one posting list is read at a time."""
+        for key, postings in self.iter_range(left, right, inclusive, reverse):
+            for rowid in reversed(postings) if reverse else postings:
+                yield key, rowid
+
+    def range_search(self, left: Key, right: Key, reverse: bool = False) -> List[int]:
+        """row ids of the keys within [left, right], in key then row id order, or descending if reverse"""
+        ret = array('q')
+        for _, postings in self.iter_range(left, right, reverse=reverse):
+            ret.extend(reversed(postings) if reverse else postings)
+        return ret.tolist()
+
+    def is_valid(self) -> bool:
+        return super().is_valid() and self.is_posted()
+
+    def is_posted(self) -> bool:
+        """check that every posting list is a non empty array of strictly increasing row ids"""
+        for leaf in self.iter_leaves():
+            for key, postings in zip(leaf.keys, leaf.payload):
+                if not isinstance(postings, array) or not postings or \
+                        any(a >= b for a, b in zip(postings, postings[1:])):
+                    print('key {} has posting list {}'.format(key, postings))
+                    return False
+        return True
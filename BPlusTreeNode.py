@@ -1,9 +1,19 @@
 # Created by Luming on 11/27/2020 12:09 PM
 from __future__ import annotations
 
+import logging
+from bisect import bisect_right
 from enum import Enum
 from math import ceil, floor
-from typing import List, Any, Optional, Union
+from typing import List, Any, Optional, Union, Callable, Dict, Tuple
+
+from BPlusTreePacked import PackedKeys
+
+logger = logging.getLogger(__name__)
+
+# any totally ordered key type works, e.g. int, float, str, bytes or tuples of those.  keys within a tree must be
+# comparable with each other.
+Key = Union[int, float, str, bytes, tuple]
 
 
 class NodeType(Enum):
@@ -13,22 +23,62 @@ class NodeType(Enum):
 
 
 class Node:
+    # no per-instance __dict__, a tree holds millions of leaves.
+    __slots__ = ('type', 'keys', 'pointers', 'payload', 'counts', 'summaries', 'sequence_pointer', 'prev_pointer',
+                 'high_key', 'latch', 'epoch')
+
+    # hook that receives a format string and its arguments for every step of insert and delete.
+    # None by default, so that nothing is formatted on the hot path.  see set_tracer
+    tracer: Optional[Callable[..., None]] = None
+
+    # version clock shared by all trees, advanced by every snapshot.  a node is stamped with it when created, so
+    # that a tree can tell the nodes a snapshot may hold from the ones made since, see BPlusTree.snapshot
+    clock: int = 0
+
     def __init__(self, keys=None, pointers=None, payload: List[Any] = None, type=NodeType.LEAF,
-                 order: int = None):
-        """sequence pointer only works when node type is LEAF
-        a node represents a square with multiple values and pointers.
+                 counts: List[int] = None, summaries: List[tuple] = None):
+        """a node represents a square with multiple values and pointers.
 
         pointers: in leaf node the list is always empty; in
                   in non-leaf node the list points to child nodes
 
         Leaf node: key,
+
+        sequence pointer links the node to the next node on the same level, the next leaf for a leaf, and high key
+        is the separator above the node to its right, every key under the node is smaller.  both are None for the
+        right most node of a level.  a reader that finds a key at or beyond the high key follows the link, see
+        move_right.  prev pointer links the node back to the node before it on the same level, None for the left
+        most one, so that leaves are walked backward as cheaply as forward, see BPlusTree.iter_leaves_reverse.
+
+        the order is not stored per node.  checks that depend on it take the constraint table generated once by
+        the tree, see gen_constraint.  keys may be a list, or an array('q') or PackedKeys for integer leaf keys.
+
+        epoch is the version clock when the node was created.  while a snapshot of the tree taken no earlier is
+        held, the tree copies the node rather than change it, see BPlusTree.own_path.  the links and high key are
+        not part of what a snapshot reads, they are changed in place either way.
+
+        counts holds the number of keys under each child of an internal node, taken from the children unless given,
+        and is None for a leaf.  every change that moves keys between subtrees keeps them, so that rank and select
+        take one descent, see get_rank.
+
+        summaries holds the aggregates of each child of an internal node, for a tree with aggregates, otherwise it is
+        None.  the node keeps them in line with its children, while the tree computes them, since only the tree knows
+        its aggregates: an entry the node cannot carry over is left for the tree to compute, see
+        BPlusTree.summarize_children.
         """
-        self.order: int = order
         self.type: NodeType = type
-        self.keys: List[int] = keys if keys else []
+        self.keys: List[Key] = keys if keys is not None else []
         self.pointers: List[Node] = pointers if pointers else []
         self.payload: List[Any] = payload if payload else []
+        if counts is None and self.pointers:
+            counts = [child.get_count() for child in self.pointers]
+        self.counts: Optional[List[int]] = counts
+        self.summaries: Optional[List[tuple]] = summaries
         self.sequence_pointer: Optional[Node] = None
+        self.prev_pointer: Optional[Node] = None
+        self.high_key: Optional[Key] = None
+        self.latch = None  # created on first use by a concurrent tree, see BPlusTreeConcurrent
+        self.epoch: int = Node.clock
 
     def __repr__(self):
 
@@ -38,6 +88,17 @@ class Node:
             self.type, self.get_id(), len(self.keys), len(self.pointers), len(self.payload), self.get_height(),
             next_addr, self.keys)
 
+    def copy(self) -> Node:
+        """copy for copy on write, stamped with the current clock.  the keys, pointers and payload are copied, the
+        children and values themselves are shared."""
+        node = Node(keys=self.keys[:], pointers=self.pointers[:], payload=self.payload[:], type=self.type,
+                    counts=self.counts[:] if self.pointers else None,
+                    summaries=self.summaries[:] if self.summaries is not None else None)
+        node.sequence_pointer = self.sequence_pointer
+        node.prev_pointer = self.prev_pointer
+        node.high_key = self.high_key
+        return node
+
     def get_id(self, hex_cut=-5):
         # take last 5 chars of hex representation
         return hex(id(self))[hex_cut:]
@@ -47,17 +108,17 @@ class Node:
         ret = 'id: {}, keys: {}'.format(self.get_id(), self.keys)
         return ret
 
-    def is_valid(self) -> bool:
+    def is_valid(self, constraint: Dict = None) -> bool:
         """check if a node conforms with the constraint, check for child and parent consistency goes to b plus tree"""
 
-        # bound check, only valid in context, i.e., when order is provided
-        if self.order is not None:
-            constraint = gen_constraint(self.order)[self.type]
+        # bound check, only valid in context, i.e., when the constraint of the tree is provided
+        if constraint is not None:
+            bound = constraint[self.type]
 
-            if not constraint['min_keys'] <= self.get_key_size() <= constraint['max_keys']:
+            if not bound['min_keys'] <= self.get_key_size() <= bound['max_keys']:
                 print(self)
                 print("keys expect:actual {}-{}:{}"
-                      .format(constraint['min_keys'], constraint['max_keys'], self.get_key_size()))
+                      .format(bound['min_keys'], bound['max_keys'], self.get_key_size()))
                 return False
 
             if self.is_leaf():  # include single root leaf case
@@ -66,9 +127,9 @@ class Node:
                           .format(self.get_key_size(), self.get_payload_size()))
                     return False
             else:
-                if not constraint['min_pointers'] <= self.get_pointer_size() <= constraint['max_pointers']:
-                    print("pointers expect:actual = {}-{}:{}".format(constraint['min_pointers'],
-                                                                     constraint['max_pointers'],
+                if not bound['min_pointers'] <= self.get_pointer_size() <= bound['max_pointers']:
+                    print("pointers expect:actual = {}-{}:{}".format(bound['min_pointers'],
+                                                                     bound['max_pointers'],
                                                                      self.get_pointer_size()))
                     return False
 
@@ -83,6 +144,10 @@ class Node:
         else:
             if self.get_key_size() + 1 != self.get_pointer_size():
                 return False
+            if self.counts != [child.get_count() for child in self.pointers]:
+                print('counts {} do not match the children {}'
+                      .format(self.counts, [child.get_count() for child in self.pointers]))
+                return False
 
         # check that all child are of the same height.
         if not self.is_leaf():
@@ -100,7 +165,7 @@ class Node:
                     return False
 
         for child in self.pointers:
-            if not child.is_valid():
+            if not child.is_valid(constraint):
                 return False
 
         return True
@@ -111,8 +176,9 @@ class Node:
     def is_leaf(self) -> bool:
         """a node cannot tell if it is the root within the tree, but it can tell that it is the leaf if it has no child
         replace the use of == NodeType.LEAF if possible.
+        same as self.get_height() == 0, without walking down to the leaf level.
         """
-        return self.get_height() == 0
+        return not self.pointers
 
     def is_singular(self) -> bool:
         """check if the node contains only a single child.  in this case, the child should replace the parent"""
@@ -121,26 +187,24 @@ class Node:
     def is_empty(self) -> bool:
         return self.get_key_size() == 0
 
-    def is_full(self) -> bool:
+    def is_full(self, constraint: Dict) -> bool:
         """useful when inserting a key.  If a node is full, then insertion will results in node split."""
-        constraint = gen_constraint(self.order)[self.type]
-        if self.get_key_size() == constraint['max_keys']:
+        if self.get_key_size() == constraint[self.type]['max_keys']:
             return True
         else:
             return False
 
-    def is_half_full(self) -> bool:
+    def is_half_full(self, constraint: Dict) -> bool:
         """useful when deleting a key.  If a node is half full, then deletion will results in node split."""
-        constraint = gen_constraint(self.order)[self.type]
-        if self.get_key_size() == constraint['min_keys']:
+        if self.get_key_size() == constraint[self.type]['min_keys']:
             return True
         else:
             return False
 
-    def is_plenty(self) -> bool:
+    def is_plenty(self, constraint: Dict) -> bool:
         """return True if the node contains more than min_keys, which is suitable for redistribution"""
-        constraint = gen_constraint(self.order)[self.type]
-        if constraint['min_keys'] < self.get_key_size() <= constraint['max_keys']:
+        bound = constraint[self.type]
+        if bound['min_keys'] < self.get_key_size() <= bound['max_keys']:
             # not sure if the max key limit should be enforced.  trying to redistribute an overflow node?
             return True
         else:
@@ -164,22 +228,22 @@ class Node:
         else:
             return False
 
-    def is_overflow(self) -> bool:
-        constraint = gen_constraint(self.order)[self.type]
-        if self.get_key_size() > constraint['max_keys']:
+    def is_overflow(self, constraint: Dict) -> bool:
+        if self.get_key_size() > constraint[self.type]['max_keys']:
             return True
         else:
             return False
 
-    def is_underflow(self) -> bool:
-        constraint = gen_constraint(self.order)[self.type]
-        if self.get_key_size() < constraint['min_keys']:
+    def is_underflow(self, constraint: Dict) -> bool:
+        if self.get_key_size() < constraint[self.type]['min_keys']:
             return True
         else:
             return False
 
     def is_sorted(self) -> bool:
-        return sorted(self.keys) == self.keys
+        """keys strictly increase, a key appears once"""
+        keys = self.keys
+        return all(keys[i] < keys[i + 1] for i in range(len(keys) - 1))
 
     def get_key_size(self) -> int:
         return len(self.keys)
@@ -191,8 +255,11 @@ class Node:
         return len(self.payload)
 
     def set_payload(self) -> None:
+        """fill a leaf that is built from keys only, each key serves as its own payload.
+        a leaf that already carries its payload is left as is."""
         if self.is_leaf():
-            self.payload = [str(key) for key in self.keys]
+            if self.get_payload_size() != self.get_key_size():
+                self.payload = list(self.keys)
         else:
             print("setting payload on non-leaf node!")
 
@@ -205,17 +272,6 @@ class Node:
         else:
             return 1 + self.pointers[0].get_height()
 
-    def get_constraint(self) -> List[str]:
-        ret = ['order {}'.format(self.order)]
-        constraint = gen_constraint(self.order)
-        for node_type in NodeType:
-            c = constraint[node_type]
-            info = '{}, pointers [{}-{}], keys [{}-{}]' \
-                .format(node_type, c['min_pointers'], c['max_pointers'], c['min_keys'], c['max_keys'])
-            ret.append(info)
-        else:
-            return ret
-
     def get_first_leaf(self) -> Node:
         curr = self
         while True:
@@ -232,7 +288,7 @@ class Node:
             else:
                 curr = curr.pointers[-1]
 
-    def get_leaf_keys(self, option='sequential') -> List[int]:
+    def get_leaf_keys(self, option='sequential') -> List[Key]:
         """return all leaf keys under the current node."""
         if option == 'sequential':
             return self.get_leaf_keys_sequential()
@@ -241,11 +297,11 @@ class Node:
         else:
             raise Exception('unknown option')
 
-    def get_leaf_keys_top_down(self) -> List[int]:
+    def get_leaf_keys_top_down(self) -> List[Key]:
         leaves = self.get_leaf_nodes()
         return [key for leaf in leaves for key in leaf.keys]
 
-    def get_leaf_keys_sequential(self) -> List[int]:
+    def get_leaf_keys_sequential(self) -> List[Key]:
         curr = self.get_first_leaf()
         ret = []
         while curr:
@@ -254,40 +310,87 @@ class Node:
         else:
             return ret
 
-    def get_min_key(self) -> int:
+    def get_min_key(self) -> Key:
         return self.get_first_leaf().keys[0]
 
-    def get_max_key(self) -> int:
+    def get_max_key(self) -> Key:
         return self.get_last_leaf().keys[-1]
 
     def get_num_leaves(self) -> int:
-        return len(self.get_leaf_nodes())
+        """number of leaves under the node, from the pointers of the nodes right above them, so that the leaves
+        themselves are not visited and a subtree costs a visit to its internal nodes only"""
+        level = [self]
+        for _ in range(self.get_height() - 1):
+            level = [child for node in level for child in node.pointers]
+        return sum(len(node.pointers) for node in level) if self.pointers else 1
+
+    def get_count(self) -> int:
+        """number of keys under the node, from the counts of its children"""
+        return sum(self.counts) if self.pointers else len(self.keys)
+
+    def get_rank(self, key: Key, inclusive: bool = False) -> int:
+        """number of keys under the node smaller than the key, or no larger if inclusive.  one descent, which adds
+        up the counts of the children to the left of the one it takes."""
+        rank = 0
+        curr = self
+        while curr.pointers:
+            idx = curr.get_index(key)
+            rank += sum(curr.counts[:idx])
+            curr = curr.pointers[idx]
+        else:
+            return rank + curr.get_left_index(key, not inclusive)
+
+    def select(self, position: int) -> Key:
+        """the key at the position in key order under the node, counted from 0.  one descent, which skips the
+        children whose keys all come before the position."""
+        curr = self
+        while curr.pointers:
+            for idx, count in enumerate(curr.counts):
+                if position < count:
+                    break
+                position -= count
+            curr = curr.pointers[idx]
+        else:
+            return curr.keys[position]
 
     def get_num_keys_total(self) -> int:
         """get the number of keys in leaf nodes"""
         leaves = self.get_leaf_nodes()
         return sum([leaf.get_key_size() for leaf in leaves])
 
-    def get_key_idx(self, key: int) -> Optional[int]:
+    def get_key_idx(self, key: Key) -> Optional[int]:
         """search for exact position of a given key.  If not found, return None."""
-        if key in self.keys:
-            return self.keys.index(key)
+        idx = self.get_index(key)
+        if idx > 0 and self.keys[idx - 1] == key:
+            return idx - 1
         else:
             return None
 
-    def get_index(self, key: int) -> int:
+    def get_index(self, key: Key) -> int:
         """for the given key, find the index to insert that maintains the sorted nature of all the keys
-        find the index such that self.keys[i-1] <= key <= self.keys[i], so that self.keys.insert(key, i) inserts
+        find the index such that self.keys[i-1] <= key < self.keys[i], so that self.keys.insert(key, i) inserts
         before index i and the list maintains sorted.
 
         this somehow also works for finding the child node that may store the key value.
         if there are no child pointers, then it is leaf itself, and it returns a possible slot to insert.
         if there are child pointers, then it returns the one
+
+        binary search on the keys in place, the missing ends behave as -inf and inf without building a padded list.
+        packed leaf keys are searched on their offsets, without decoding.
         """
-        comparison = [-float('inf')] + self.keys + [float('inf')]
-        for i in range(len(comparison) - 1):
-            if comparison[i] <= key < comparison[i + 1]:
-                return i
+        keys = self.keys
+        if type(keys) is PackedKeys:
+            return keys.bisect_right(key)
+        return bisect_right(keys, key)
+
+    def get_left_index(self, key: Key, inclusive: bool = True) -> int:
+        """position of the first key that is no smaller than the given key, or larger than it if not inclusive.
+        keys[get_left_index(left):get_index(right)] are the keys within [left, right]
+        """
+        idx = self.get_index(key)
+        if inclusive and idx > 0 and self.keys[idx - 1] == key:
+            idx -= 1
+        return idx
 
     def get_leaf_nodes(self) -> List[Node]:
         """top down approach"""
@@ -303,36 +406,45 @@ class Node:
         else:
             return child_nodes
 
-    def search_node(self, target: int) -> Optional[Node]:
+    def search_node(self, target: Key) -> Optional[Node]:
         """given target key value, return the leaf node that possibly contains the value,
         Such leaf node either contains the value, or should contain if empty space remains within.
         When entering a leaf node, if a key value smaller than the target is found,
         then it confirms that such node can hold the target value,
         assuming that it does not violate the parent constraint.
         """
-        if self.is_leaf():
+        curr = self.move_right(target)
+        while curr.pointers:
+            curr = curr.pointers[curr.get_index(target)].move_right(target)
+        else:
             # assume that parent constraint is met, no check is required in leaf level.
-            return self
+            return curr
+
+    def move_right(self, key: Key) -> Node:
+        """follow the links to the right while the key is at or beyond the high key, i.e. to the node on this level
+        that covers the key, in case keys moved right by a split since the parent of this node was read.
+        in a tree that is not being changed this is the node itself.
+        """
+        curr = self
+        while curr.high_key is not None and key >= curr.high_key:
+            curr = curr.sequence_pointer
         else:
-            search_range = [-float('inf')] + self.keys + [float('inf')]  # add a dummy infinity number for comparison
-            for idx in range(len(search_range) - 1):
-                if search_range[idx] <= target < search_range[idx + 1]:
-                    return self.pointers[idx].search_node(target)
+            return curr
 
-    def search(self, target: int) -> Optional[Any, None]:
+    def search(self, target: Key) -> Optional[Any, None]:
         """search for exact position of key within the given node, return the
         in actual application, return
         ref: note17, p4
         """
         leaf = self.search_node(target)
-        for idx, key in enumerate(leaf.keys):
-            if key == target:
-                return leaf.payload[idx]
+        idx = leaf.get_key_idx(target)
+        if idx is not None:
+            return leaf.payload[idx]
         else:
             # print("target {} not found.".format(target))
             return None
 
-    def range_search(self, left, right) -> List[str]:
+    def range_search(self, left, right) -> List[Any]:
         """return matching elements within closed interval [left, right]
         1. find position for left
         2. direct elements within interval to the output
@@ -345,54 +457,50 @@ class Node:
         """
         ret = []
         leaf = self.search_node(left)
+        start = leaf.get_left_index(left)
         while leaf:
-            for idx, key in enumerate(leaf.keys):
-                if key < left:
-                    continue
-                elif left <= key <= right:
-                    ret.append(leaf.payload[idx])
-                else:
-                    return ret
+            end = leaf.get_index(right)  # first position with key > right
+            ret.extend(leaf.payload[start:end])
+            if end < leaf.get_key_size():
+                return ret
             else:
                 leaf = leaf.sequence_pointer
+                start = 0
         else:
             return ret
 
-    def insert_key(self, key: int, data: Union[str, Node], height: int = 0):
-        """insert key to a leaf node.  When calling directly to a leaf node, possible overflow will not be handled
-        unless its parent node checks.
-        it defaults to inserting to a leaf node.  If specified, insert to a child node.
-        if inserting to a leaf, data should be string;
+    def insert_key(self, key: Key, data: Union[Any, Node]) -> None:
+        """insert key to the current node.  Possible overflow will not be handled here, the caller walks back up the
+        descent path and splits. see BPlusTree.insert
+        if inserting to a leaf, data is the payload of the key;
         if inserting to a internal node, data should be the new child Node
         """
-        if self.get_height() < height:
-            raise Exception('cannot reach above. {} < {}'.format(self.get_height(), height))
-
-        if self.get_height() == height:
-            print('INSERTING KEY: {}'.format(key))
-            print('BEFORE INSERTION: {}'.format(self))
-            idx = self.get_index(key)  # find suitable position
-            self.keys.insert(idx, key)
-            if self.is_leaf():
-                self.payload.insert(idx, data)
-            else:
-                self.pointers.insert(idx, data)
-            print('AFTER INSERTION: {}'.format(self))
-
-        else:  # dig down into lower layer, pass data down
-            idx = self.get_index(key)
-            self.pointers[idx].insert_key(key, data, height)
-            if self.pointers[idx].is_overflow():
-                print('INSERTION OVERFLOW')
-                print('NODE BEFORE SPLIT: {}'.format(self.pointers[idx]))
-                new_node = self.pointers[idx].split()
-                print('NODE AFTER SPLIT: {}'.format(self.pointers[idx]))
-                print('NEW NODE: {}'.format(new_node))
-                # insert to the right of the original node that just got split
-                print('NODE BEFORE INSERT: {}'.format(self))
-                self.pointers.insert(idx + 1, new_node)
-                self.keys.insert(idx, self.pointers[idx + 1].get_first_leaf().keys[0])
-                print('NODE AFTER INSERT: {}'.format(self))
+        if Node.tracer:
+            Node.tracer('INSERTING KEY: {}', key)
+            Node.tracer('BEFORE INSERTION: {}', self)
+        idx = self.get_index(key)  # find suitable position
+        self.keys.insert(idx, key)
+        if self.is_leaf():
+            self.payload.insert(idx, data)
+        else:
+            self.pointers.insert(idx, data)
+            self.counts.insert(idx, data.get_count())
+            if self.summaries is not None:
+                self.summaries.insert(idx, None)
+        if Node.tracer:
+            Node.tracer('AFTER INSERTION: {}', self)
+
+    def add_children(self, idx: int, new_nodes: List[Node], separators: List[Key]) -> None:
+        """at parent perspective, put the nodes split off the idx-th child right after it, separators[i] goes before
+        new_nodes[i].  their keys are counted out of the child, their aggregates and those of the child are left to the
+        tree."""
+        new_counts = [node.get_count() for node in new_nodes]
+        self.pointers[idx + 1:idx + 1] = new_nodes
+        self.keys[idx:idx] = separators
+        self.counts[idx] -= sum(new_counts)
+        self.counts[idx + 1:idx + 1] = new_counts
+        if self.summaries is not None:
+            self.summaries[idx:idx + 1] = [None] * (len(new_nodes) + 1)
 
     def traversal(self):
         """traverse down from the given node to the leaf nodes, print out leaf payload"""
@@ -418,158 +526,250 @@ class Node:
             print('H{}: {}'.format(i, self.get_key_layer(i)))
             print()
 
-    def merge(self, idx: int) -> bool:
+    def merge(self, idx: int, constraint: Dict) -> bool:
         """at parent perspective, merge node idx+1 into node idx. return True if success else False
         there is no difference between left merge and right merge.  node1, node2, node3.  node1 right merge into node2
         is the same as node2 left merge into node1.  Therefore one implementation is sufficient.
 
         merge idx+1 into node idx.  For right most leaf with no next node, call merge(idx-1) if it has left sibling.
         """
-        node = self.pointers[idx]
-        if not self.has_right_sibling(idx) or self.pointers[idx + 1].is_full():
+        if not self.has_right_sibling(idx) or self.pointers[idx + 1].is_full(constraint):
             return False
         else:
             next_node = self.pointers[idx + 1]
-            print('FIX BY MERGING')
-            print('LEFT NODE BEFORE MERGE: {}'.format(self.pointers[idx]))
-            print('RIGHT NODE BEFORE MERGE: {}'.format(next_node))
+            if Node.tracer:
+                Node.tracer('FIX BY MERGING')
+                Node.tracer('LEFT NODE BEFORE MERGE: {}', self.pointers[idx])
+                Node.tracer('RIGHT NODE BEFORE MERGE: {}', next_node)
+
+        self.concat(idx)
+        if Node.tracer:
+            Node.tracer('NODE AFTER MERGE: {}', self.pointers[idx])
+        return True
 
+    def concat(self, idx: int) -> Node:
+        """at parent perspective, append node idx+1 to node idx and drop it, whatever their sizes.  return the merged
+        node, which may underflow or overflow.  used by merge, and by range deletion where a node may be far below
+        the minimum.
+        """
+        node = self.pointers[idx]
+        next_node = self.pointers[idx + 1]
         if node.is_leaf():
             node.keys.extend(next_node.keys)
             node.payload.extend(next_node.payload)
-            self.keys.pop(idx)
-            self.pointers.pop(idx + 1)
-            node.sequence_pointer = next_node.sequence_pointer
             # when merge results in parent having 0 key 1 pointer, make the merged node as self.
             # however, this can only be handled by self.parent.
         else:
-            node.keys.append(next_node.get_min_key())
+            node.keys.append(self.keys[idx])  # the parent key is no larger than any key under next_node
             node.keys.extend(next_node.keys)
             node.pointers.extend(next_node.pointers)
-            self.keys.pop(idx)
-            self.pointers.pop(idx + 1)
-
-        print('NODE AFTER MERGE: {}'.format(self.pointers[idx]))
-        return True
-
-    def redistribute(self, idx: int) -> bool:
+            node.counts.extend(next_node.counts)
+            if node.summaries is not None:
+                node.summaries.extend(next_node.summaries)
+        node.sequence_pointer = next_node.sequence_pointer
+        if node.sequence_pointer is not None:
+            node.sequence_pointer.prev_pointer = node
+        node.high_key = next_node.high_key
+        self.keys.pop(idx)
+        self.pointers.pop(idx + 1)
+        self.counts[idx] += self.counts.pop(idx + 1)
+        if self.summaries is not None:
+            self.summaries[idx:idx + 2] = [None]
+        return node
+
+    def redistribute(self, idx: int, constraint: Dict) -> bool:
         """redistribute a key from a sibling of the idx-th child to it.  return True if success else False"""
         node = self.pointers[idx]
-        if self.has_left_sibling(idx) and self.pointers[idx - 1].is_plenty():
-            print('FIX BY BORROW FROM LEFT SIBLING')
+        if self.has_left_sibling(idx) and self.pointers[idx - 1].is_plenty(constraint):
+            if Node.tracer:
+                Node.tracer('FIX BY BORROW FROM LEFT SIBLING')
             left_sibling = self.pointers[idx - 1]
-            print('LEFT SIBLING BEFORE BORROW: {}'.format(left_sibling))
+            if Node.tracer:
+                Node.tracer('LEFT SIBLING BEFORE BORROW: {}', left_sibling)
             if node.is_leaf():
                 # max key of the left sibling, redistribute to be the min key of the node
                 moving_key = left_sibling.keys.pop()
                 moving_payload = left_sibling.payload.pop()
                 node.keys.insert(0, moving_key)
                 node.payload.insert(0, moving_payload)
-                self.keys[idx - 1] = moving_key  # min key from the right sub-tree
+                self.keys[idx - 1] = get_separator(left_sibling.keys[-1], moving_key)
+                left_sibling.high_key = self.keys[idx - 1]
+                moving_count = 1
             else:
-                new_key = node.get_min_key()
+                # rotate: the parent key comes down in front of the moving child, the right most key of the left
+                # sibling goes up in its place
                 moving_child = left_sibling.pointers.pop()
-                left_sibling.keys.pop()  # simply remove the right most key
                 node.pointers.insert(0, moving_child)
-                node.keys.insert(0, new_key)
-                self.keys[idx - 1] = node.get_min_key()  # update since node gets a new left most leaf
-
-            print('LEFT SIBLING AFTER BORROW: {}'.format(left_sibling))
-            print('UNDERFLOW NODE AFTER BORROW: {}'.format(self.pointers[idx]))
+                node.keys.insert(0, self.keys[idx - 1])
+                self.keys[idx - 1] = left_sibling.keys.pop()
+                left_sibling.high_key = self.keys[idx - 1]
+                moving_count = left_sibling.counts.pop()
+                node.counts.insert(0, moving_count)
+                if node.summaries is not None:
+                    node.summaries.insert(0, left_sibling.summaries.pop())
+            self.counts[idx - 1] -= moving_count
+            self.counts[idx] += moving_count
+
+            if Node.tracer:
+                Node.tracer('LEFT SIBLING AFTER BORROW: {}', left_sibling)
+                Node.tracer('UNDERFLOW NODE AFTER BORROW: {}', self.pointers[idx])
             return True
 
-        elif self.has_right_sibling(idx) and self.pointers[idx + 1].is_plenty():
+        elif self.has_right_sibling(idx) and self.pointers[idx + 1].is_plenty(constraint):
             right_sibling = self.pointers[idx + 1]
-            print('FIX BY BORROW FROM RIGHT')
-            print('RIGHT SIBLING BEFORE BORROW: {}'.format(right_sibling))
+            if Node.tracer:
+                Node.tracer('FIX BY BORROW FROM RIGHT')
+                Node.tracer('RIGHT SIBLING BEFORE BORROW: {}', right_sibling)
             if node.is_leaf():
                 new_key = right_sibling.keys.pop(0)  # min key of the right sibling
                 node.keys.append(new_key)
                 moving_payload = right_sibling.payload.pop(0)
                 node.payload.append(moving_payload)
-                self.keys[idx] = right_sibling.get_min_key()
+                self.keys[idx] = get_separator(new_key, right_sibling.keys[0])
+                node.high_key = self.keys[idx]
+                moving_count = 1
             else:
                 moving_child = right_sibling.pointers.pop(0)
-                right_sibling.keys.pop(0)
                 node.pointers.append(moving_child)
-                node.keys.append(moving_child.get_min_key())
-                # right_sibling.keys[0] = right_sibling.pointers[1].get_min_key()
-                self.keys[idx] = right_sibling.get_min_key()
-
-            print('RIGHT SIBLING AFTER BORROW: {}'.format(right_sibling))
-            print('UNDERFLOW NODE AFTER BORROW: {}'.format(self.pointers[idx]))
+                node.keys.append(self.keys[idx])
+                self.keys[idx] = right_sibling.keys.pop(0)
+                node.high_key = self.keys[idx]
+                moving_count = right_sibling.counts.pop(0)
+                node.counts.append(moving_count)
+                if node.summaries is not None:
+                    node.summaries.append(right_sibling.summaries.pop(0))
+            self.counts[idx + 1] -= moving_count
+            self.counts[idx] += moving_count
+
+            if Node.tracer:
+                Node.tracer('RIGHT SIBLING AFTER BORROW: {}', right_sibling)
+                Node.tracer('UNDERFLOW NODE AFTER BORROW: {}', self.pointers[idx])
             return True
 
         else:  # redistribution fails, try merge with siblings.
             return False
 
-    def delete_key(self, key: int) -> None:
-        if self.is_leaf():
-            print('NODE BEFORE DELETE: {}'.format(self))
-            idx = self.get_key_idx(key)
-            if idx is not None:
-                self.keys.pop(idx)
-                self.payload.pop(idx)
-                print('NODE AFTER DELETE: {}'.format(self))
-            else:
-                print('key to delete: {} not found.'.format(key))
+    def delete_key(self, key: Key) -> bool:
+        """delete key from the current leaf node.  return True if the key is found.
+        underflow is fixed by the caller from the parent level, see BPlusTree.delete
+        """
+        if Node.tracer:
+            Node.tracer('NODE BEFORE DELETE: {}', self)
+        idx = self.get_key_idx(key)
+        if idx is not None:
+            self.keys.pop(idx)
+            self.payload.pop(idx)
+            if Node.tracer:
+                Node.tracer('NODE AFTER DELETE: {}', self)
+            return True
         else:
-            node_idx = self.get_index(key)
-            self.pointers[node_idx].delete_key(key)
-
-            # should fix height difference by rotating a higher node key.
-            # same as redistribution
-            if self.pointers[node_idx].is_underflow():
-                print('UNDERFLOW CAUSED BY DELETE')
-                print('NODE BEFORE FIX: {}'.format(self.pointers[node_idx]))
-                # priority: redistribution > merge
-                # try merge with neighbor nodes
-                if self.redistribute(node_idx):
-                    return
-                elif self.merge(node_idx):  # merge curr and right
-                    return
-                elif self.merge(node_idx - 1):  # merge left and curr
-                    return
-                else:  # singular case,
-                    print('singular case, cannot redistribute nor merge')
-
-    def split(self) -> Node:
+            if Node.tracer:
+                Node.tracer('key to delete: {} not found.', key)
+            return False
+
+    def split(self, constraint: Dict) -> Tuple[Node, Key]:
         """split an overflow node and return two nodes.  By default the split is left biased,
         that the left node has more keys than the right node.  Return the new node that is to be put to the right of
-        the current one, while the original one is the left node.
+        the current one, while the original one is the left node, and the key that separates them in the parent.
 
         The split behavior depends on the height of the node.
 
         split of root: root -> leaf, root -> non-leaf
         """
-        if self.is_overflow():
+        if self.is_overflow(constraint):
+            # the new node is linked in before the keys leave this one, so that a reader who finds them gone
+            # also finds the high key that sends it right
             if self.is_leaf():
                 cut = (self.get_key_size() + 1) // 2
-                new_node = Node(keys=self.keys[cut:], payload=[str(key) for key in self.keys[cut:]], type=NodeType.LEAF,
-                                order=self.order)
-                new_node.sequence_pointer = self.sequence_pointer
-                self.sequence_pointer = new_node
+                new_node = Node(keys=self.keys[cut:], payload=self.payload[cut:], type=NodeType.LEAF)
+                separator = get_separator(self.keys[cut - 1], self.keys[cut])
+                self.link([new_node], [separator])
 
                 self.keys = self.keys[:cut]
-                self.payload = [str(key) for key in self.keys]
+                self.payload = self.payload[:cut]
                 self.type = NodeType.LEAF  # for single root tree split to leaf case
-                return new_node
+                return new_node, separator
             else:  # when splitting an internal node, the median value upgrades to the upper height
                 # should slice child pointers for new node and original node
                 # cut = (self.get_key_size() + 1) // 2
                 cut = self.get_key_size() // 2
                 keys = self.keys
                 pointers = self.pointers
+                summaries = self.summaries
                 new_node = Node(keys=keys[cut + 1:], pointers=pointers[cut + 1:], type=NodeType.NON_LEAF,
-                                order=self.order)
+                                counts=self.counts[cut + 1:],
+                                summaries=summaries[cut + 1:] if summaries is not None else None)
+                self.link([new_node], [keys[cut]])
                 self.keys = keys[:cut]
                 self.pointers = pointers[:cut + 1]
+                self.counts = self.counts[:cut + 1]
+                if summaries is not None:
+                    self.summaries = summaries[:cut + 1]
                 self.type = NodeType.NON_LEAF  # for root split to internal node case
-                return new_node
+                return new_node, keys[cut]
         else:
             raise Exception('requesting split on a not overflow node')
 
-    def get_key_layer(self, height=None) -> List[List[int]]:
+    def link(self, new_nodes: List[Node], separators: List[Key]) -> None:
+        """put new_nodes right after this node on its level, separators[i] goes before new_nodes[i].
+        the new nodes are linked among themselves before this node links to the first one, so that they are
+        complete by the time a reader can reach them.
+        """
+        next_nodes = new_nodes[1:] + [self.sequence_pointer]
+        high_keys = separators[1:] + [self.high_key]
+        for node, prev_node, next_node, high_key in zip(new_nodes, [self] + new_nodes, next_nodes, high_keys):
+            node.sequence_pointer = next_node
+            node.prev_pointer = prev_node
+            node.high_key = high_key
+        if self.sequence_pointer is not None:
+            self.sequence_pointer.prev_pointer = new_nodes[-1]
+        self.sequence_pointer = new_nodes[0]
+        self.high_key = separators[0]
+
+    def split_into(self, sizes: List[int]) -> Tuple[List[Node], List[Key]]:
+        """split the node into len(sizes) nodes in one go, the original node keeps the first part.
+        sizes count keys for a leaf, and pointers for an internal node.
+        return the new nodes to be put to the right of the current one, and the keys that separate them, which are
+        to be inserted into the parent along with the new nodes.
+        as in split, a leaf puts a separator between adjacent new nodes up, while an internal node moves its cut keys
+        up.
+        """
+        new_nodes = []
+        separators = []
+        keys = self.keys
+        start = sizes[0]
+        if self.is_leaf():
+            payload = self.payload
+            for size in sizes[1:]:
+                end = start + size
+                separators.append(get_separator(keys[start - 1], keys[start]))
+                new_nodes.append(Node(keys=keys[start:end], payload=payload[start:end], type=NodeType.LEAF))
+                start = end
+            self.link(new_nodes, separators)
+            self.keys = keys[:sizes[0]]
+            self.payload = payload[:sizes[0]]
+            self.type = NodeType.LEAF
+        else:
+            pointers = self.pointers
+            counts = self.counts
+            summaries = self.summaries
+            for size in sizes[1:]:
+                end = start + size
+                separators.append(keys[start - 1])
+                new_nodes.append(Node(keys=keys[start:end - 1], pointers=pointers[start:end], type=NodeType.NON_LEAF,
+                                      counts=counts[start:end],
+                                      summaries=summaries[start:end] if summaries is not None else None))
+                start = end
+            self.link(new_nodes, separators)
+            self.keys = keys[:sizes[0] - 1]
+            self.pointers = pointers[:sizes[0]]
+            self.counts = counts[:sizes[0]]
+            if summaries is not None:
+                self.summaries = summaries[:sizes[0]]
+            self.type = NodeType.NON_LEAF
+        return new_nodes, separators
+
+    def get_key_layer(self, height=None) -> List[List[Key]]:
         """return a list of key lists for nodes at the given height, a horizontal section of keys.
         height=0 -> leaf keys
         height=1 -> keys from parents of leaf
@@ -590,6 +790,37 @@ class Node:
             return [node.keys for node in nodes]
 
 
+def get_separator(left: Key, right: Key) -> Key:
+    """shortest key s with left < s <= right, to separate a node whose keys end at left from the next one starting
+    at right.  str, bytes and tuple keys are cut to the shortest prefix of right that is still larger than left, so
+    that internal nodes hold short keys, other keys separate by right itself.
+    """
+    if type(left) is type(right) and isinstance(right, (str, bytes, tuple)):
+        i = 0
+        length = min(len(left), len(right))
+        while i < length and left[i] == right[i]:
+            i += 1
+        return right[:i + 1]
+    else:
+        return right
+
+
+def set_tracer(tracer: Optional[Callable[..., None]] = None) -> None:
+    """install the tracing hook for insert and delete on all nodes, e.g. print_tracer for the verbose trace.
+    call with None to go silent again."""
+    Node.tracer = tracer
+
+
+def print_tracer(msg: str, *args) -> None:
+    print(msg.format(*args))
+
+
+def log_tracer(msg: str, *args) -> None:
+    """send the trace to the module logger at debug level"""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(msg.format(*args))
+
+
 # this is a static method.  moving the function to other files may easily cause circular import problems.
 def gen_constraint(order: int):
     """generate b plus tree node attribute constraint. ref: note17 p3"""
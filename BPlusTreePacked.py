@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Iterable, Iterator, List, Union
+
+# unsigned typecodes from narrow to wide, an offset is stored in the narrowest one that holds the span of the leaf
+TYPECODES = [typecode for typecode in ('B', 'H', 'I', 'L', 'Q') if array(typecode).itemsize in (1, 2, 4, 8)]
+
+
+class PackedKeys:
+    """sorted integer keys of a leaf, compressed by frame of reference: the smallest key is kept as the base, and the
+    keys are stored as offsets from it, packed into an array of 1, 2, 4 or 8 bytes per key, whichever is the
+    narrowest to hold the span of the leaf.  dense keys take a byte or two each instead of a 28+ byte int object.
+
+    it behaves as the list of keys as far as a leaf uses it.  lookups binary search the offsets in place without
+    decoding them.  a write that fits the frame changes the offsets in place, only a key below the base or beyond
+    the width re-encodes this leaf.
+    """
+    __slots__ = ('base', 'offsets', 'limit')
+
+    def __init__(self, keys: Iterable[int] = ()):
+        self.encode(list(keys))
+
+    def encode(self, keys: List[int]) -> None:
+        self.base: int = keys[0] if keys else 0
+        span = keys[-1] - self.base if keys else 0
+        for typecode in TYPECODES:
+            limit = (1 << (8 * array(typecode).itemsize)) - 1
+            if span <= limit:
+                break
+        else:
+            raise OverflowError('key span {} does not fit in 64 bits'.format(span))
+        base = self.base
+        self.offsets = array(typecode, [key - base for key in keys])
+        self.limit: int = limit
+
+    @classmethod
+    def from_frame(cls, base: int, offsets: array) -> PackedKeys:
+        packed = cls.__new__(cls)
+        packed.base = base
+        packed.offsets = offsets
+        packed.limit = (1 << (8 * offsets.itemsize)) - 1
+        return packed
+
+    def fits(self, key: int) -> bool:
+        return 0 <= key - self.base <= self.limit
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __iter__(self) -> Iterator[int]:
+        return map(self.base.__add__, self.offsets)
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def __eq__(self, other) -> bool:
+        return list(self) == list(other)
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[int, PackedKeys]:
+        if isinstance(idx, slice):
+            return PackedKeys.from_frame(self.base, self.offsets[idx])
+        return self.base + self.offsets[idx]
+
+    def __setitem__(self, idx: int, key: int) -> None:
+        if self.fits(key):
+            self.offsets[idx] = key - self.base
+        else:
+            keys = self.tolist()
+            keys[idx] = key
+            self.encode(keys)
+
+    def __delitem__(self, idx: Union[int, slice]) -> None:
+        del self.offsets[idx]
+
+    def tolist(self) -> List[int]:
+        return list(map(self.base.__add__, self.offsets))
+
+    def bisect_right(self, key: int) -> int:
+        """same as bisect.bisect_right on the keys, on the offsets"""
+        offset = key - self.base
+        if offset < 0:
+            return 0
+        elif offset > self.limit:
+            return len(self.offsets)
+        else:
+            return bisect_right(self.offsets, offset)
+
+    def bisect_left(self, key: int) -> int:
+        offset = key - self.base
+        if offset < 0:
+            return 0
+        elif offset > self.limit:
+            return len(self.offsets)
+        else:
+            return bisect_left(self.offsets, offset)
+
+    def insert(self, idx: int, key: int) -> None:
+        if self.fits(key):
+            self.offsets.insert(idx, key - self.base)
+        else:
+            keys = self.tolist()
+            keys.insert(idx, key)
+            self.encode(keys)
+
+    def append(self, key: int) -> None:
+        self.insert(len(self.offsets), key)
+
+    def extend(self, keys: Iterable[int]) -> None:
+        keys = list(keys)
+        if keys and self.fits(keys[0]) and self.fits(keys[-1]):
+            base = self.base
+            self.offsets.extend([key - base for key in keys])
+        elif keys:
+            self.encode(self.tolist() + keys)
+
+    def pop(self, idx: int = -1) -> int:
+        return self.base + self.offsets.pop(idx)
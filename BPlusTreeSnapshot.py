@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import pickle
+import struct
+import sys
+from array import array
+from typing import Any, BinaryIO, Dict, List, Tuple
+
+from BPlusTree import BPlusTree
+from BPlusTreeAggregate import Monoid
+from BPlusTreeNode import Node, NodeType
+
+# snapshot format: a header, then the leaves from left to right, each one a contiguous block of keys followed by a
+# block of values.  internal nodes are not stored, load rebuilds them level by level from the leaves, which are
+# already in key order, so nothing is sorted again.
+#
+# leaf block: leaf header, then the keys, then the pickled list of values.
+#     keys are little endian 64-bit integers when every key of the tree fits, otherwise the pickled list of keys.
+#     values are left out when each value is its own key, as in a tree built from keys only.
+
+MAGIC = b'BPSNAP02'
+# magic, order, key kind, key store, option, fill factor of the fill option, number of leaves, number of keys,
+# checkpoint id, see BPlusTreeLog.checkpoint
+SNAPSHOT_HEADER = struct.Struct('<8sIBBBxdqqq')
+# number of keys, size of the keys block, size of the values block or SAME_AS_KEYS
+LEAF_HEADER = struct.Struct('<III')
+SAME_AS_KEYS = 0xFFFFFFFF
+
+INT_KEYS, PICKLED_KEYS = 0, 1
+KEY_STORES = ('list', 'array', 'packed')
+OPTIONS = ('dense', 'sparse', 'fill')
+
+
+def is_int64(keys) -> bool:
+    return isinstance(keys, array) or all(type(key) is int and -(1 << 63) <= key < (1 << 63) for key in keys)
+
+
+def is_same_as_key(key, value) -> bool:
+    """the value is rebuilt exactly from the key: it is the key itself, or an int, str or bytes equal to it.  values
+    that only compare equal, 1.0 or True for the key 1, or -0.0 for 0.0, are stored."""
+    return value is key or type(value) is type(key) and type(key) in (int, str, bytes) and value == key
+
+
+def encode_keys(keys, key_kind: int) -> bytes:
+    if key_kind == PICKLED_KEYS:
+        return pickle.dumps(list(keys), pickle.HIGHEST_PROTOCOL)
+    keys = keys if isinstance(keys, array) else array('q', keys)
+    if sys.byteorder == 'big':
+        keys = array('q', keys)
+        keys.byteswap()
+    return keys.tobytes()
+
+
+def decode_keys(data: bytes, key_kind: int) -> array:
+    if key_kind == PICKLED_KEYS:
+        return pickle.loads(data)
+    keys = array('q')
+    keys.frombytes(data)
+    if sys.byteorder == 'big':
+        keys.byteswap()
+    return keys
+
+
+def read_exactly(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise Exception('snapshot is truncated')
+    return data
+
+
+def dump(tree: BPlusTree, f: BinaryIO, checkpoint: int = 0) -> None:
+    """write a snapshot of the tree to the binary file object f, one leaf at a time.  checkpoint is the id of the
+    log record that the snapshot covers the log up to, 0 for none."""
+    leaves = list(tree.iter_leaves())
+    key_kind = INT_KEYS if all(is_int64(leaf.keys) for leaf in leaves) else PICKLED_KEYS
+    if isinstance(tree.option, str):
+        option, fill_factor = OPTIONS.index(tree.option), 0.0
+    else:
+        option, fill_factor = OPTIONS.index('fill'), tree.option
+    f.write(SNAPSHOT_HEADER.pack(MAGIC, tree.order, key_kind, KEY_STORES.index(tree.key_store), option,
+                                 fill_factor, len(leaves), sum(leaf.get_key_size() for leaf in leaves), checkpoint))
+    for leaf in leaves:
+        keys = encode_keys(leaf.keys, key_kind)
+        if all(is_same_as_key(key, value) for key, value in zip(leaf.keys, leaf.payload)):
+            values = b''
+            values_size = SAME_AS_KEYS
+        else:
+            values = pickle.dumps(list(leaf.payload), pickle.HIGHEST_PROTOCOL)
+            values_size = len(values)
+        f.write(LEAF_HEADER.pack(leaf.get_key_size(), len(keys), values_size))
+        f.write(keys)
+        f.write(values)
+
+
+def read_header(f: BinaryIO) -> Tuple[int, int, str, Any, int, int, int]:
+    """read the header of a snapshot, return its order, key kind, key store, option as BPlusTree takes it, number of
+    leaves, number of keys and checkpoint id"""
+    magic, order, key_kind, key_store, option, fill_factor, num_leaves, num_keys, checkpoint = \
+        SNAPSHOT_HEADER.unpack(read_exactly(f, SNAPSHOT_HEADER.size))
+    if magic != MAGIC:
+        raise Exception('not a b+ tree snapshot')
+    option = fill_factor if OPTIONS[option] == 'fill' else OPTIONS[option]
+    return order, key_kind, KEY_STORES[key_store], option, num_leaves, num_keys, checkpoint
+
+
+def load(f: BinaryIO, aggregates: Dict[str, Monoid] = None) -> BPlusTree:
+    """rebuild a tree from a snapshot read from the binary file object f.
+    leaves are read one block at a time, so the snapshot is never held in memory next to the tree.
+    aggregates are not part of the snapshot, those of BPlusTree are given again and computed from the values.
+    """
+    order, key_kind, key_store, option, num_leaves, num_keys, _ = read_header(f)
+    tree = BPlusTree(order, option=option, key_store=key_store, aggregates=aggregates)
+
+    leaves: List[Node] = []
+    total = 0
+    for _ in range(num_leaves):
+        count, keys_size, values_size = LEAF_HEADER.unpack(read_exactly(f, LEAF_HEADER.size))
+        keys = decode_keys(read_exactly(f, keys_size), key_kind)
+        if values_size == SAME_AS_KEYS:
+            values: List[Any] = keys.tolist() if isinstance(keys, array) else list(keys)
+        else:
+            values = pickle.loads(read_exactly(f, values_size))
+        if len(keys) != count or len(values) != count:
+            raise Exception('snapshot leaf holds {} keys and {} values, expected {}'
+                            .format(len(keys), len(values), count))
+        if key_kind == INT_KEYS and tree.key_store == 'list':
+            keys = keys.tolist()
+        elif tree.key_store == 'packed':
+            keys = tree.new_keys(keys)
+        leaf = Node(keys=keys, payload=values, type=NodeType.LEAF)
+        total += count
+        if leaves:
+            leaves[-1].sequence_pointer = leaf
+        leaves.append(leaf)
+
+    if len(leaves) > 1:
+        tree.root = tree.construct_parents(leaves, tree.option)
+    elif leaves:
+        tree.root = leaves[0]
+        tree.root.type = NodeType.ROOT
+    tree.init_stats()
+    if total != num_keys:
+        raise Exception('snapshot holds {} keys, expected {}'.format(total, num_keys))
+    return tree
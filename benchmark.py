@@ -0,0 +1,471 @@
+from __future__ import annotations
+
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Tuple
+
+import BPlusTreeBulk
+import BPlusTreeSnapshot
+from BPlusTree import BPlusTree
+from BPlusTreeAggregate import SUM, MAX
+from BPlusTreeDisk import DiskBPlusTree, dump, get_page_size
+from BPlusTreeLog import WriteAheadLog
+from BPlusTreeMulti import MultiBPlusTree
+from BPlusTreeNode import NodeType, set_tracer
+
+
+def gen_keys(num_keys: int) -> List[int]:
+    """consecutive integer keys above the small int cache, so that every key is its own object"""
+    start = 1 << 32
+    return list(range(start, start + num_keys))
+
+
+class DictNode:
+    """the node layout before Node declared __slots__: attributes in a per instance __dict__, and the order kept in
+    every node.  for memory_benchmark only."""
+
+    def __init__(self, keys: List[int], pointers: List[DictNode] = None, payload: List = None,
+                 type=NodeType.LEAF, order: int = None):
+        self.order = order
+        self.type = type
+        self.keys = keys
+        self.pointers = pointers if pointers else []
+        self.payload = payload if payload else []
+        self.sequence_pointer = None
+
+
+def construct_dict_nodes(order: int, keys: List[int], values: List) -> Tuple[DictNode, int]:
+    """build the tree that BPlusTree.construct builds from sorted keys out of DictNode, with the same node sizes.
+    return the root and the height."""
+    tree = BPlusTree(order)
+    nodes, firsts = [], []
+    start = 0
+    for size in tree.get_node_dist(len(keys), NodeType.LEAF):
+        nodes.append(DictNode(keys[start:start + size], payload=values[start:start + size], order=order))
+        firsts.append(keys[start])
+        start += size
+    for left, right in zip(nodes, nodes[1:]):
+        left.sequence_pointer = right
+    height = 0
+    while len(nodes) > 1:
+        parents, parent_firsts = [], []
+        start = 0
+        for size in tree.get_node_dist(len(nodes), NodeType.NON_LEAF):
+            parents.append(DictNode(firsts[start + 1:start + size], pointers=nodes[start:start + size],
+                                    type=NodeType.NON_LEAF, order=order))
+            parent_firsts.append(firsts[start])
+            start += size
+        nodes, firsts = parents, parent_firsts
+        height += 1
+    nodes[0].type = NodeType.ROOT
+    return nodes[0], height
+
+
+def measure_construct(num_keys: int, order: int, with_values: bool = False, layout: str = 'slots',
+                      **kwargs) -> Dict:
+    """build a tree via BPlusTree.construct and report the memory held by the tree afterwards, per key.
+    the input keys are generated under tracing as well, since leaves keep the key objects alive.
+    with_values stores a separate row id per key instead of the key itself as payload.
+    layout 'dict' builds the same tree out of DictNode, the node layout before __slots__, instead.
+    """
+    tracemalloc.start()
+    keys = gen_keys(num_keys)
+    start = time.perf_counter()
+    if layout == 'dict':
+        tree, height = construct_dict_nodes(order, keys, list(range(num_keys)) if with_values else keys)
+    elif with_values:
+        tree = BPlusTree(order, items=list(zip(keys, range(num_keys))), **kwargs)
+    else:
+        tree = BPlusTree(order, keys=keys, **kwargs)
+    elapsed = time.perf_counter() - start
+    del keys
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'bytes_per_key': current / num_keys,
+        'peak_bytes_per_key': peak / num_keys,
+        'seconds': elapsed,
+        'height': height if layout == 'dict' else tree.get_height(),
+    }
+
+
+def memory_benchmark(num_keys: int = 10_000_000, order: int = 128):
+    """bytes per key of a tree built from num_keys integer keys: the node layout before __slots__ with list keys,
+    against the current one with the list, array('q') and packed key stores"""
+    cases = [('dict', 'list')] + [('slots', key_store) for key_store in ['list', 'array', 'packed']]
+    for with_values in [False, True]:
+        for layout, key_store in cases:
+            if layout == 'dict':
+                result = measure_construct(num_keys, order, with_values, layout)
+            else:
+                result = measure_construct(num_keys, order, with_values, layout, key_store=key_store)
+            print('{} keys, order {}, {}, {} nodes, key store {}: {:.1f} bytes/key, peak {:.1f} bytes/key, {:.1f}s, '
+                  'height {}'.format(num_keys, order, 'key -> row id' if with_values else 'key only', layout,
+                                     key_store, result['bytes_per_key'], result['peak_bytes_per_key'],
+                                     result['seconds'], result['height']))
+
+
+def search_many_benchmark(num_keys: int = 1_000_000, batch_size: int = 10_000, order: int = 128, num_batch: int = 10):
+    """BPlusTree.search_many against calling BPlusTree.search per key, on random batches with ~50% hit rate.
+    the batch is spread over the whole key range, or packed into a narrow window of it."""
+    keys = gen_keys(num_keys)
+    tree = BPlusTree(order, keys=list(keys))
+    low, high = keys[0], keys[0] + 2 * num_keys
+    for spread in ['wide', 'narrow']:
+        width = high - low if spread == 'wide' else 4 * batch_size
+        batches = []
+        for _ in range(num_batch):
+            start = random.randrange(low, high - width + 1)
+            batches.append([random.randrange(start, start + width) for _ in range(batch_size)])
+
+        start = time.perf_counter()
+        expected = [[tree.search(key) for key in batch] for batch in batches]
+        loop = time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = [tree.search_many(batch) for batch in batches]
+        many = time.perf_counter() - start
+
+        if expected != actual:
+            raise Exception('search_many result differs from search')
+        print('{} keys, order {}, {} batches of {} {}: search loop {:.3f}s, search_many {:.3f}s, speedup {:.2f}x'
+              .format(num_keys, order, num_batch, batch_size, spread, loop, many, loop / many))
+
+
+def cold_start_benchmark(num_keys: int = 1_000_000, order: int = 128, num_lookup: int = 10_000):
+    """time to a first answer: rebuild with BPlusTree.construct against opening a file written by dump"""
+    keys = gen_keys(num_keys)
+    lookups = [random.choice(keys) for _ in range(num_lookup)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tree.db')
+        start = time.perf_counter()
+        tree = BPlusTree(order, keys=list(keys))
+        rebuild = time.perf_counter() - start
+        dump(tree, path)
+
+        start = time.perf_counter()
+        disk_tree = DiskBPlusTree(path)
+        open_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        memory_values = [tree.get(key) for key in lookups]
+        memory_lookup = time.perf_counter() - start
+        start = time.perf_counter()
+        disk_values = [disk_tree.get(key) for key in lookups]
+        disk_lookup = time.perf_counter() - start
+        disk_tree.close()
+
+        if memory_values != disk_values:
+            raise Exception('disk tree result differs from memory tree')
+        print('{} keys, order {}: rebuild {:.3f}s, open file {:.6f}s, {} lookups memory {:.3f}s, disk {:.3f}s'
+              .format(num_keys, order, rebuild, open_time, num_lookup, memory_lookup, disk_lookup))
+
+
+def buffer_pool_benchmark(num_keys: int = 1_000_000, order: int = 128, num_lookup: int = 100_000,
+                          pool_fraction: float = 0.05):
+    """hit ratio of the disk tree buffer pool, lru against clock, for uniform and skewed (80/20) lookups,
+    with a pool of pool_fraction of the pages"""
+    keys = gen_keys(num_keys)
+    hot = keys[:num_keys // 5]
+    uniform = [random.choice(keys) for _ in range(num_lookup)]
+    skewed = [random.choice(hot) if random.random() < 0.8 else random.choice(keys) for _ in range(num_lookup)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tree.db')
+        dump(BPlusTree(order, keys=keys), path)
+        num_pages = os.path.getsize(path) // get_page_size(order)  # upper bound, includes the heap
+        for policy in ['lru', 'clock']:
+            for name, lookups in [('uniform', uniform), ('skewed', skewed)]:
+                with DiskBPlusTree(path, pool_size=max(1, int(num_pages * pool_fraction)), policy=policy) as tree:
+                    start = time.perf_counter()
+                    for key in lookups:
+                        tree.get(key)
+                    elapsed = time.perf_counter() - start
+                    stats = tree.pool.get_stats()
+                print('{} keys, order {}, pool of {} pages, {} {} lookups: {:.3f}s, hit ratio {:.3f}, '
+                      '{:.2f} misses/lookup'.format(num_keys, order, stats['capacity'], policy, name, elapsed,
+                                                    stats['hit_ratio'], stats['misses'] / num_lookup))
+
+
+def snapshot_benchmark(num_keys: int = 1_000_000, order: int = 128):
+    """reload a tree from a snapshot against rebuilding it with BPlusTree.construct, keys only and key -> row id"""
+    keys = gen_keys(num_keys)
+    random.shuffle(keys)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tree.snap')
+        for with_values in [False, True]:
+            start = time.perf_counter()
+            if with_values:
+                tree = BPlusTree(order, items=list(zip(keys, range(num_keys))))
+            else:
+                tree = BPlusTree(order, keys=list(keys))
+            rebuild = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with open(path, 'wb') as f:
+                BPlusTreeSnapshot.dump(tree, f)
+            dump_time = time.perf_counter() - start
+            start = time.perf_counter()
+            with open(path, 'rb') as f:
+                loaded = BPlusTreeSnapshot.load(f)
+            load_time = time.perf_counter() - start
+
+            if list(loaded.iter_range()) != list(tree.iter_range()):
+                raise Exception('snapshot differs from tree')
+            print('{} keys, order {}, {}: construct {:.3f}s, snapshot dump {:.3f}s, load {:.3f}s, {:.1f} MB'
+                  .format(num_keys, order, 'key -> row id' if with_values else 'key only', rebuild, dump_time,
+                          load_time, os.path.getsize(path) / 1e6))
+
+
+def bulk_load_benchmark(num_keys: int = 10_000_000, order: int = 128):
+    """BPlusTreeBulk.bulk_load on a numpy array against BPlusTree.construct on a list of the same shuffled keys"""
+    np = BPlusTreeBulk.np
+    if np is None:
+        print('numpy is not installed, skip bulk load benchmark')
+        return
+    keys = np.random.permutation(num_keys).astype(np.int64) + (1 << 32)
+    for option in ['dense', 'sparse']:
+        key_list = keys.tolist()
+        start = time.perf_counter()
+        BPlusTree(order, keys=key_list, option=option)
+        construct = time.perf_counter() - start
+        start = time.perf_counter()
+        BPlusTreeBulk.bulk_load(order, keys, option=option)
+        bulk = time.perf_counter() - start
+        print('{} keys, order {}, {}: construct {:.3f}s, bulk_load {:.3f}s, speedup {:.2f}x'
+              .format(num_keys, order, option, construct, bulk, construct / bulk))
+
+
+def fill_factor_benchmark(num_keys: int = 200_000, num_insert: int = 40_000, order: int = 64,
+                          options: Tuple = ('dense', 0.9, 0.8, 0.7, 0.6, 'sparse')):
+    """node splits caused by random inserts after building at several fill factors, against the leaves and
+    height the layout costs up front.  splits are counted through the tracer hook."""
+    keys = list(range(0, 2 * num_keys, 2))  # even keys, inserts go in between
+    inserts = random.sample(range(1, 2 * num_keys, 2), min(num_insert, num_keys))
+    splits = [0]
+
+    def count_splits(msg: str, *args) -> None:
+        if msg in ('INSERTION OVERFLOW', 'root overflows.  left and right node: '):
+            splits[0] += 1
+
+    for option in options:
+        tree = BPlusTree(order, keys=list(keys), option=option)
+        num_leaves, height = tree.get_num_leaves(), tree.get_height()
+        splits[0] = 0
+        set_tracer(count_splits)
+        start = time.perf_counter()
+        for key in inserts:
+            tree.insert(key)
+        elapsed = time.perf_counter() - start
+        set_tracer(None)
+        print('{} keys, order {}, option {}: {} leaves, height {}, {} inserts: {} splits, {:.3f}s, {} leaves after'
+              .format(num_keys, order, option, num_leaves, height, len(inserts), splits[0], elapsed,
+                      tree.get_num_leaves()))
+
+
+def separator_benchmark(num_keys: int = 200_000, order: int = 64):
+    """size of the keys held by internal nodes for long string keys with a common prefix, shortest separators
+    against full keys, which all have the same length here"""
+    keys = ['https://example.com/users/{:012d}/profile'.format(key) for key in random.sample(range(10 ** 12), num_keys)]
+    tree = BPlusTree(order, keys=keys)
+    separators = [key for height in range(1, tree.get_height() + 1) for node_keys in tree.get_key_layer(height)
+                  for key in node_keys]
+    separator_bytes = sum(sys.getsizeof(key) for key in separators)
+    full_bytes = sys.getsizeof(keys[0]) * len(separators)
+    print('{} keys of {} chars, order {}: {} internal keys of {:.1f} chars on average, {} bytes against {} bytes '
+          'for full keys'.format(num_keys, len(keys[0]), order, len(separators),
+                                 sum(len(key) for key in separators) / len(separators), separator_bytes, full_bytes))
+
+
+def wal_benchmark(num_keys: int = 20_000, order: int = 128, group_sizes: Tuple[int, ...] = (1, 8, 64, 512)):
+    """insert throughput of a logged tree for several group commit sizes, group size 1 fsyncs every insert"""
+    keys = gen_keys(num_keys)
+    random.shuffle(keys)
+    with tempfile.TemporaryDirectory() as directory:
+        for group_size in group_sizes:
+            path = os.path.join(directory, 'tree{}.log'.format(group_size))
+            tree = BPlusTree(order, wal=WriteAheadLog(path, group_size=group_size))
+            start = time.perf_counter()
+            for key in keys:
+                tree.insert(key)
+            tree.wal.close()
+            elapsed = time.perf_counter() - start
+            print('{} inserts, order {}, group commit of {}: {:.3f}s, {:.0f} inserts/s, {} fsyncs'
+                  .format(num_keys, order, group_size, elapsed, num_keys / elapsed, tree.wal.num_commits))
+
+
+def mvcc_benchmark(num_keys: int = 1_000_000, num_update: int = 100_000, order: int = 128):
+    """upserts with and without a snapshot held, a full scan of a snapshot while the tree keeps changing, and the
+    memory taken by the nodes copied for the snapshot, until it is released"""
+    keys = gen_keys(num_keys)
+    updates = random.sample(keys, num_update)
+    for held in [False, True]:
+        tree = BPlusTree(order, keys=list(keys))
+        snapshot = tree.snapshot() if held else None
+        start = time.perf_counter()
+        for key in updates:
+            tree.upsert(key, -key)
+        elapsed = time.perf_counter() - start
+        print('{} keys, order {}, {} upserts {}: {:.3f}s'
+              .format(num_keys, order, num_update, 'with a snapshot held' if held else 'without snapshot', elapsed))
+
+    start = time.perf_counter()
+    for i, (key, value) in enumerate(snapshot.iter_range()):
+        if key != value:
+            raise Exception('snapshot sees a later value of {}'.format(key))
+        if i % 10 == 0:
+            tree.upsert(key, 0)
+    print('full scan of the snapshot with an upsert every 10 keys: {:.3f}s'.format(time.perf_counter() - start))
+    snapshot.release()
+
+    tracemalloc.start()  # traced from the build, so that the nodes freed on release are seen
+    tree = BPlusTree(order, keys=list(keys))
+    built = tracemalloc.get_traced_memory()[0]
+    snapshot = tree.snapshot()
+    for key in updates:
+        tree.upsert(key, -key)
+    updated = tracemalloc.get_traced_memory()[0]
+    snapshot.release()
+    released = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('tree of {:.1f} MB, {:.1f} MB more with the snapshot held after {} upserts, {:.1f} MB more once released'
+          .format(built / 1e6, (updated - built) / 1e6, num_update, (released - built) / 1e6))
+
+
+def stats_benchmark(num_keys: int = 1_000_000, order: int = 128, num_call: int = 1000):
+    """len and repr, which read the statistics kept by the changes, against the walk of the leaves they replace"""
+    tree = BPlusTree(order, keys=gen_keys(num_keys))
+    start = time.perf_counter()
+    for _ in range(num_call):
+        len(tree)
+        repr(tree)
+    elapsed = time.perf_counter() - start
+    print('{} keys, order {}, {} calls of len and repr: {:.6f}s'.format(num_keys, order, num_call, elapsed))
+    start = time.perf_counter()
+    for _ in range(10):
+        tree.root.get_num_keys_total()
+    elapsed = time.perf_counter() - start
+    print('count by a walk of the leaves: {:.6f}s per call'.format(elapsed / 10))
+
+
+def order_statistic_benchmark(num_keys: int = 1_000_000, order: int = 128, num_query: int = 1000):
+    """count_range, select and deep pages of iter_range by the counts kept in the internal nodes, against the scans
+    they replace"""
+    keys = gen_keys(num_keys)
+    tree = BPlusTree(order, keys=keys)
+    bounds = [sorted(random.sample(keys, 2)) for _ in range(num_query)]
+    positions = [random.randrange(num_keys) for _ in range(num_query)]
+
+    start = time.perf_counter()
+    counts = [tree.count_range(left, right) for left, right in bounds]
+    elapsed = time.perf_counter() - start
+    print('{} keys, order {}, {} count_range: {:.3f}s'.format(num_keys, order, num_query, elapsed))
+    start = time.perf_counter()
+    for (left, right), count in list(zip(bounds, counts))[:10]:
+        if sum(1 for _ in tree.iter_range(left, right)) != count:
+            raise Exception('count_range({}, {}) is wrong'.format(left, right))
+    print('count by a scan: {:.3f}s per range'.format((time.perf_counter() - start) / 10))
+
+    start = time.perf_counter()
+    for position in positions:
+        tree.select(position)
+    print('{} select: {:.3f}s'.format(num_query, time.perf_counter() - start))
+    start = time.perf_counter()
+    for position in positions[:10]:
+        list(tree.iter_range(offset=position, limit=10))
+    print('page of 10 at a random offset: {:.6f}s per page'.format((time.perf_counter() - start) / 10))
+
+
+def aggregate_benchmark(num_keys: int = 1_000_000, order: int = 128, num_query: int = 1000):
+    """sum and max over key ranges by the aggregates kept in the internal nodes, against a range_search and a
+    reduction, and the cost of keeping them on inserts"""
+    keys = gen_keys(num_keys)
+    items = [(key, random.random()) for key in keys]
+    aggregates = {'sum': SUM, 'max': MAX}
+    for kept in (None, aggregates):
+        start = time.perf_counter()
+        tree = BPlusTree(order, aggregates=kept)
+        for key, value in items[:num_keys // 10]:
+            tree.insert(key, value)
+        print('{} inserts, aggregates {}: {:.3f}s'.format(num_keys // 10, list(kept or ()),
+                                                          time.perf_counter() - start))
+
+    tree = BPlusTree(order, items=items, aggregates=aggregates)
+    bounds = [sorted(random.sample(keys, 2)) for _ in range(num_query)]
+    start = time.perf_counter()
+    sums = [tree.aggregate_range(left, right, 'sum') for left, right in bounds]
+    for left, right in bounds:
+        tree.aggregate_range(left, right, 'max')
+    print('{} keys, order {}, {} sum and max: {:.3f}s'.format(num_keys, order, num_query,
+                                                              time.perf_counter() - start))
+    start = time.perf_counter()
+    for (left, right), total in list(zip(bounds, sums))[:10]:
+        if abs(sum(tree.range_search(left, right)) - total) > 1e-6 * max(abs(total), 1):
+            raise Exception('aggregate_range({}, {}) is wrong'.format(left, right))
+    print('sum by range_search: {:.3f}s per range'.format((time.perf_counter() - start) / 10))
+
+
+def multimap_benchmark(num_rows: int = 1_000_000, num_distinct: int = 1000, order: int = 128, num_query: int = 100):
+    """a secondary index of num_rows row ids over num_distinct key values: posting lists of a multimap tree against
+    one leaf slot per row, as (key, rowid) keys of a plain tree.  memory per row, and range scans of row ids.
+    the pairs are generated under tracing as well, since the plain tree keeps them alive as its keys."""
+    bounds = [sorted(random.sample(range(num_distinct), 2)) for _ in range(num_query)]
+    for multimap in [False, True]:
+        rng = random.Random(0)
+        tracemalloc.start()
+        pairs = [(rng.randrange(num_distinct), rowid) for rowid in range(num_rows)]
+        tree = MultiBPlusTree(order, items=pairs) if multimap else BPlusTree(order, keys=sorted(pairs))
+        del pairs
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        start = time.perf_counter()
+        if multimap:
+            rows = sum(sum(1 for _ in tree.iter_postings(left, right)) for left, right in bounds)
+        else:
+            rows = sum(sum(1 for _ in tree.iter_range((left, -1), (right, num_rows))) for left, right in bounds)
+        print('{} rows, {} keys, order {}, {}: {:.1f} bytes/row, {} range scans {:.3f}s, {} rows'.format(
+            num_rows, num_distinct, order, 'posting lists' if multimap else '(key, rowid) keys', current / num_rows,
+            num_query, time.perf_counter() - start, rows))
+
+
+def reverse_scan_benchmark(num_keys: int = 1_000_000, order: int = 128, num_query: int = 1000, top: int = 10):
+    """the top keys and a full descending scan by the prev pointers of the leaves, against stepping back along the
+    descent path, which a snapshot does since it does not read the links"""
+    keys = gen_keys(num_keys)
+    tree = BPlusTree(order, keys=keys)
+    froms = random.sample(keys, num_query)
+    snapshot = tree.snapshot()
+    for name, view in [('prev pointers', tree), ('descent path', snapshot)]:
+        start = time.perf_counter()
+        for key in froms:
+            list(view.iter_reverse(key, limit=top))
+        queries = time.perf_counter() - start
+        start = time.perf_counter()
+        count = sum(1 for _ in view.iter_reverse())
+        scan = time.perf_counter() - start
+        if count != num_keys:
+            raise Exception('descending scan found {} keys, expected {}'.format(count, num_keys))
+        print('{} keys, order {}, {}: {} top {} queries {:.3f}s, full descending scan {:.3f}s'
+              .format(num_keys, order, name, num_query, top, queries, scan))
+    snapshot.release()
+
+
+if __name__ == '__main__':
+    memory_benchmark()
+    search_many_benchmark()
+    cold_start_benchmark()
+    buffer_pool_benchmark()
+    snapshot_benchmark()
+    bulk_load_benchmark()
+    fill_factor_benchmark()
+    separator_benchmark()
+    wal_benchmark()
+    mvcc_benchmark()
+    stats_benchmark()
+    order_statistic_benchmark()
+    aggregate_benchmark()
+    multimap_benchmark()
+    reverse_scan_benchmark()
@@ -1,7 +1,22 @@
 # Created by Luming on 11/30/2020 11:57 AM
-from typing import List
-
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+
+import BPlusTreeBulk
+import BPlusTreeSnapshot
 from BPlusTree import BPlusTree
+from BPlusTreeAggregate import SUM, MIN, MAX
+from BPlusTreeBuffer import BufferPool
+from BPlusTreeConcurrent import ConcurrentBPlusTree
+from BPlusTreeDisk import DiskBPlusTree, dump
+from BPlusTreeLog import WriteAheadLog, checkpoint, read_log, recover
+from BPlusTreeMulti import MultiBPlusTree
+from BPlusTreeNode import Node, NodeType, get_separator, set_tracer
+from BPlusTreePacked import PackedKeys
 
 import numpy as np
 
@@ -34,7 +49,7 @@ def gen_new_key(tree: BPlusTree) -> int:
     min_key, max_key = tree.get_min_key(), tree.get_max_key()
     while True:
         new_key = np.random.choice(range(min_key - 10, max_key + 10), 1)[0]
-        if tree.search(new_key) is None:
+        if new_key not in tree:
             return new_key
 
 
@@ -156,6 +171,681 @@ def random_operation_test(order: int, num_nodes: int, option: str, num_trial: in
         print('pass test')
 
 
+class SimulatedCrash(Exception):
+    pass
+
+
+def crash_at_step(step: int):
+    """tracer that raises at the given step of a tree operation, every traced step of split, merge and
+    redistribute is a crash point"""
+    count = [0]
+
+    def tracer(msg: str, *args) -> None:
+        count[0] += 1
+        if count[0] == step:
+            raise SimulatedCrash(msg)
+
+    return tracer
+
+
+def wal_crash_test(order: int, num_op: int):
+    """run random inserts and deletes on a logged tree, and crash each operation at every one of its steps in turn.
+    after each crash, the tree recovered from the log must be valid and hold exactly the keys of the committed
+    operations, the crashed one included, since a record is committed before its change is applied."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tree.log')
+        keys = set()
+        tree = BPlusTree(order, wal=WriteAheadLog(path, group_size=1))
+        for _ in range(num_op):
+            if keys and np.random.random() < 0.4:
+                key, op = int(np.random.choice(sorted(keys))), 'delete'
+            else:
+                key, op = int(np.random.randint(0, 10 * num_op)), 'upsert'
+            size = os.path.getsize(path)
+            step = 1
+            while True:
+                set_tracer(crash_at_step(step))
+                try:
+                    getattr(tree, op)(key, *([key] if op == 'upsert' else []))
+                except SimulatedCrash:
+                    crashed = True
+                else:
+                    crashed = False
+                finally:
+                    set_tracer(None)
+                tree.wal.close()
+                tree = recover(path, order, group_size=1)
+                expected = keys | {key} if op == 'upsert' else keys - {key}
+                if not tree.is_valid() or set(tree.get_leaf_keys()) != expected:
+                    raise Exception('recovery after {} {} crashed at step {} is not consistent'.format(op, key, step))
+                if not crashed:
+                    keys = expected
+                    break
+                # roll the log back to before the operation, and crash at the next step
+                tree.wal.close()
+                os.truncate(path, size)
+                tree = recover(path, order, group_size=1)
+                step += 1
+        tree.wal.close()
+    print('pass wal crash test, order {}, {} operations'.format(order, num_op))
+
+
+def wal_group_test(group_size: int = 4, group_interval: float = 0.05):
+    """a log commits its pending records once group_size of them are pending, and once the oldest of them is
+    group_interval seconds old, even with no append to follow it"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tree.log')
+        tree = BPlusTree(4, wal=WriteAheadLog(path, group_size=group_size))
+        for key in range(2 * group_size + 1):
+            tree.insert(key, key)
+        num_records = len(list(read_log(path)))
+        if num_records != 2 * group_size or tree.wal.num_commits != 2:
+            raise Exception('log committed {} records in {} groups'.format(num_records, tree.wal.num_commits))
+        tree.wal.close()
+        tree = recover(path, 4, group_size=10 * group_size, group_interval=group_interval)
+        tree.insert(-1, -1)
+        time.sleep(10 * group_interval)
+        if len(list(read_log(path))) != 2 * group_size + 2 or tree.wal.pending:
+            raise Exception('log did not commit a group older than its interval')
+        tree.wal.close()
+    print('pass wal group test, group size {}, interval {}s'.format(group_size, group_interval))
+
+
+def checkpoint_crash_test(order: int, num_round: int = 30, num_op: int = 100):
+    """run random inserts and deletes on a logged tree with a checkpoint after every round of them, each one either
+    completed, crashed before the log is emptied, or crashed before the snapshot is renamed into place, the old one
+    still there.  the tree recovered from the snapshot and the log must be valid and hold the keys of all the
+    rounds."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tree.log')
+        snapshot = os.path.join(directory, 'tree.snap')
+        items = {}
+        tree = BPlusTree(order, wal=WriteAheadLog(path, group_size=8))
+        for i in range(num_round):
+            for _ in range(num_op):
+                key = int(np.random.randint(0, 20 * num_op))
+                if key in items:
+                    tree.delete(key)
+                    del items[key]
+                else:
+                    tree.insert(key, i)
+                    items[key] = i
+            crash = i % 3
+            old = None
+            if crash == 2 and os.path.exists(snapshot):
+                with open(snapshot, 'rb') as f:
+                    old = f.read()
+
+            def truncate():
+                raise SimulatedCrash('checkpoint')
+
+            if crash:
+                tree.wal.truncate = truncate
+            try:
+                checkpoint(tree, snapshot)
+            except SimulatedCrash:
+                if old is not None:
+                    with open(snapshot, 'wb') as f:
+                        f.write(old)
+            tree.wal.close()
+            tree = recover(path, order, group_size=8, snapshot=snapshot)
+            if not tree.is_valid() or list(tree.iter_range()) != sorted(items.items()):
+                raise Exception('recovery after checkpoint {}, crash {} is not consistent'.format(i, crash))
+        tree.wal.close()
+        try:
+            recover(path, order, snapshot=snapshot, key_store='array')
+        except Exception as e:
+            if 'key store' not in str(e):
+                raise
+        else:
+            raise Exception('recover ignored the key store of the snapshot')
+    print('pass checkpoint crash test, order {}, {} rounds'.format(order, num_round))
+
+
+def concurrent_stress_test(order: int, num_thread: int = 8, num_op: int = 3000, key_store: str = 'list'):
+    """run random inserts, deletes, lookups and range searches, ascending and descending, from several threads on
+    one tree.  each thread owns the keys equal to its number modulo num_thread, so it knows which of them must be
+    found, and every thread looks up a set of keys that are never deleted.  the tree must end up valid and hold
+    exactly the keys left by the threads."""
+    key_range = 20000
+    fixed = list(range(key_range, key_range + 500))
+    tree = ConcurrentBPlusTree(order, keys=list(fixed), key_store=key_store)
+    owned = [set() for _ in range(num_thread)]
+    errors = []
+
+    def worker(t: int):
+        rng = np.random.RandomState(t)
+        keys = owned[t]
+        try:
+            for _ in range(num_op):
+                r = rng.random_sample()
+                key = int(rng.randint(0, key_range // num_thread)) * num_thread + t
+                if r < 0.45:
+                    tree.upsert(key, key)
+                    keys.add(key)
+                elif r < 0.7 and keys:
+                    key = int(rng.choice(sorted(keys)))
+                    if tree.pop(key) != key:
+                        errors.append('pop {} returned a wrong value'.format(key))
+                    keys.discard(key)
+                elif r < 0.85:
+                    if (tree.get(key) == key) != (key in keys):
+                        errors.append('get {} does not match'.format(key))
+                    key = fixed[rng.randint(0, len(fixed))]
+                    if tree.get(key) != key:
+                        errors.append('get {} missed a fixed key'.format(key))
+                else:
+                    left = int(rng.randint(0, key_range + len(fixed)))
+                    right = left + int(rng.randint(0, 2000))
+                    reverse = rng.random_sample() < 0.5
+                    limit = None
+                    if r < 0.925:
+                        values = tree.range_search(left, right, reverse)
+                    else:
+                        limit = int(rng.randint(1, 200))
+                        values = [value for _, value in tree.iter_range(left, right, reverse=reverse, limit=limit)]
+                    if reverse:
+                        values.reverse()
+                    if len(values) == limit:  # the matches stop at the last one taken
+                        left, right = (values[0], right) if reverse else (left, values[-1])
+                    if values != sorted(set(values)):
+                        errors.append('range [{}, {}] not sorted'.format(left, right))
+                    if [v for v in values if v % num_thread == t or v >= key_range] != \
+                            sorted(k for k in keys | set(fixed) if left <= k <= right):
+                        errors.append('range [{}, {}] does not match'.format(left, right))
+        except Exception as e:
+            errors.append(repr(e))
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads as often as possible, to interleave within operations
+    try:
+        threads = [threading.Thread(target=worker, args=(t,)) for t in range(num_thread)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    if errors:
+        raise Exception('concurrent stress test: {}'.format(errors[:5]))
+    if not tree.is_valid() or tree.get_leaf_keys() != sorted(set().union(*owned) | set(fixed)):
+        raise Exception('tree not valid after concurrent operations')
+    print('pass concurrent stress test, order {}, {} threads, {} operations each, {} restarts'
+          .format(order, num_thread, num_op, tree.num_restarts))
+
+
+def random_tree(order: int, key_store: str = 'list', key_range: int = 5000, **kwargs) -> Tuple[BPlusTree, Dict]:
+    """a tree of key_range // 5 random keys below key_range, each its own value, and the dict of its pairs"""
+    keys = [int(key) for key in np.random.choice(key_range, key_range // 5, replace=False)]
+    tree = BPlusTree(order, items=[(key, key) for key in keys], key_store=key_store, **kwargs)
+    return tree, {key: key for key in keys}
+
+
+def random_workload(tree: BPlusTree, items: Dict, num_op: int, key_range: int = 5000) -> Iterator[int]:
+    """run random upserts, deletes, range deletes and bulk inserts on the tree, and the same changes on items.
+    yield the number of each operation once it is applied, for the caller to check the tree against items."""
+    for i in range(num_op):
+        r = np.random.random()
+        key = int(np.random.randint(0, key_range))
+        if r < 0.5:
+            tree.upsert(key, i)
+            items[key] = i
+        elif r < 0.9:
+            tree.delete(key)
+            items.pop(key, None)
+        elif r < 0.95:
+            right = key + int(np.random.randint(0, 200))
+            tree.delete_range(key, right)
+            for k in [k for k in items if key <= k <= right]:
+                del items[k]
+        else:
+            batch = sorted(set(int(k) for k in np.random.randint(key, key + 500, 40)))
+            tree.bulk_insert([(k, -k) for k in batch])
+            items.update((k, -k) for k in batch)
+        yield i
+
+
+def snapshot_test(order: int, num_op: int = 3000, key_store: str = 'list'):
+    """take and release snapshots at random during a random workload.  every snapshot must hold exactly the pairs
+    of the tree when it was taken, the tree must stay valid, and it must stop copying once the last snapshot is
+    released."""
+    tree, items = random_tree(order, key_store)
+    snapshots = []
+    for i in random_workload(tree, items, num_op):
+        r = np.random.random()
+        if r < 0.03:
+            snapshots.append((tree.snapshot(), sorted(items.items())))
+        elif r < 0.05 and snapshots:
+            snapshot, expected = snapshots.pop(np.random.randint(len(snapshots)))
+            with snapshot:
+                if list(snapshot.iter_range()) != expected:
+                    raise Exception('snapshot version {} changed'.format(snapshot.version))
+        if i % 100 == 0 and (not tree.is_valid() or list(tree.iter_range()) != sorted(items.items())):
+            raise Exception('tree not valid after operation {}'.format(i))
+    for snapshot, expected in snapshots:
+        if list(snapshot.iter_range()) != expected or list(snapshot.iter_range(reverse=True)) != expected[::-1]:
+            raise Exception('snapshot version {} changed'.format(snapshot.version))
+        snapshot.release()
+    if tree.pinned != -1:
+        raise Exception('snapshots still held after release: {}'.format(tree.versions))
+    print('pass snapshot test, order {}, {} operations, {} snapshots held at the end'
+          .format(order, num_op, len(snapshots)))
+
+
+def order_statistic_test(order: int, num_op: int = 3000, key_store: str = 'list'):
+    """check rank, select, count_range and pages of iter_range against the sorted keys after each operation of a
+    random workload."""
+    key_range = 5000
+    tree, items = random_tree(order, key_store, key_range)
+    for i in random_workload(tree, items, num_op, key_range):
+        expected = np.array(sorted(items), dtype=np.int64)
+        left, right = sorted(int(k) for k in np.random.randint(0, key_range, 2))
+        lo, hi = np.searchsorted(expected, left), np.searchsorted(expected, right, side='right')
+        if tree.rank(left) != lo or tree.count_range(left, right) != hi - lo:
+            raise Exception('rank or count of [{}, {}] wrong after operation {}'.format(left, right, i))
+        if len(expected) and tree.select(int(np.random.randint(len(expected)))) not in items:
+            raise Exception('select wrong after operation {}'.format(i))
+        offset = int(np.random.randint(0, 50))
+        if [k for k, _ in tree.iter_range(left, right, offset=offset, limit=10)] != \
+                expected[lo + offset:min(hi, lo + offset + 10)].tolist():
+            raise Exception('page of [{}, {}] at offset {} wrong after operation {}'.format(left, right, offset, i))
+        if i % 100 == 0 and (not tree.is_valid() or [tree.select(j) for j in range(len(tree))] != expected.tolist()):
+            raise Exception('tree not valid after operation {}'.format(i))
+    print('pass order statistic test, order {}, {} operations'.format(order, num_op))
+
+
+def aggregate_test(order: int, num_op: int = 3000, key_store: str = 'list'):
+    """check aggregate_range of a tree that keeps sum, min and max against the values in the range after each
+    operation of a random workload."""
+    key_range = 5000
+    tree, items = random_tree(order, key_store, key_range, aggregates={'sum': SUM, 'min': MIN, 'max': MAX})
+    for i in random_workload(tree, items, num_op, key_range):
+        left, right = sorted(int(k) for k in np.random.randint(0, key_range, 2))
+        values = [v for k, v in items.items() if left <= k < right]
+        expected = {'sum': sum(values), 'min': min(values, default=MIN.identity),
+                    'max': max(values, default=MAX.identity)}
+        for op, value in expected.items():
+            if tree.aggregate_range(left, right, op, (True, False)) != value:
+                raise Exception('{} of [{}, {}) wrong after operation {}'.format(op, left, right, i))
+        if i % 100 == 0 and not tree.is_valid():
+            raise Exception('tree not valid after operation {}'.format(i))
+    print('pass aggregate test, order {}, {} operations'.format(order, num_op))
+
+
+def multimap_test(order: int, num_op: int = 3000, key_store: str = 'list'):
+    """run random inserts and deletes of (key, rowid) pairs on a multimap tree with few distinct keys, and check
+    iter_postings and range_search against the sorted pairs after each of them."""
+    key_range, rowid_range = 300, 100
+    pairs = set(zip(np.random.randint(0, key_range, 1000).tolist(), np.random.randint(0, rowid_range, 1000).tolist()))
+    tree = MultiBPlusTree(order, items=list(pairs), key_store=key_store)
+    for i in range(num_op):
+        r = np.random.random()
+        key, rowid = int(np.random.randint(0, key_range)), int(np.random.randint(0, rowid_range))
+        if r < 0.5:
+            if (key, rowid) not in pairs:
+                tree.insert(key, rowid)
+                pairs.add((key, rowid))
+        elif r < 0.95:
+            tree.delete(key, rowid)
+            pairs.discard((key, rowid))
+        else:
+            tree.delete(key)
+            pairs = {pair for pair in pairs if pair[0] != key}
+
+        left, right = sorted(int(k) for k in np.random.randint(0, key_range, 2))
+        expected = sorted(pair for pair in pairs if left <= pair[0] <= right)
+        if list(tree.iter_postings(left, right)) != expected or \
+                tree.range_search(left, right) != [rowid for _, rowid in expected]:
+            raise Exception('postings of [{}, {}] wrong after operation {}'.format(left, right, i))
+        if i % 100 == 0 and (not tree.is_valid() or len(tree) != len({key for key, _ in pairs})):
+            raise Exception('tree not valid after operation {}'.format(i))
+    print('pass multimap test, order {}, {} operations'.format(order, num_op))
+
+
+def reverse_scan_test(order: int, num_op: int = 3000, key_store: str = 'list'):
+    """check iter_reverse and descending range_search against the sorted keys after each operation of a random
+    workload."""
+    key_range = 5000
+    tree, items = random_tree(order, key_store, key_range)
+    for i in random_workload(tree, items, num_op, key_range):
+        expected = sorted(items.items(), reverse=True)
+        left, right = sorted(int(k) for k in np.random.randint(0, key_range, 2))
+        limit = int(np.random.randint(0, 20))
+        if list(tree.iter_reverse(right, limit=limit)) != [(k, v) for k, v in expected if k <= right][:limit]:
+            raise Exception('top {} below {} wrong after operation {}'.format(limit, right, i))
+        if tree.range_search(left, right, reverse=True) != [v for k, v in expected if left <= k <= right]:
+            raise Exception('descending range [{}, {}] wrong after operation {}'.format(left, right, i))
+        if i % 100 == 0 and (not tree.is_valid() or list(tree.iter_reverse()) != expected):
+            raise Exception('tree not valid after operation {}'.format(i))
+    print('pass reverse scan test, order {}, {} operations'.format(order, num_op))
+
+
+def disk_test(order: int, num_keys: int = 2000, num_query: int = 200):
+    """dump a tree to the disk format and open it again, through the memory map and through a small buffer pool, and
+    check len, get and iter_range with open and closed bounds, reverse, offset and limit against the tree.  an empty
+    tree and a tree of a single leaf are checked as well."""
+    keys = gen_record(range(3 * num_keys), num_keys)
+    trees = [BPlusTree(order), BPlusTree(order, items=[(key, str(key)) for key in keys[:2]]),
+             BPlusTree(order, items=[(key, str(key)) for key in keys])]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tree.db')
+        for tree in trees:
+            dump(tree, path)
+            for pool_size in [None, 3]:
+                with DiskBPlusTree(path, pool_size=pool_size) as disk_tree:
+                    if len(disk_tree) != len(tree):
+                        raise Exception('disk tree holds {} keys, expected {}'.format(len(disk_tree), len(tree)))
+                    for key in np.random.randint(-1, 3 * num_keys + 1, num_query).tolist():
+                        if disk_tree.get(key, 'missing') != tree.get(key, 'missing'):
+                            raise Exception('get {} differs from the tree'.format(key))
+                    for _ in range(num_query):
+                        left, right = sorted(np.random.randint(-1, 3 * num_keys + 1, 2).tolist())
+                        left = None if np.random.random() < 0.2 else left
+                        right = None if np.random.random() < 0.2 else right
+                        inclusive = tuple(bool(b) for b in np.random.randint(0, 2, 2))
+                        reverse = bool(np.random.randint(0, 2))
+                        offset, limit = int(np.random.randint(0, 20)), int(np.random.randint(0, 50))
+                        args = (left, right, inclusive, reverse, limit, offset)
+                        if list(disk_tree.iter_range(*args)) != list(tree.iter_range(*args)):
+                            raise Exception('iter_range{} differs from the tree'.format(args))
+                    if list(disk_tree.iter_range()) != list(tree.iter_range()):
+                        raise Exception('full scan differs from the tree')
+    print('pass disk test, order {}, {} keys'.format(order, num_keys))
+
+
+class PageStore:
+    """pages in memory for buffer_pool_test, page i is [1 for an internal page else 0, i]"""
+
+    def __init__(self, num_pages: int, internal: List[int]):
+        self.pages = {i: bytes([int(i in internal), i]) for i in range(num_pages)}
+
+    def read_page(self, page_id: int) -> bytes:
+        return self.pages[page_id]
+
+    def write_page(self, page_id: int, data: bytes) -> None:
+        self.pages[page_id] = data
+
+
+def buffer_pool_test(num_keys: int = 3000):
+    """a pool of 3 frames over more pages: the victim of each policy, internal pages kept over leaves, pinned pages
+    never evicted, and a dirty page written back on eviction and on flush.  then a writable disk tree with a pool
+    much smaller than the tree, whose updates must be read back after eviction and after the tree is reopened."""
+    def access(pool: BufferPool, page_id: int, value: int = None) -> None:
+        data = pool.pin(page_id)
+        if data[1] != page_id and value is None:
+            raise Exception('page {} holds {}'.format(page_id, list(data)))
+        if value is not None:
+            data[1] = value
+        pool.unpin(page_id, dirty=value is not None)
+
+    for policy, survivors in [('lru', {1, 3, 4}), ('clock', {2, 4, 5})]:
+        store = PageStore(10, internal=[0])
+        pool = BufferPool(store, 3, policy, retain=lambda data: data[0] == 1)
+        for page_id in [1, 2, 3, 1, 4] if policy == 'lru' else [1, 2, 3, 4, 2, 5]:
+            access(pool, page_id)
+        if set(pool.frames) != survivors:
+            raise Exception('{} kept pages {}, expected {}'.format(policy, sorted(pool.frames), sorted(survivors)))
+
+        pool = BufferPool(store, 3, policy, retain=lambda data: data[0] == 1)
+        access(pool, 0)
+        held = pool.pin(6)
+        for page_id in range(1, 10):
+            access(pool, page_id)
+            if 0 not in pool.frames or 6 not in pool.frames:
+                raise Exception('{} evicted an internal or a pinned page'.format(policy))
+        held[1] = 60
+        pool.unpin(6, dirty=True)
+        for page_id in range(1, 6):
+            access(pool, page_id)
+        if 6 in pool.frames or store.pages[6][1] != 60 or pool.writes != 1:
+            raise Exception('{} did not write back the dirty page on eviction'.format(policy))
+        access(pool, 2, value=20)
+        pool.flush()
+        if store.pages[2][1] != 20 or pool.pin(6)[1] != 60:
+            raise Exception('{} did not write back the dirty page on flush'.format(policy))
+        pool.unpin(6)
+        for page_id in range(3):
+            pool.pin(page_id)
+        try:
+            pool.pin(9)
+        except Exception as e:
+            if 'exhausted' not in str(e):
+                raise
+        else:
+            raise Exception('{} evicted a pinned page'.format(policy))
+
+    keys = gen_record(range(3 * num_keys), num_keys)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tree.db')
+        dump(BPlusTree(8, keys=keys), path)
+        for policy in ['lru', 'clock']:
+            with DiskBPlusTree(path, pool_size=4, policy=policy, writable=True) as disk_tree:
+                for key in keys:
+                    disk_tree.update(key, (policy, key))
+                if any(disk_tree.get(key) != (policy, key) for key in keys):
+                    raise Exception('{} lost an update after eviction'.format(policy))
+                if disk_tree.pool.evictions == 0 or disk_tree.pool.writes == 0:
+                    raise Exception('{} pool of 4 pages did not evict'.format(policy))
+            with DiskBPlusTree(path) as disk_tree:
+                if any(disk_tree.get(key) != (policy, key) for key in keys):
+                    raise Exception('{} lost an update after the tree was reopened'.format(policy))
+    print('pass buffer pool test')
+
+
+def snapshot_file_test(order: int, num_keys: int = 2000):
+    """dump trees to a snapshot file and load them back: int and str keys, keys as their own values, separate
+    values and values that only compare equal to their keys, every key store for int keys, an empty tree, and a
+    snapshot view.  the loaded tree must be valid, hold the same pairs with values of the same types, and have its
+    leaves linked both ways from its first to its last leaf."""
+    keys = gen_record(range(3 * num_keys), num_keys)
+    trees = [BPlusTree(order), BPlusTree(order, keys=[str(key) for key in keys]),
+             BPlusTree(order, items=[(key, [key]) for key in keys]),
+             BPlusTree(order, items=[(key, float(key)) for key in keys]),
+             BPlusTree(order, items=[(0, False), (1, True), (2, 2), (3.0, 3.0)])]
+    trees += [BPlusTree(order, keys=keys, key_store=key_store) for key_store in ['list', 'array', 'packed']]
+    views = [tree.snapshot() for tree in trees[-1:]]
+    for tree in trees + views:
+        with tempfile.TemporaryFile() as f:
+            BPlusTreeSnapshot.dump(tree, f)
+            f.seek(0)
+            loaded = BPlusTreeSnapshot.load(f)
+        if not loaded.is_valid() or [(key, value, type(value)) for key, value in loaded.iter_range()] != \
+                [(key, value, type(value)) for key, value in tree.iter_range()]:
+            raise Exception('loaded tree differs from the tree it was dumped from')
+        if loaded.key_store != tree.key_store or len(loaded) != len(tree):
+            raise Exception('loaded tree has key store {} and {} keys'.format(loaded.key_store, len(loaded)))
+        leaves = loaded.root.get_leaf_nodes()
+        if loaded.first_leaf is not leaves[0] or loaded.last_leaf is not leaves[-1]:
+            raise Exception('loaded tree does not know its first and last leaf')
+        if list(loaded.iter_leaves()) != leaves or list(loaded.iter_leaves_reverse()) != leaves[::-1]:
+            raise Exception('leaves of the loaded tree are not linked both ways')
+    for view in views:
+        view.release()
+    print('pass snapshot file test, order {}, {} keys'.format(order, num_keys))
+
+
+def gen_prefixed_keys(kind: str, num_keys: int) -> List:
+    """distinct str, bytes or tuple keys with long shared prefixes, so that separators can be cut short"""
+    keys = set()
+    while len(keys) < num_keys:
+        word = 'item/' + ''.join(np.random.choice(list('abc'), np.random.randint(1, 12)))
+        if kind == 'str':
+            keys.add(word)
+        elif kind == 'bytes':
+            keys.add(word.encode())
+        else:
+            keys.add((int(np.random.randint(0, 3)), word, int(np.random.randint(0, 3))))
+    return list(keys)
+
+
+def check_separators(node: Node, shortest: bool) -> None:
+    """every key of an internal node must route between the largest key to its left and the smallest to its right,
+    and if shortest, no prefix of it may do that as well"""
+    for idx, separator in enumerate(node.keys if node.pointers else []):
+        left = node.pointers[idx].get_last_leaf().keys[-1]
+        right = node.pointers[idx + 1].get_first_leaf().keys[0]
+        if not left < separator <= right:
+            raise Exception('separator {} does not route between {} and {}'.format(separator, left, right))
+        if shortest and separator[:-1] > left:
+            raise Exception('separator {} between {} and {} is longer than needed'.format(separator, left, right))
+    for child in node.pointers:
+        check_separators(child, shortest)
+
+
+def separator_test(order: int, num_keys: int = 2000):
+    """build trees of str, bytes and tuple keys and insert more keys into them: every separator must route and be
+    the shortest prefix that does.  once keys are deleted the separators must still route, and find every key."""
+    for kind in ['str', 'bytes', 'tuple']:
+        for a, b in [('apple', 'apricot'), ('ab', 'abc'), ('b', 'ba')]:
+            if kind != 'str':
+                a, b = (a.encode(), b.encode()) if kind == 'bytes' else (tuple(a), tuple(b))
+            separator = get_separator(a, b)
+            if not a < separator <= b or separator[:-1] > a:
+                raise Exception('get_separator({}, {}) returned {}'.format(a, b, separator))
+
+        keys = gen_prefixed_keys(kind, 2 * num_keys)
+        tree = BPlusTree(order, keys=keys[:num_keys])
+        check_separators(tree.root, shortest=True)
+        for key in keys[num_keys:]:
+            tree.insert(key)
+        check_separators(tree.root, shortest=True)
+        for idx in np.random.choice(len(keys), num_keys, replace=False).tolist():
+            tree.delete(keys[idx])
+        check_separators(tree.root, shortest=False)
+        if not tree.is_valid() or any(key not in tree for key in tree.get_leaf_keys()):
+            raise Exception('tree of {} keys not valid'.format(kind))
+    print('pass separator test, order {}, {} keys'.format(order, num_keys))
+
+
+def packed_keys_test(order: int, num_op: int = 3000):
+    """change PackedKeys next to a list of the same keys, with keys below the base and far beyond the width of the
+    offsets so that they are encoded again in wider frames, then run the random workload on a packed tree, whose
+    leaves are split and merged, and check it against the pairs."""
+    keys, packed = [], PackedKeys()
+    below_base = widened = 0
+    for i in range(num_op):
+        r = np.random.random()
+        itemsize = packed.offsets.itemsize
+        if r < 0.6 or not keys:
+            key = int(np.random.randint(0, 1 << int(np.random.choice([4, 12, 20, 40]))))
+            if key not in keys:
+                below_base += bool(keys) and key < packed.base
+                idx = packed.bisect_left(key)
+                packed.insert(idx, key)
+                keys.insert(idx, key)
+        elif r < 0.9:
+            idx = int(np.random.randint(len(keys)))
+            if packed.pop(idx) != keys.pop(idx):
+                raise Exception('pop {} differs'.format(idx))
+        else:  # a split and a concat, as a leaf does
+            cut = int(np.random.randint(len(keys) + 1))
+            left, right = packed[:cut], packed[cut:]
+            left.extend(right)
+            packed = left
+        widened += packed.offsets.itemsize > itemsize
+        probe = int(np.random.randint(0, 1 << 41))
+        if list(packed) != keys or packed.bisect_left(probe) != sorted(keys + [probe]).index(probe):
+            raise Exception('packed keys differ from the list after operation {}'.format(i))
+    if not below_base or not widened:
+        raise Exception('{} inserts below the base and {} wider frames'.format(below_base, widened))
+
+    key_range = 50000
+    tree, items = random_tree(order, 'packed', key_range)
+    for i in random_workload(tree, items, num_op, key_range):
+        if i % 100 == 0 and (not tree.is_valid() or list(tree.iter_range()) != sorted(items.items())):
+            raise Exception('packed tree not valid after operation {}'.format(i))
+    if not all(isinstance(leaf.keys, PackedKeys) for leaf in tree.get_leaf_nodes()) or \
+            list(tree.iter_range()) != sorted(items.items()):
+        raise Exception('packed tree not valid after {} operations'.format(num_op))
+    print('pass packed keys test, order {}, {} operations'.format(order, num_op))
+
+
+def bulk_load_test(order: int, num_keys: int = 2000):
+    """bulk_load int, float, str and bytes keys, bytes with trailing NULs among them, with and without values, dense,
+    sparse and at a fill factor, and int keys in every key store.  the tree must be valid and have the leaves and
+    pairs of the tree BPlusTree builds from the same keys."""
+    ints = gen_record(range(3 * num_keys), num_keys)
+    words = gen_prefixed_keys('bytes', num_keys // 2)
+    key_sets = [('int', ints), ('float', [key / 7 for key in ints]), ('str', gen_prefixed_keys('str', num_keys)),
+                ('bytes', words + [word + b'\x00' * (i % 3 + 1) for i, word in enumerate(words)])]
+    cases = [(kind, keys, 'list') for kind, keys in key_sets] + [('int', ints, 'array'), ('int', ints, 'packed')]
+    for kind, keys, key_store in cases:
+        values = [str(key) for key in keys]
+        for option in ['dense', 'sparse', 0.7]:
+            for with_values in [False, True]:
+                if with_values:
+                    tree = BPlusTreeBulk.bulk_load(order, keys, values, option=option, key_store=key_store)
+                    expected = BPlusTree(order, items=list(zip(keys, values)), option=option, key_store=key_store)
+                else:
+                    tree = BPlusTreeBulk.bulk_load(order, keys, option=option, key_store=key_store)
+                    expected = BPlusTree(order, keys=list(keys), option=option, key_store=key_store)
+                if not tree.is_valid() or list(tree.iter_range()) != list(expected.iter_range()) or \
+                        [list(leaf.keys) for leaf in tree.iter_leaves()] != \
+                        [list(leaf.keys) for leaf in expected.iter_leaves()]:
+                    raise Exception('bulk load of {} keys in {} store, {}, values {} differs from construct'
+                                    .format(kind, key_store, option, with_values))
+    print('pass bulk load test, order {}, {} keys'.format(order, num_keys))
+
+
+def fill_factor_test(order: int):
+    """sweep the fill factor from 0.5 to 1 over several numbers of keys.  the distributions of get_node_dist_fill,
+    of its numpy twin in BPlusTreeBulk and of get_split_dist must add up, fill every node to the target but the
+    last ones, and keep every node within its bounds.  the trees built and bulk inserted at that fill factor must be
+    valid, with the leaves of those distributions."""
+    tree = BPlusTree(order)
+    for fill_factor in [0.5, 0.6, 0.7, 0.8, 0.9, 1.0]:
+        for num in sorted({0, 1, 2, order - 1, order, order + 1, 5 * order + 3, 997}):
+            for node_type in [NodeType.LEAF, NodeType.NON_LEAF]:
+                lower, upper = tree.get_bounds(node_type)
+                target = tree.get_fill_target(node_type, fill_factor)
+                sizes = tree.get_node_dist_fill(num, node_type, fill_factor)
+                if sum(sizes) != num or any(size != target for size in sizes[:-2]) or \
+                        any(not lower <= size <= upper for size in sizes if len(sizes) > 1) or \
+                        sizes != BPlusTreeBulk.get_node_dist_array(num, lower, upper, fill_factor).tolist():
+                    raise Exception('fill {} of {} {} nodes: {}'.format(fill_factor, num, node_type, sizes))
+                sizes = tree.get_split_dist(num, node_type, fill_factor) if num > upper else []
+                if sum(sizes) != (num if sizes else 0) or any(not lower <= size <= upper for size in sizes):
+                    raise Exception('split at fill {} of {} {} nodes: {}'.format(fill_factor, num, node_type, sizes))
+
+            items = [(key, key) for key in range(num)]
+            built = BPlusTree(order, items=items, option=fill_factor)
+            if not built.is_valid() or [leaf.get_key_size() for leaf in built.iter_leaves()] != \
+                    (tree.get_node_dist_fill(num, NodeType.LEAF, fill_factor) or [0]):
+                raise Exception('tree built at fill {} from {} keys'.format(fill_factor, num))
+            inserted = BPlusTree(order)
+            inserted.bulk_insert(items, fill_factor)
+            upper = tree.get_bounds(NodeType.LEAF)[1]
+            expected = tree.get_split_dist(num, NodeType.LEAF, fill_factor) if num > upper else [num]
+            if not inserted.is_valid() or [leaf.get_key_size() for leaf in inserted.iter_leaves()] != expected:
+                raise Exception('bulk insert at fill {} of {} keys'.format(fill_factor, num))
+            inserted.bulk_insert([(key, key) for key in range(num, 2 * num, 2)], fill_factor)
+            if not inserted.is_valid():
+                raise Exception('second bulk insert at fill {} of {} keys'.format(fill_factor, num))
+    print('pass fill factor test, order {}'.format(order))
+
+
+def search_many_test(order: int, num_keys: int = 2000, num_query: int = 500, key_store: str = 'list'):
+    """search_many must return what search returns key by key, for sorted, presorted, unsorted and numpy batches,
+    with repeated and missing keys, keys below the first leaf and above the last one, before and after deletes."""
+    keys = [int(key) for key in np.random.choice(range(1000, 1000 + 3 * num_keys), num_keys, replace=False)]
+    tree = BPlusTree(order, items=[(key, -key) for key in keys], key_store=key_store)
+    for stage in range(2):
+        queries = [int(key) for key in np.random.randint(0, 2000 + 3 * num_keys, num_query)]
+        queries += [int(key) for key in np.random.choice(keys, num_query // 5)] * 2 + [-5, 0, 10 ** 9]
+        for batch in [queries, sorted(queries), sorted(queries, reverse=True), []]:
+            expected = [tree.search(key) for key in batch]
+            if tree.search_many(batch) != expected or tree.search_many(np.array(batch, dtype=np.int64)) != expected:
+                raise Exception('search_many differs from search, stage {}'.format(stage))
+            if batch == sorted(batch) and tree.search_many(batch, presorted=True) != expected:
+                raise Exception('presorted search_many differs from search, stage {}'.format(stage))
+            if tree.search_many(batch, default='missing') != [tree.get(key, 'missing') for key in batch]:
+                raise Exception('search_many ignores the default, stage {}'.format(stage))
+        for key in keys[:num_keys // 2]:
+            tree.delete(key)
+    print('pass search many test, order {}, {} keys, {} key store'.format(order, num_keys, key_store))
+
+
 if __name__ == '__main__':
     experiment()
     # random_operation_test(13, 2000, 'dense', 5)